@@ -1,117 +1,246 @@
 import pandas as pd
-import flywheel
-import warnings
 import argparse
 import ast
 import os
-from flywheel_bids_tools.query_bids import process_acquisition
 #from flywheel_bids_tools.bids_generator import BidsGenerator
-from flywheel_bids_tools.utils import read_flywheel_csv
+from flywheel_bids_tools.utils import read_flywheel_csv, ordered_map, read_table_header
+from flywheel_bids_tools.cassette import add_cassette_arguments
+from flywheel_bids_tools.ratelimit import add_policy_arguments
+from flywheel_bids_tools.instrument import stage, add_metrics_arguments, report_metrics
+from flywheel_bids_tools.client import add_client_arguments, client_for
 from tqdm import tqdm
 FAILS = []
 
+# the columns of the query table autofill-bids uses
+COLUMNS = ['acquisition.id', 'name', 'type', 'session.id', 'session.label',
+    'subject.label', 'info_BIDS_IntendedFor', 'info_BIDS_Folder',
+    'info_BIDS_Filename', 'info_SeriesDescription', 'info_ShimSetting',
+    'info_EchoTime1', 'info_EchoTime2']
 
-def build_intention_path(row):
 
-    path = "ses-{0}/{1}/{2}".format(
-        row['session.label'], row['info_BIDS_Folder'], row['info_BIDS_Filename'])
-    return path
+def build_intention_paths(df):
 
-def update_intentions(df, client):
+    paths = "ses-" + df['session.label'].astype(str) + "/" + \
+        df['info_BIDS_Folder'].astype(str) + "/" + df['info_BIDS_Filename'].astype(str)
+    return paths
 
-    global FAILS
-    df = df.dropna(subset=["info_BIDS_IntendedFor"]).reset_index()
 
-    counter = []
-    for index, row in tqdm(df.iterrows(), total=df.shape[0]):
+def session_columns(df):
+    '''
+    The columns that tell which session a row of the query table is in
+    '''
+
+    if 'session.id' in df.columns and df['session.id'].notnull().all():
+        return ['session.id']
+    return ['subject.label', 'session.label']
+
+
+def intended_folders(value):
+    '''
+    The BIDS folders a fieldmap's IntendedFor field points at, in the order
+    it lists them
+    '''
+
+    return list(dict.fromkeys(x['Folder'] for x in ast.literal_eval(value)))
+
+
+def resolve_intentions(df, match_shim=False):
+    '''
+    Work out the IntendedFor paths of every fieldmap in a query table
+
+    Each fieldmap is intended for the NIfTIs in the folders its IntendedFor
+    field lists, from the other acquisitions of its own session. All of them
+    are matched up at once by joining the fieldmaps to the session's files on
+    the session and folder.
+
+    Input:
+        df: the query table
+        match_shim: boolean; only match files with the same shim setting as
+            the fieldmap
+    Output:
+        intentions: dataframe with the acquisition.id and name of each
+            fieldmap file that has matches, and the list of their paths
+        fails: the fieldmap rows that couldn't be resolved, with the reason
+    '''
+
+    session = session_columns(df)
+    shim = ['info_ShimSetting'] if match_shim else []
+    fieldmaps = df.dropna(subset=["info_BIDS_IntendedFor"]).reset_index(drop=True)
+    fieldmaps['fieldmap'] = fieldmaps.index
+    fieldmaps['error'] = None
+
+    folders = []
+    for i, value in fieldmaps['info_BIDS_IntendedFor'].items():
+        try:
+            folders.extend((i, x) for x in intended_folders(value))
+        except Exception as e:
+            fieldmaps.at[i, 'error'] = "Unable to read IntendedFor: {}".format(e)
+    folders = pd.DataFrame(folders, columns=['fieldmap', 'info_BIDS_Folder'])
+    if match_shim:
+        fieldmaps.loc[fieldmaps['info_ShimSetting'].isnull() & fieldmaps['error'].isnull(), 'error'] = "No shim settings for this file"
+
+    targets = df.dropna(subset=['info_BIDS_Folder', 'info_BIDS_Filename'])
+    if 'type' in targets.columns:
+        targets = targets.loc[targets['type'].astype(str).str.contains("nifti")]
+    targets = targets.assign(path=build_intention_paths(targets))
+    targets = targets[session + shim + ['info_BIDS_Folder', 'acquisition.id', 'path']]
+
+    requests = folders.merge(
+        fieldmaps.loc[fieldmaps['error'].isnull(), ['fieldmap', 'acquisition.id'] + session + shim],
+        on='fieldmap')
+    matches = requests.merge(targets, on=session + shim + ['info_BIDS_Folder'], suffixes=('', '_target'))
+    # a fieldmap isn't intended for its own acquisition
+    matches = matches.loc[matches['acquisition.id'] != matches['acquisition.id_target']]
+    paths = matches.groupby('fieldmap', sort=False)['path'].agg(list)
+
+    fieldmaps['files'] = fieldmaps['fieldmap'].map(paths)
+    no_match = "No matching files for this shim setting" if match_shim else "No matching files"
+    fieldmaps.loc[fieldmaps['files'].isnull() & fieldmaps['error'].isnull(), 'error'] = no_match
+    resolved = fieldmaps['error'].isnull()
+    return fieldmaps.loc[resolved].drop(columns=['fieldmap', 'error']), fieldmaps.loc[~resolved].drop(columns=['fieldmap', 'files'])
+
+
+def update_intentions(df, client, match_shim=False, workers=1):
+    '''
+    Fill in the IntendedFor fields of the fieldmaps in a query table
+
+    The paths are resolved from the table itself, so nothing is read back
+    from flywheel; each fieldmap file takes a single request to update.
+
+    Input:
+        df: the query table
+        client: the flywheel Client class object
+        match_shim: boolean; only match files with the same shim setting as
+            the fieldmap
+        workers: number of requests to have in flight at once
+    '''
+
+    global FAILS
+    intentions, fails = resolve_intentions(df, match_shim)
+    for index, row in fails.iterrows():
+        print("Unable to update intentions for this file:")
+        print(row['name'], row['session.label'], row['info_BIDS_Filename'])
+        print(row['error'])
+        FAILS.append(row)
 
+    def send(row):
         try:
-            acq = client.get(row['acquisition.id'])
-            session = client.get(acq['parents']['session'])
-            acqs_df = []
-            for acquisition in session.acquisitions():
-                temp = process_acquisition(acquisition.id, client, target_cols=['info_SeriesDescription','info_ShimSetting', 'info_BIDS_Folder', 'info_BIDS_Filename', 'type'])
-                temp['session.label'] = row['session.label']
-                temp['subject.label'] = row['subject.label']
-                acqs_df.append(temp)
-
-            acqs_df = pd.concat(acqs_df, ignore_index=True, sort=False)
-            acqs_df = acqs_df.loc[acqs_df.type.str.contains("nifti"),]
-            current_shim = tuple(acqs_df.loc[(acqs_df['info_SeriesDescription'] == row['info_SeriesDescription']) & (acqs_df['acquisition.id'] == row['acquisition.id'])].info_ShimSetting.values[0])
-
-            assert len(current_shim) > 0, "No shim settings for this file"
-
-            acqs_df = acqs_df.loc[~(acqs_df['acquisition.id'] == row['acquisition.id'])]
-            #acqs_df = acqs_df.dropna(subset=['info_ShimSetting'])
-            #acqs_df['info_ShimSetting'] = acqs_df['info_ShimSetting'].map(tuple)
-            #final_files = acqs_df.loc[(acqs_df['info_ShimSetting'] == current_shim)]
-            #final_files = final_files.dropna()
-            intent = [x['Folder'] for x in ast.literal_eval(row['info_BIDS_IntendedFor'])]
-            final_files = acqs_df.loc[acqs_df['info_BIDS_Folder'].isin(intent), ]
-            assert len(final_files) > 0, "No matching files for this shim setting"
-
-            result = final_files.apply(build_intention_path, axis=1)
-            #print("{}: This file has {} matching files".format(row['info_BIDS_Filename'], len(result)))
-            acq.update_file_info(row['name'], {'IntendedFor': list(result.values)})
-            counter.append(pd.DataFrame({'files': result, 'origin': row['info_BIDS_Filename']}))
+            client.modify_acquisition_file_info(
+                row['acquisition.id'], row['name'], {'set': {'IntendedFor': row['files']}})
         except Exception as e:
             print("Unable to update intentions for this file:")
             print(row['name'], row['session.label'], row['info_BIDS_Filename'])
             print(e)
             FAILS.append(row)
+            return None
+        return pd.DataFrame({'files': row['files'], 'origin': row['info_BIDS_Filename']})
+
+    rows = (row for index, row in intentions.iterrows())
+    counter = [x for x in tqdm(ordered_map(send, rows, workers), total=intentions.shape[0]) if x is not None]
 
     cwd = os.getcwd()
 
-    counter = pd.concat(counter, ignore_index=True, sort=False)
-    counter.to_csv("{}/successful_intention_updates.csv".format(cwd), index=False)
+    if counter:
+        counter = pd.concat(counter, ignore_index=True, sort=False)
+        counter.to_csv("{}/successful_intention_updates.csv".format(cwd), index=False)
 
     if len(FAILS) > 0:
         fails_dict = [x.to_dict() for x in FAILS]
         fails_df = pd.DataFrame(fails_dict)
         fails_df.to_csv("{}/failed_to_update_intentions.csv".format(cwd), index=False)
 
-def update_echo_times(df, client):
+def echo_time_updates(acquisition, rows):
+    '''
+    Pair up each row of an acquisition with the file it updates
+
+    Input:
+        acquisition: the flywheel acquisition object
+        rows: the rows of the query table for its files
+    Output:
+        updates: list of (row, file) pairs; file is None if the acquisition
+            has no file of that name
+    '''
+
+    files = {f.name: f for f in acquisition.files}
+    return [(row, files.get(row['name'])) for index, row in rows.iterrows()]
+
+
+def update_echo_times(df, client, workers=1):
+    '''
+    Copy the EchoTime1 and EchoTime2 columns of a query table to flywheel
+
+    Each acquisition is fetched once for all of its files, and the updates
+    are sent through a pool of worker threads; the client's request policy
+    retries those that fail transiently.
+
+    Input:
+        df: the query table
+        client: the flywheel Client class object
+        workers: number of requests to have in flight at once
+    '''
 
     global FAILS
     df = df.dropna(subset=["info_EchoTime1"]).reset_index()
+    failed = []
 
-    counter = []
-    for index, row in tqdm(df.iterrows(), total=df.shape[0]):
+    def report(row, e):
+        print("Unable to update echo times for this file:")
+        print(row['name'], row['session.label'], row['info_BIDS_Filename'])
+        print(e)
+        failed.append(row)
 
+    def fetch(item):
+        acquisition_id, rows = item
         try:
-            acq = client.get(row['acquisition.id'])
-            file_name = row['name']
-            f = [f for f in acq.files if f.name == file_name][0]
-            success = f.update_info({"EchoTime1": row["info_EchoTime1"], "EchoTime2": row["info_EchoTime2"]})
-            if success:
-                counter.append(row)
+            acq = client.get(acquisition_id)
         except Exception as e:
-            print("Unable to update echo times for this file:")
-            print(row['name'], row['session.label'], row['info_BIDS_Filename'])
-            print(e)
-            FAILS.append(row)
+            for index, row in rows.iterrows():
+                report(row, e)
+            return []
+        return echo_time_updates(acq, rows)
+
+    def send(update):
+        row, f = update
+        if f is None:
+            report(row, "No file of this name in the acquisition")
+            return None
+        info = {"EchoTime1": float(row["info_EchoTime1"])}
+        if pd.notnull(row.get("info_EchoTime2")):
+            info["EchoTime2"] = float(row["info_EchoTime2"])
+        try:
+            f.update_info(info)
+        except Exception as e:
+            report(row, e)
+            return None
+        return row
+
+    updates = (
+        update
+        for planned in ordered_map(fetch, df.groupby('acquisition.id', sort=False), workers)
+        for update in planned
+        )
+    counter = [x for x in tqdm(ordered_map(send, updates, workers), total=df.shape[0]) if x is not None]
+    FAILS.extend(failed)
 
     cwd = os.getcwd()
 
-    counter = pd.concat(counter, ignore_index=True, sort=False)
-    counter.to_csv("{}/successful_echotime_updates.csv".format(cwd), index=False)
+    if counter:
+        counter = pd.DataFrame([x.to_dict() for x in counter])
+        counter.to_csv("{}/successful_echotime_updates.csv".format(cwd), index=False)
 
-    if len(FAILS) > 0:
-        fails_dict = [x.to_dict() for x in FAILS]
+    if len(failed) > 0:
+        fails_dict = [x.to_dict() for x in failed]
         fails_df = pd.DataFrame(fails_dict)
         fails_df.to_csv("{}/failed_to_update_echotimes.csv".format(cwd), index=False)
+    print("Updated echo times for {} files; {} failed.".format(len(counter), len(failed)))
 
-def main():
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        fw = flywheel.Client()
-        assert fw, "Your Flywheel CLI credentials aren't set!"
+def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-input",
-        help="Path to the flywheel query CSV",
+        help="Path to the flywheel query table (.csv, .parquet or .feather)",
         dest="df",
         required=True
     )
@@ -122,14 +251,41 @@ def main():
         required=False,
         default=True
     )
+    parser.add_argument(
+        "--match-shim",
+        help="Only point fieldmaps at files with the same shim settings",
+        action="store_true",
+        dest="match_shim"
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of requests to send to flywheel at once",
+        type=int,
+        default=1
+    )
 
+    add_cassette_arguments(parser)
+    add_metrics_arguments(parser)
+    add_policy_arguments(parser)
+    add_client_arguments(parser)
     args = parser.parse_args()
 
-    # original df
-    intentions_df = read_flywheel_csv(args.df, required_cols=['acquisition.id', 'info_BIDS_IntendedFor'])
+    with report_metrics(args, 'autofill-bids'):
+        # original df
+        required_cols = ['acquisition.id', 'info_BIDS_IntendedFor']
+        if args.match_shim:
+            if 'info_ShimSetting' not in read_table_header(args.df):
+                raise ValueError("--match-shim needs the info_ShimSetting column, which {} doesn't have; "
+                                 "query it again with query-bids to include it".format(args.df))
+            required_cols.append('info_ShimSetting')
+        with stage('read'):
+            intentions_df = read_flywheel_csv(args.df, required_cols=required_cols, columns=COLUMNS)
 
-    update_intentions(intentions_df, fw)
-    update_echo_times(intentions_df, fw)
+        fw = client_for(args)
+        with stage('intentions'):
+            update_intentions(intentions_df, fw, args.match_shim, args.workers)
+        with stage('echo_times'):
+            update_echo_times(intentions_df, fw, args.workers)
     print("Done!")
 
 
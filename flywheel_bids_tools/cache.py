@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+
+
+class ContainerCache(object):
+    '''
+    A bounded, thread-safe LRU cache of flywheel containers keyed by ID
+
+    Many acquisitions share the same session and subject, so fetching parent
+    containers through this cache means each of them is only requested from
+    the server once per run. Concurrent lookups of the same ID wait for the
+    first request rather than issuing their own.
+
+    Input:
+        client: the flywheel Client class object
+        maxsize: the maximum number of containers to hold on to
+    '''
+
+    def __init__(self, client, maxsize=1024):
+        self.client = client
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, container_id):
+        return container_id in self._cache
+
+    def get(self, container_id):
+        '''
+        Return the container with this ID, fetching it if it isn't cached
+        '''
+
+        while True:
+            with self._lock:
+                if container_id in self._cache:
+                    self._cache.move_to_end(container_id)
+                    self.hits += 1
+                    return self._cache[container_id]
+                event = self._pending.get(container_id)
+                if event is None:
+                    event = self._pending[container_id] = threading.Event()
+                    self.misses += 1
+                    break
+            # someone else is already fetching it
+            event.wait()
+
+        container = None
+        try:
+            container = self.client.get(container_id)
+        finally:
+            with self._lock:
+                if container is not None:
+                    self._cache[container_id] = container
+                    while len(self._cache) > self.maxsize:
+                        self._cache.popitem(last=False)
+                del self._pending[container_id]
+            event.set()
+        return container
+
+    def label(self, container_id):
+        '''
+        Return the label of the container with this ID
+        '''
+
+        return self.get(container_id).label
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        '''
+        Summarise how well the cache has done
+        '''
+
+        return "{} hits, {} misses, {} cached (max {})".format(
+            self.hits, self.misses, len(self._cache), self.maxsize)
@@ -0,0 +1,287 @@
+import sys
+import gzip
+import json
+import time
+import atexit
+import base64
+import warnings
+import threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+
+CASSETTE_MODES = ['record', 'replay']
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(LookupError):
+    '''
+    A request was made in replay that the cassette has no response for
+    '''
+
+
+class ReplayResponse(object):
+    '''
+    A recorded response, standing in for the SDK's RESTResponse
+    '''
+
+    def __init__(self, interaction):
+        self.status = interaction['status']
+        self.reason = interaction['reason']
+        self.headers = interaction['headers']
+        if interaction.get('base64'):
+            self.data = base64.b64decode(interaction['data'])
+        else:
+            self.data = interaction['data'].encode('utf8')
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+def request_key(method, url, query_params=None, body=None):
+    '''
+    What identifies a request, whatever host it was sent to
+
+    Input:
+        method: the HTTP method
+        url: the full URL requested
+        query_params: list of (name, value) query parameters
+        body: the JSON body, if any
+    Output:
+        key: a string of the method, path, sorted query and body
+    '''
+
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query) + [(k, str(v)) for k, v in (query_params or [])]
+    if isinstance(body, bytes):
+        body = body.decode('utf8')
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+    if body is not None:
+        body = json.dumps(body, sort_keys=True, default=str)
+    return "{} {}?{} {}".format(method.upper(), parts.path, urlencode(sorted(query)), body or '')
+
+
+class Cassette(object):
+    '''
+    Record the SDK's HTTP traffic to a file, or serve it back from one
+
+    A cassette is gzipped JSON lines: a header with the host it was recorded
+    against, then one line for each request and its response. Only the
+    request's method, path, query and body are kept, never its headers, so
+    API keys don't end up in the file.
+
+    In replay, requests are matched to recorded ones by method, path, query
+    and body. Identical requests are served their responses in the order
+    they were recorded, the last of them being reused if the replay asks
+    for more; anything else raises a CassetteMiss.
+
+    Input:
+        fpath: path of the cassette
+        mode: "record" or "replay"
+        latency_scale: in replay, how long to take to respond as a multiple
+            of the recorded time; 0 responds at once
+        host: in record, the host the client talks to
+    '''
+
+    def __init__(self, fpath, mode='replay', latency_scale=1.0, host=None):
+        if mode not in CASSETTE_MODES:
+            raise ValueError("Cassette mode must be one of {}!".format(CASSETTE_MODES))
+        self.fpath = fpath
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.host = host
+        self.interactions = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._responses = defaultdict(deque)
+
+        if mode == 'record':
+            self._file = gzip.open(fpath, 'wt')
+            self._write({'version': CASSETTE_VERSION, 'host': host, 'recorded': time.time()})
+        else:
+            with gzip.open(fpath, 'rt') as f:
+                header = json.loads(next(f))
+                self.host = header.get('host')
+                for line in f:
+                    interaction = json.loads(line)
+                    self._responses[interaction['key']].append(interaction)
+                    self.interactions += 1
+
+    def _write(self, record):
+        self._file.write(json.dumps(record))
+        self._file.write('\n')
+
+    def record(self, key, status, reason, headers, data, elapsed):
+        '''
+        Add a response to the cassette
+        '''
+
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        interaction = {
+            'key': key,
+            'status': status,
+            'reason': reason,
+            'headers': dict(headers or {}),
+            'elapsed': elapsed
+            }
+        try:
+            interaction['data'] = (data or b'').decode('utf8')
+        except UnicodeDecodeError:
+            interaction['data'] = base64.b64encode(data).decode('ascii')
+            interaction['base64'] = True
+        with self._lock:
+            self._write(interaction)
+            self.interactions += 1
+
+    def replay(self, key):
+        '''
+        The recorded response to a request, after the recorded latency
+
+        Output:
+            interaction: dict of the response's status, reason, headers,
+                data and elapsed time
+        '''
+
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise CassetteMiss("No recorded response for {}".format(key))
+            interaction = responses.popleft() if len(responses) > 1 else responses[0]
+        if self.latency_scale:
+            time.sleep(interaction['elapsed'] * self.latency_scale)
+        return interaction
+
+    def close(self):
+        '''
+        Finish writing a recording
+        '''
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def api_exception_class(rest_client):
+    '''
+    The exception the SDK's rest client raises for error responses
+    '''
+
+    module = sys.modules.get(type(rest_client).__module__)
+    flywheel = sys.modules.get('flywheel')
+    return getattr(module, 'ApiException', None) or getattr(flywheel, 'ApiException', Exception)
+
+
+def use_cassette(client, fpath, mode='replay', latency_scale=1.0):
+    '''
+    Record a flywheel client's HTTP traffic to a cassette, or replay it
+
+    Every request the SDK makes goes out through its ApiClient's
+    rest_client.request, so that's where requests are recorded or answered
+    from the cassette. Responses with error statuses are recorded too, and
+    raised again in replay. Streamed downloads aren't recorded.
+
+    Input:
+        client: the flywheel Client class object
+        fpath: path of the cassette
+        mode: "record" or "replay"
+        latency_scale: in replay, the multiple of the recorded latency to
+            respond in
+    Output:
+        cassette: the Cassette now in use; a recording is finished when
+            the program exits
+    '''
+
+    api_client = getattr(client, 'api_client', None)
+    rest_client = getattr(api_client, 'rest_client', None)
+    if rest_client is None:
+        raise ValueError("This client doesn't make requests through a rest client!")
+
+    host = getattr(getattr(api_client, 'configuration', None), 'host', None)
+    cassette = Cassette(fpath, mode, latency_scale, host)
+    request = rest_client.request
+    ApiException = api_exception_class(rest_client)
+
+    def recorded_request(method, url, query_params=None, headers=None, body=None,
+                         post_params=None, _preload_content=True, _request_timeout=None):
+        key = request_key(method, url, query_params, body)
+        if mode == 'replay':
+            interaction = cassette.replay(key)
+            response = ReplayResponse(interaction)
+            if not 200 <= response.status <= 299:
+                raise ApiException(http_resp=response)
+            return response
+
+        start = time.perf_counter()
+        try:
+            response = request(method, url, query_params=query_params, headers=headers, body=body,
+                               post_params=post_params, _preload_content=_preload_content,
+                               _request_timeout=_request_timeout)
+        except ApiException as e:
+            cassette.record(key, e.status, e.reason, getattr(e, 'headers', None),
+                            getattr(e, 'body', None), time.perf_counter() - start)
+            raise
+        if _preload_content:
+            cassette.record(key, response.status, response.reason, response.getheaders(),
+                            response.data, time.perf_counter() - start)
+        return response
+
+    rest_client.request = recorded_request
+    if mode == 'record':
+        atexit.register(cassette.close)
+    return cassette
+
+
+def replay_client(fpath):
+    '''
+    A flywheel client for replaying a cassette, which needs no credentials
+
+    Input:
+        fpath: path of the cassette
+    Output:
+        client: the flywheel Client class object, pointed at the host the
+            cassette was recorded against
+    '''
+
+    import flywheel
+    with gzip.open(fpath, 'rt') as f:
+        header = json.loads(next(f))
+    host = urlsplit(header.get('host') or 'https://replay.invalid/api').netloc
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return flywheel.Client('{}:replay'.format(host), skip_version_check=True)
+
+
+def add_cassette_arguments(parser):
+    '''
+    Add the options for recording and replaying to a tool's parser
+    '''
+
+    parser.add_argument(
+        "--cassette",
+        help="Path of a cassette to record flywheel's responses to, or to replay them from",
+        default=None
+    )
+    parser.add_argument(
+        "--cassette-mode",
+        help="Record flywheel's responses to the cassette or replay them from it",
+        choices=CASSETTE_MODES,
+        default='record',
+        dest="cassette_mode"
+    )
+    parser.add_argument(
+        "--cassette-latency",
+        help="In replay, how long to take to respond as a multiple of the recorded time",
+        type=float,
+        default=1.0,
+        dest="cassette_latency"
+    )
+
@@ -0,0 +1,184 @@
+import threading
+import warnings
+from flywheel_bids_tools.cassette import use_cassette, replay_client
+from flywheel_bids_tools.instrument import instrument
+from flywheel_bids_tools.ratelimit import request_policy
+
+
+# connections kept open to the server, unless there are more workers than this
+DEFAULT_POOL_SIZE = 10
+
+_lock = threading.Lock()
+_client = None
+_set_up = False
+_settings = {'api_key': None, 'pool_size': DEFAULT_POOL_SIZE, 'keep_alive': True}
+
+
+def configure(**settings):
+    '''
+    Choose how the process-wide client will be made
+
+    Input:
+        api_key: the key to log in with; the flywheel CLI's login if None
+        pool_size: how many connections to keep open to the server
+        keep_alive: whether to keep connections open between requests
+    '''
+
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise ValueError("Unknown client settings: {}".format(sorted(unknown)))
+    with _lock:
+        _settings.update(settings)
+
+
+def pool_connections(client, pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+    '''
+    Size a flywheel client's pool of HTTP connections
+
+    Depending on its version, the SDK sends requests through a requests
+    Session or a urllib3 PoolManager; either way, workers beyond the size of
+    the pool have their connections thrown away after each request and pay
+    for a new TLS handshake on the next one.
+
+    Input:
+        client: the flywheel Client class object
+        pool_size: how many connections to keep open to the server
+        keep_alive: whether to keep connections open between requests
+    '''
+
+    api_client = getattr(client, 'api_client', None)
+    rest_client = getattr(api_client, 'rest_client', None)
+    if rest_client is None:
+        return
+
+    session = getattr(rest_client, 'session', None)
+    if hasattr(session, 'mount'):
+        from requests.adapters import HTTPAdapter
+        retries = getattr(session.get_adapter('https://'), 'max_retries', 0)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    pool_manager = getattr(rest_client, 'pool_manager', None)
+    if hasattr(pool_manager, 'connection_pool_kw'):
+        pool_manager.connection_pool_kw['maxsize'] = pool_size
+        pool_manager.clear()
+
+    if hasattr(api_client, 'set_default_header'):
+        api_client.set_default_header('Connection', 'keep-alive' if keep_alive else 'close')
+
+
+def create_client(api_key=None, pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+    '''
+    Log in to flywheel
+
+    The SDK is only imported here, so tools that never reach the network
+    don't wait for it to load.
+
+    Output:
+        client: the flywheel Client class object, with its connections pooled
+    '''
+
+    import flywheel
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        client = flywheel.Client(api_key) if api_key else flywheel.Client()
+    assert client, "Your Flywheel CLI credentials aren't set!"
+    pool_connections(client, pool_size, keep_alive)
+    return client
+
+
+def get_client():
+    '''
+    The client shared by the whole process, logging in the first time
+
+    Output:
+        client: the flywheel Client class object
+    '''
+
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = create_client(**_settings)
+    return _client
+
+
+def set_client(client):
+    '''
+    Share a ready-made client instead of logging in
+    '''
+
+    global _client
+    with _lock:
+        _client = client
+
+
+def reset_client():
+    '''
+    Forget the shared client, so the next one is made afresh
+    '''
+
+    global _client, _set_up
+    with _lock:
+        _client = None
+        _set_up = False
+
+
+def add_client_arguments(parser):
+    '''
+    Add the options for the connections to flywheel to a tool's parser
+    '''
+
+    parser.add_argument(
+        "--pool-size",
+        help="How many connections to flywheel to keep open; at least as many as --workers by default",
+        type=int,
+        default=None,
+        dest="pool_size"
+    )
+    parser.add_argument(
+        "--no-keep-alive",
+        help="Close the connection to flywheel after each request",
+        action="store_false",
+        dest="keep_alive"
+    )
+
+
+def client_for(args):
+    '''
+    The shared client, set up with a tool's options
+
+    The first time, the client is made (or replayed from a cassette),
+    recorded to a cassette if asked, instrumented, and given a request
+    policy; later calls in the same process get the same client back.
+
+    Input:
+        args: the tool's parsed options; any of those from
+            add_client_arguments, add_cassette_arguments and
+            add_policy_arguments, and --workers, are used if present
+    Output:
+        client: the flywheel Client class object
+    '''
+
+    global _set_up
+    if _set_up:
+        return get_client()
+
+    workers = getattr(args, 'workers', None) or 1
+    cassette = getattr(args, 'cassette', None)
+    mode = getattr(args, 'cassette_mode', 'record')
+    if cassette and mode == 'replay':
+        set_client(replay_client(cassette))
+    else:
+        configure(pool_size=getattr(args, 'pool_size', None) or max(DEFAULT_POOL_SIZE, workers),
+                  keep_alive=getattr(args, 'keep_alive', True))
+    client = get_client()
+
+    if cassette:
+        use_cassette(client, cassette, mode, getattr(args, 'cassette_latency', 1.0))
+    instrument(client)
+    request_policy(client, getattr(args, 'max_rate', None), concurrency=workers,
+                   retries=getattr(args, 'retries', 5))
+    _set_up = True
+    return client
@@ -1,10 +1,11 @@
-import flywheel
+from flywheel_bids_tools.client import get_client
 
 class SeqInfo(object):
 
     def __init__(self, session_id):
         self.id = session_id
-        self.fw = flywheel.Client()
+        # every session shares one logged-in client and its connections
+        self.fw = get_client()
         self.protocols = self.generate_sequences()
 
     def __len__(self):
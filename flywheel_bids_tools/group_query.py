@@ -1,29 +1,7 @@
-import pandas as pd
 import argparse
-from flywheel_bids_tools.utils import unlist_item
+from flywheel_bids_tools.utils import read_flywheel_csv, write_table, group_table, read_schema, write_schema, table_format
 
-
-def read_flywheel_csv(fpath, required_cols=['acquisition.id']):
-    '''
-    Read in a CSV and also ensure it's one of ours
-
-    Input:
-        fpath: path to the file
-        required_cols: list of columns to ensure csv is a flywheel query
-    Output:
-        df: a pandas dataframe
-    '''
-
-    df = pd.read_csv(fpath)
-
-    if not all(elem in df.columns.tolist() for elem in required_cols):
-        raise Exception(("It doesn't look like this csv is correctly formatted",
-        " for this flywheel editing process!"))
-    #drop_downs = ['classification_Measurement', 'classification_Intent',
-        #'classification_Features']
-    #df.loc[:, drop_downs] = df.loc[:, drop_downs].applymap(unlist_item)
-    df = df.sort_values(by=["acquisition.id", "acquisition.label"])
-    return(df)
+SORT_BY = ["acquisition.id", "acquisition.label"]
 
 
 def main():
@@ -37,7 +15,7 @@ def main():
     )
     parser.add_argument(
         "-output", "--grouped-output",
-        help="The path and name of a grouped version of the output CSV of the query",
+        help="The path and name of a grouped version of the output table of the query",
         dest="group_output",
         required=True
     )
@@ -51,26 +29,16 @@ def main():
     args = parser.parse_args()
 
     # read in the file
-    query_result = read_flywheel_csv(args.infile)
-
-    # add a group index
-    query_result['group_id'] = float('nan')
-    # group the file and store separate groups
-    grouped_df = query_result.groupby(args.group).groups
-
-    # loop over groups and assign the index
-    id = 1
-    for name, df in grouped_df.items():
-
-        index = df.to_list()
-        query_result.loc[index, 'group_id'] = id
-        id += 1
-
-    # finally, drop duplicates
-    query_result = query_result.drop_duplicates(args.group)
-    query_result['groups'] = unlist_item(args.group)
-    query_result = query_result.sort_values(by=["acquisition.id", "acquisition.label"])
-    query_result.to_csv(args.group_output, index=False)
+    query_result = read_flywheel_csv(args.infile, sort_by=SORT_BY, ascending=True)
+
+    # number the groups and keep one row of each
+    query_result = group_table(query_result, args.group)
+    write_table(query_result, args.group_output)
+    # the grouped table has the same columns as the query, plus the groups
+    schema = read_schema(args.infile)
+    if schema is not None and table_format(args.group_output) == 'csv':
+        schema.update({'group_id': 'float', 'groups': 'str'})
+        write_schema(args.group_output, schema)
     print("Done")
 
 
@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+
+
+# upper bounds of the latency histogram's buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats(object):
+    '''
+    What the calls to one endpoint have added up to
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = Counter()
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+
+    def to_dict(self):
+        cumulative, total = {}, 0
+        for bound, n in zip([str(x) for x in self.buckets] + ['+Inf'], self.bucket_counts):
+            total += n
+            cumulative[bound] = total
+        return {
+            'count': self.count,
+            'errors': sum(self.errors.values()),
+            'errors_by_status': dict(self.errors),
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'mean_seconds': self.seconds / self.count if self.count else None,
+            'max_seconds': self.max_seconds,
+            'latency_buckets': cumulative
+        }
+
+
+class Metrics(object):
+    '''
+    Thread-safe counts of flywheel calls and timings of a tool's stages
+
+    Calls are counted per endpoint, as the method and the SDK's resource path
+    template (e.g. "GET /acquisitions/{AcquisitionId}"), with a histogram of
+    their latency, the bytes of their responses and their errors by status.
+    A stage's time is added up over every thread that runs it, so stages run
+    by several workers at once can take longer than the run itself.
+
+    Input:
+        buckets: upper bounds of the latency histogram's buckets, in seconds
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget everything recorded so far
+        '''
+
+        with self._lock:
+            self.endpoints = defaultdict(lambda: EndpointStats(self.buckets))
+            self.stages = defaultdict(lambda: {'count': 0, 'seconds': 0.0})
+            self.started = time.time()
+
+    def observe_call(self, endpoint, seconds, error=None):
+        '''
+        Record a call to an endpoint, and its error if it failed
+        '''
+
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.bucket_counts[bisect_left(self.buckets, seconds)] += 1
+            if error is not None:
+                stats.errors[str(getattr(error, 'status', None) or type(error).__name__)] += 1
+
+    def add_bytes(self, endpoint, n):
+        with self._lock:
+            self.endpoints[endpoint].bytes += n
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name]['count'] += 1
+            self.stages[name]['seconds'] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Time a block of code as part of a stage
+        '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def summary(self, tool=None):
+        '''
+        Everything recorded so far
+
+        Output:
+            summary: dict of the tool, wall time, totals, per-endpoint stats
+                and per-stage timings, ready to be written as JSON
+        '''
+
+        with self._lock:
+            endpoints = {k: v.to_dict() for k, v in sorted(self.endpoints.items())}
+            stages = {k: dict(v) for k, v in sorted(self.stages.items())}
+        return {
+            'tool': tool,
+            'wall_seconds': time.time() - self.started,
+            'calls': sum(x['count'] for x in endpoints.values()),
+            'errors': sum(x['errors'] for x in endpoints.values()),
+            'bytes': sum(x['bytes'] for x in endpoints.values()),
+            'endpoints': endpoints,
+            'stages': stages
+        }
+
+
+# the metrics every module records to
+METRICS = Metrics()
+
+
+def stage(name):
+    '''
+    Time a block of code as part of a stage of the current run
+    '''
+
+    return METRICS.stage(name)
+
+
+def instrument(client, metrics=METRICS):
+    '''
+    Record every request a flywheel client makes
+
+    Every request the SDK makes goes through the client's ApiClient.call_api,
+    which is given the endpoint's resource path, so calls are timed and
+    counted there. Where the ApiClient sends requests through a rest client,
+    the size of each response is taken from there too. Instrumenting a
+    client twice has no further effect.
+
+    Input:
+        client: the flywheel Client class object
+        metrics: the Metrics to record to
+    Output:
+        metrics: the Metrics being recorded to
+    '''
+
+    api_client = getattr(client, 'api_client', None)
+    if api_client is None:
+        raise ValueError("This client doesn't make requests through an ApiClient!")
+    if getattr(api_client, '_instrumented', None) is metrics:
+        return metrics
+
+    current = threading.local()
+    call_api = api_client.call_api
+
+    def instrumented_call_api(resource_path, method, *args, **kwargs):
+        endpoint = "{} {}".format(method, resource_path)
+        current.endpoint = endpoint
+        start = time.perf_counter()
+        try:
+            result = call_api(resource_path, method, *args, **kwargs)
+        except Exception as e:
+            metrics.observe_call(endpoint, time.perf_counter() - start, e)
+            raise
+        finally:
+            current.endpoint = None
+        metrics.observe_call(endpoint, time.perf_counter() - start)
+        return result
+
+    api_client.call_api = instrumented_call_api
+
+    rest_client = getattr(api_client, 'rest_client', None)
+    if rest_client is not None:
+        request = rest_client.request
+
+        def measured_request(*args, **kwargs):
+            response = request(*args, **kwargs)
+            data = getattr(response, 'data', None)
+            endpoint = getattr(current, 'endpoint', None)
+            if endpoint is not None and isinstance(data, (bytes, str)):
+                metrics.add_bytes(endpoint, len(data))
+            return response
+
+        rest_client.request = measured_request
+
+    api_client._instrumented = metrics
+    return metrics
+
+
+def prometheus_text(summary):
+    '''
+    Write a summary out in the Prometheus text exposition format
+
+    Output:
+        text: the metrics, labelled with the tool and endpoint or stage
+    '''
+
+    def labels(**kwargs):
+        escaped = [
+            '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+            for k, v in kwargs.items()
+            ]
+        return '{' + ','.join(escaped) + '}'
+
+    tool = summary['tool'] or ''
+    endpoints = summary['endpoints']
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(samples)
+
+    metric('flywheel_api_requests_total', 'counter', 'Flywheel API calls made.', [
+        'flywheel_api_requests_total{} {}'.format(labels(tool=tool, endpoint=k), v['count'])
+        for k, v in endpoints.items()
+        ])
+    metric('flywheel_api_errors_total', 'counter', 'Flywheel API calls that failed.', [
+        'flywheel_api_errors_total{} {}'.format(labels(tool=tool, endpoint=k, status=status), n)
+        for k, v in endpoints.items() for status, n in sorted(v['errors_by_status'].items())
+        ])
+    metric('flywheel_api_response_bytes_total', 'counter', 'Bytes received from the Flywheel API.', [
+        'flywheel_api_response_bytes_total{} {}'.format(labels(tool=tool, endpoint=k), v['bytes'])
+        for k, v in endpoints.items()
+        ])
+    samples = []
+    for k, v in endpoints.items():
+        for bound, n in v['latency_buckets'].items():
+            samples.append('flywheel_api_request_duration_seconds_bucket{} {}'.format(labels(tool=tool, endpoint=k, le=bound), n))
+        samples.append('flywheel_api_request_duration_seconds_sum{} {}'.format(labels(tool=tool, endpoint=k), v['seconds']))
+        samples.append('flywheel_api_request_duration_seconds_count{} {}'.format(labels(tool=tool, endpoint=k), v['count']))
+    metric('flywheel_api_request_duration_seconds', 'histogram', 'Latency of Flywheel API calls.', samples)
+    metric('flywheel_bids_tools_stage_seconds_total', 'counter', 'Time spent in each stage, over all threads.', [
+        'flywheel_bids_tools_stage_seconds_total{} {}'.format(labels(tool=tool, stage=k), v['seconds'])
+        for k, v in summary['stages'].items()
+        ])
+    metric('flywheel_bids_tools_run_seconds', 'gauge', 'Wall time of the run.', [
+        'flywheel_bids_tools_run_seconds{} {}'.format(labels(tool=tool), summary['wall_seconds'])
+        ])
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(fpath, text):
+    '''
+    Write a file so that readers never see it half written
+    '''
+
+    tmp = '{}.tmp'.format(fpath)
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, fpath)
+
+
+def add_metrics_arguments(parser):
+    '''
+    Add the options for where to write a run's metrics to a tool's parser
+    '''
+
+    parser.add_argument(
+        "--metrics",
+        help="Path to write a JSON summary of the run's flywheel calls and stage timings to",
+        default=None
+    )
+    parser.add_argument(
+        "--prometheus",
+        help="Path of a Prometheus textfile to write the run's metrics to",
+        default=None
+    )
+
+
+@contextmanager
+def report_metrics(args, tool, metrics=METRICS):
+    '''
+    Record a run's metrics, and write them out when it ends, however it ends
+
+    Input:
+        args: the tool's parsed options, from add_metrics_arguments
+        tool: the name of the tool
+        metrics: the Metrics to record to
+    '''
+
+    metrics.reset()
+    try:
+        yield metrics
+    finally:
+        summary = metrics.summary(tool)
+        if args.metrics:
+            write_atomically(args.metrics, json.dumps(summary, indent=2))
+        if args.prometheus:
+            write_atomically(args.prometheus, prometheus_text(summary))
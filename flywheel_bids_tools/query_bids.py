@@ -1,20 +1,77 @@
-import flywheel
 import pandas as pd
 import sys
+import os
+import csv
+import pickle
+import time
+import tempfile
 import argparse
+from itertools import chain, groupby
+from collections import Counter, defaultdict
+from operator import itemgetter
 from tqdm import tqdm
 import re
 from pandas.io.json.normalize import nested_to_record
 from pandas.api.types import is_list_like
 import warnings
-from flywheel_bids_tools.utils import unlist_item, is_list_column
+from flywheel_bids_tools.utils import unlist_item, is_list_column, ordered_map, table_format, read_table, write_table, column_kind, read_schema, write_schema, read_started, read_table_header
+from flywheel_bids_tools.cache import ContainerCache
+from flywheel_bids_tools.ratelimit import add_policy_arguments
+from flywheel_bids_tools.cassette import add_cassette_arguments
+from flywheel_bids_tools.instrument import stage, add_metrics_arguments, report_metrics
+from flywheel_bids_tools.client import add_client_arguments, client_for
 
 UNCLASSIFIED = 0
 NO_DATA = 0
 VERBOSE = True
 
+# how to turn the text of a CSV cell back into a value of each schema kind
+SCHEMA_PARSERS = {
+    'str': str,
+    # whole numbers in a float column were written from ints
+    'float': lambda x: int(x) if x.lstrip('-').isdigit() else float(x),
+    'int': int,
+    'bool': lambda x: x == 'True'
+}
 
-def query_fw(client, project, subject=None, session=None):
+
+def hydrate_acquisition(acquisition, session):
+    '''
+    Build an acquisition record from a session-level listing
+
+    The acquisitions listed under a session already carry their files, and the
+    session knows its own and its subject's labels, so this record can be
+    processed without going back to the server for the acquisition or its
+    parents.
+
+    Parameters
+    --------
+    acquisition
+        A flywheel acquisition object listed from the session
+    session
+        The flywheel session object it was listed from
+
+    Returns
+    --------
+    record
+        A dict of the acquisition's identifying columns and its files
+    '''
+
+    return {
+        'acquisition.id': acquisition.id,
+        'acquisition.label': acquisition.label,
+        'session.id': session.id,
+        'session.label': session.label,
+        'subject.id': session.subject.id,
+        'subject.label': session.subject.label,
+        'timestamp': acquisition.timestamp,
+        'acquisition.modified': acquisition.modified,
+        'files': acquisition.files
+    }
+
+
+def query_fw(client, project, subject=None, session=None, hydrate=False,
+             workers=1):
     """Query the flywheel client for a project name
     This function uses the flywheel API to find the first match of a project
     name. The name must be exact so make sure to type it as is on the
@@ -26,9 +83,15 @@ def query_fw(client, project, subject=None, session=None):
     project
         The name of the project to search for.
     subject
-        Subject ID
+        Subject label, or a list of them; any the project doesn't have are
+        skipped with a warning
     session
-        Session ID
+        Session label, or a list of them; likewise
+    hydrate
+        Return acquisition records with their files and parent labels
+        already filled in from the session listing (see hydrate_acquisition)
+    workers
+        Number of sessions to list acquisitions for concurrently
 
     Returns
     ---------
@@ -51,20 +114,360 @@ def query_fw(client, project, subject=None, session=None):
             print('%s' % (p.label))
         raise ValueError("Could not find \"{0}\" project on Flywheel!".format(project))
 
+    if isinstance(subject, str):
+        subject = [subject]
+    if isinstance(session, str):
+        session = [session]
+
+    # with several projects, a label is usually only in one of them
     if subject is not None:
-        subject = project_object.subjects.find_one('code="{}"'.format(subject))
-        sessions = subject.sessions()
+        subjects = []
+        for x in subject:
+            found = project_object.subjects.find_first('code="{}"'.format(x))
+            if found is None:
+                print("Warning: no subject {} in project {}; skipping it".format(x, project))
+            else:
+                subjects.append(found)
+        sessions = [s for x in subjects for s in x.sessions()]
+        if session is not None:
+            sessions = [s for s in sessions if s.label in session]
     elif session is not None:
-        sessions = project_object.sessions.find('label="{}"'.format(session))
+        sessions = []
+        for x in session:
+            found = project_object.sessions.find('label="{}"'.format(x))
+            if not found:
+                print("Warning: no session {} in project {}; skipping it".format(x, project))
+            sessions.extend(found)
     else:
         sessions = project_object.sessions()
 
-    acquisitions = [acq for s in sessions for acq in s.acquisitions()]
+    listings = ordered_map(lambda s: (s, s.acquisitions()), sessions, workers)
+    if hydrate:
+        acquisitions = [hydrate_acquisition(acq, s) for s, acqs in listings for acq in acqs]
+    else:
+        acquisitions = [acq for s, acqs in listings for acq in acqs]
 
     return(acquisitions)
 
 
-def process_query(client, acquisitions, target_cols=None):
+def fetch_acquisition_files(client, x, cache=None):
+    '''
+    Fetch the files of a single acquisition
+
+    This function gets the full acquisition object from flywheel along with
+    the labels of its session and subject, and stamps these onto each of the
+    acquisition's file dicts. It is safe to call from several threads at once.
+
+    Hydrated records from query_fw are used as they are; the acquisition is
+    only fetched again if the listing left out the info of any of its files.
+
+    Parameters
+    --------
+    client
+        A flywheel connection object
+    x
+        A flywheel acquisition object, or a record from hydrate_acquisition
+    cache
+        A ContainerCache to look up the session and subject labels in
+
+    Returns
+    --------
+    files
+        A list of file dicts, or None if the acquisition could not be fetched
+    '''
+
+    if cache is None:
+        cache = ContainerCache(client)
+    try:
+        if isinstance(x, dict):
+            d = {k: v for k, v in x.items() if k != 'files'}
+            files = x['files']
+            if any(getattr(f, 'info_exists', False) and not getattr(f, 'info', None) for f in files):
+                files = client.get(x['acquisition.id']).files
+            files = [f.to_dict() for f in files]
+            for f in files:
+                f.update(d)
+            return files
+
+        tempacq = client.get(x.id)
+        if tempacq is None:
+            raise Exception
+
+        d = {
+            'acquisition.id': x.id,
+            'acquisition.label': x.label,
+            'session.id': x.session,
+            'session.label': cache.label(x.parents.session),
+            'subject.id': x.parents.subject,
+            'subject.label': cache.label(x.parents.subject),
+            'timestamp': x.timestamp
+        }
+
+        files = tempacq.files
+        files = [f.to_dict() for f in files]
+        for f in files:
+
+            f.update(d)
+
+    except Exception as e:
+        print(e)
+        return None
+    return files
+
+
+def column_pattern(target_cols=None):
+    '''
+    Build the regular expression that picks out the columns to keep
+
+    Parameters
+    --------
+    target_cols
+        List of specific columns to return; the default set is used if empty
+
+    Returns
+    --------
+    pattern
+        A regular expression string to search column names with
+    '''
+
+    if not target_cols:
+        return r'(\.label)|(\.id)|(classification)|(^type$)|(^modality$)|(BIDS)|(EchoTime)|(RepetitionTime)|(PhaseEncodingDirection)|(SequenceName)|(SeriesDescription)|(ShimSetting)|(name)'
+
+    required_cols = ['\.id', '\.label', 'name']
+    return "|".join(["({})".format(x) for x in list(target_cols) + required_cols])
+
+
+class ColumnFilter(object):
+    '''
+    Pick out the columns to keep from flattened file records
+
+    Projects only have a few hundred distinct column names between them, so
+    the pattern is compiled once and the keep/drop decision for each column
+    name is remembered instead of being searched for again on every record.
+
+    Parameters
+    --------
+    target_cols
+        List of specific columns to return; the default set is used if empty
+    '''
+
+    def __init__(self, target_cols=None):
+        self.pattern = re.compile(column_pattern(target_cols))
+        self._decisions = {}
+
+    def keep(self, key):
+        '''
+        Whether a column with this name should be kept
+        '''
+
+        try:
+            return self._decisions[key]
+        except KeyError:
+            decision = self._decisions[key] = self.pattern.search(key) is not None
+            return decision
+
+    def __call__(self, record):
+        '''
+        Return a copy of the record with only the kept columns
+        '''
+
+        decisions = self._decisions
+        keep = self.keep
+        return {
+            k: v for k, v in record.items()
+            if (decisions[k] if k in decisions else keep(k))
+            }
+
+
+def acquisition_id(x):
+    '''
+    The ID of an acquisition object or of a record from hydrate_acquisition
+    '''
+
+    return x['acquisition.id'] if isinstance(x, dict) else x.id
+
+
+def parse_since(since):
+    '''
+    Work out the cutoff time for an incremental query
+
+    Parameters
+    --------
+    since
+        Either the path to the output of a previous query, whose sidecar
+        records when that query started, or a timestamp that is taken to be
+        in UTC unless it says otherwise
+
+    Returns
+    --------
+    cutoff, prior
+        The cutoff time, and the path to the previous output (or None)
+    '''
+
+    if os.path.isfile(since):
+        # the file's own modification time moves if it is copied or saved
+        # again, so only a start time recorded by query-bids will do
+        started = read_started(since)
+        if started is None:
+            raise ValueError("{} has no record of when its query started; "
+                             "give --since a timestamp instead".format(since))
+        return pd.Timestamp(started, unit='s', tz='UTC'), since
+
+    cutoff = pd.Timestamp(since)
+    if cutoff.tzinfo is None:
+        cutoff = cutoff.tz_localize('UTC')
+    return cutoff, None
+
+
+def modified_since(x, cutoff):
+    '''
+    Whether an acquisition has changed after the cutoff; acquisitions that
+    don't say when they were modified are assumed to have changed
+    '''
+
+    modified = x.get('acquisition.modified') if isinstance(x, dict) else getattr(x, 'modified', None)
+    if modified is None:
+        return True
+    return pd.Timestamp(modified) > cutoff
+
+
+def read_prior_chunks(prior, keep):
+    '''
+    Read the rows of a previous query back in, an acquisition at a time
+
+    Parameters
+    --------
+    prior
+        Path to the table written by a previous query
+    keep
+        The IDs of the acquisitions whose rows should be carried over
+
+    Yields
+    --------
+    acquisition_id, records
+        In the same form as iter_query_records, with blank cells left out
+        unless their column is text. Values in a CSV are read back in by the
+        kinds in its schema; without one they are kept as the text they
+        were written as
+    '''
+
+    if table_format(prior) != 'csv':
+        df = read_table(prior)
+        df = df.loc[df['acquisition.id'].isin(keep)]
+        for acq, group in df.groupby('acquisition.id', sort=False):
+            yield acq, [
+                {k: v for k, v in row.items() if not (v is None or v != v)}
+                for row in group.to_dict('records')
+                ]
+        return
+
+    # every cell is read as text, and only converted if the schema says what
+    # it was written from; guessing would turn labels like 0001 into numbers
+    parsers = {k: SCHEMA_PARSERS[v] for k, v in (read_schema(prior) or {}).items()}
+
+    def parse(column, value):
+        try:
+            return parsers[column](value) if column in parsers else value
+        except ValueError:
+            return value
+
+    with open(prior, newline='') as f:
+        rows = csv.DictReader(f)
+        for acq, group in groupby(rows, key=itemgetter('acquisition.id')):
+            if acq in keep:
+                # blank text cells were empty strings, which still make the column text
+                yield acq, [
+                    {k: parse(k, v) for k, v in row.items() if v != '' or parsers.get(k) is str}
+                    for row in group
+                    ]
+
+
+def prior_columns(prior):
+    '''
+    The columns of a previous query, which a merged output has to keep even
+    where none of the rows carried over have a value in them
+
+    Parameters
+    --------
+    prior
+        Path to the table written by a previous query
+
+    Returns
+    --------
+    columns, untyped
+        All of its columns, and those of a CSV whose values are carried over
+        as text because its schema doesn't cover them
+    '''
+
+    columns = read_table_header(prior)
+    if table_format(prior) != 'csv':
+        return columns, []
+    schema = read_schema(prior) or {}
+    return columns, [x for x in columns if x not in schema]
+
+
+def iter_query_records(client, acquisitions, target_cols=None, workers=1,
+                       cache=None):
+    '''
+    Process acquisitions one at a time
+
+    This function fetches each acquisition, flattens its files and keeps
+    only the columns of interest, handing back the results for one
+    acquisition at a time so that the whole project never has to be held in
+    memory. Acquisitions that can't be fetched are counted in NO_DATA.
+
+    Parameters
+    --------
+    client
+        A flywheel connection object
+    acquisitions
+        A list of flywheel acquisition objects
+    target_cols
+        List of specific columns to return
+    workers
+        Number of acquisitions to fetch from flywheel concurrently
+    cache
+        A ContainerCache shared with other queries; one is made if not given
+
+    Yields
+    --------
+    acquisition_id, records
+        The acquisition's ID and a list of flattened file dicts
+    '''
+
+    global NO_DATA
+    if cache is None:
+        cache = ContainerCache(client)
+
+    select = ColumnFilter(target_cols)
+    # only filter on file type if the type column is being kept
+    filter_type = select.keep('type')
+
+    def fetch(x):
+        with stage('fetch'):
+            return fetch_acquisition_files(client, x, cache)
+
+    fetched = ordered_map(fetch, acquisitions, workers)
+    for x, files in tqdm(zip(acquisitions, fetched), total=len(acquisitions)):
+        if files is None:
+            NO_DATA += 1
+            continue
+
+        with stage('flatten'):
+            flat = [nested_to_record(fdict, sep="_") for fdict in files]
+        with stage('filter'):
+            records = [select(record) for record in flat]
+            if filter_type:
+                records = [r for r in records if re.search(r'nifti|dicom', str(r.get('type', '')))]
+
+        yield acquisition_id(x), records
+
+    if VERBOSE:
+        print("Parent label cache: {}".format(cache.info()))
+
+
+def process_query(client, acquisitions, target_cols=None, workers=1,
+                  cache=None):
     '''
     Extract an acquisition
 
@@ -80,6 +483,10 @@ def process_query(client, acquisitions, target_cols=None):
         A list of flywheel acquisition objects
     target_cols
         List of specific columns to return
+    workers
+        Number of acquisitions to fetch from flywheel concurrently
+    cache
+        A ContainerCache shared with other queries; one is made if not given
 
     Returns
     --------
@@ -87,88 +494,202 @@ def process_query(client, acquisitions, target_cols=None):
         A dataframe of the result of the query and processing
     '''
 
-    acquisitions_list = []
-    for x in tqdm(acquisitions, total=len(acquisitions)):
+    files_list = [
+        record
+        for _, records in iter_query_records(client, acquisitions, target_cols, workers, cache)
+        for record in records
+        ]
+
+    if VERBOSE:
+        print("Tidying and returning the results...")
+    return_df = pd.DataFrame(files_list)
+    #drop_downs = return_df.apply(is_list_column, 0, reduce=None).values
+    #return_df.loc[:, drop_downs] = return_df.loc[:, drop_downs].applymap(unlist_item)
+    return(return_df)
+
+
+def sort_key(record):
+    '''
+    The key query results are sorted on; missing values sort last when the
+    rows are sorted in descending order, as they do in pandas
+    '''
+
+    key = []
+    for col in ['acquisition.id', 'acquisition.label', 'name']:
+        value = record.get(col)
+        key.append((0, '') if value is None else (1, value))
+    return tuple(key)
+
+
+def read_checkpoint(spill):
+    '''
+    Read back the acquisitions saved in a checkpoint file
+
+    If the run that wrote the checkpoint died part way through saving an
+    acquisition, the incomplete entry is cut off the end of the file.
+
+    Parameters
+    --------
+    spill
+        An open checkpoint file, positioned at the start
+
+    Yields
+    --------
+    offset, acquisition_id, records
+        Where the acquisition is saved in the file, its ID and its records
+    '''
+
+    while True:
+        offset = spill.tell()
         try:
-            tempacq = client.get(x.id)
-            if tempacq is None:
-                raise Exception
-
-            d = {
-                'acquisition.id': x.id,
-                'acquisition.label': x.label,
-                'session.id': x.session,
-                'session.label': client.get(x.parents.session).label,
-                'subject.id': x.parents.subject,
-                'subject.label': client.get(x.parents.subject).label,
-                'timestamp': x.timestamp
-            }
+            acquisition_id, records = pickle.load(spill)
+        except EOFError:
+            return
+        except Exception:
+            spill.seek(offset)
+            spill.truncate()
+            return
+        yield offset, acquisition_id, records
 
-            files = tempacq.files
-            files = [f.to_dict() for f in files]
-            for f in files:
 
-                f.update(d)
+def completed_acquisitions(checkpoint):
+    '''
+    The IDs of the acquisitions already saved in a checkpoint file
+    '''
 
-        except Exception as e:
-            print(e)
-            global NO_DATA
-            NO_DATA += 1
-            continue
-        acquisitions_list.extend(files)
+    if not os.path.isfile(checkpoint):
+        return set()
+    with open(checkpoint, 'r+b') as spill:
+        return set(acquisition_id for _, acquisition_id, _ in read_checkpoint(spill))
 
-    files_list = [nested_to_record(fdict, sep="_") for fdict in acquisitions_list]
 
-    global VERBOSE
-    if VERBOSE:
-        print("Tidying and returning the results...")
-    # filter columns if necessary
-    if not target_cols:
-        cols = r'(\.label)|(\.id)|(classification)|(^type$)|(^modality$)|(BIDS)|(EchoTime)|(RepetitionTime)|(PhaseEncodingDirection)|(SequenceName)|(SeriesDescription)|(name)'
-
-        # filter the dict keys for the columns names
-        files_list = [
-            {k: v for k, v in my_dict.items() if re.search(cols, k)}
-            for my_dict in files_list
-            ]
-        return_df = pd.DataFrame(files_list)
-    else:
-        required_cols = ['\.id', '\.label', 'name']
+def write_query_csv(chunks, output, checkpoint=None, columns=(), untyped=(),
+                    started=None):
+    '''
+    Stream processed acquisitions out to a CSV
 
-        target_cols.extend(required_cols)
-        target_cols = "|".join(["({})".format(x) for x in target_cols])
+    The first pass spills each acquisition's records to a temporary file next
+    to the output while collecting the column names and a small sort index.
+    The second pass writes the records back out in sorted order under the
+    full set of sorted columns, so only one acquisition's records are ever in
+    memory at once. Parquet and feather outputs can't be appended to, so for
+    those the second pass collects the sorted records into one dataframe.
 
-        files_list = [
-            {k: v for k, v in my_dict.items() if re.search(target_cols, k)}
-            for my_dict in files_list
-            ]
-        return_df = pd.DataFrame(files_list)
+    If a checkpoint path is given, the spill file is kept there instead and
+    anything already in it is written out along with the new acquisitions.
+    It is only removed once the CSV has been written, so a run that dies can
+    be picked up again from where it stopped.
 
-    #drop_downs = return_df.apply(is_list_column, 0, reduce=None).values
-    #return_df.loc[:, drop_downs] = return_df.loc[:, drop_downs].applymap(unlist_item)
-    if 'type' in return_df.columns:
-        return_df = return_df[return_df.type.str.contains(r'nifti|dicom', na=False)].reset_index(drop=True)
-    return(return_df)
+    The table is written with a sidecar of the types of a CSV's columns, so
+    that reading it back in doesn't have to guess them, and of when the query
+    started.
 
+    Parameters
+    --------
+    chunks
+        An iterable of (acquisition ID, list of records), as given by
+        iter_query_records
+    output
+        Path to the table to write; a CSV unless it ends in .parquet or
+        .feather
+    checkpoint
+        Path to a checkpoint file to resume from and save progress to
+    columns
+        Columns to write even if none of the records have a value in them
+    untyped
+        Columns whose kind is left out of the schema, for those carried over
+        from a previous query as text
+    started
+        When the query started, as seconds since the epoch; saved in the
+        sidecar for a later --since
 
-def main():
+    Returns
+    --------
+    n_rows
+        The number of rows written
+    '''
+
+    types = defaultdict(set)
+    counts = Counter()
+    index = []
+
+    def add_to_index(offset, records):
+        for i, record in enumerate(records):
+            counts.update(record.keys())
+            for k, v in record.items():
+                types[k].add(type(v))
+            index.append((sort_key(record), offset, i))
+
+    if checkpoint is None:
+        spill = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(output)))
+    else:
+        spill = open(checkpoint, 'a+b')
+        spill.seek(0)
+        for offset, _, records in read_checkpoint(spill):
+            add_to_index(offset, records)
+        if VERBOSE and index:
+            print("Resuming from {} rows saved in {}".format(len(index), checkpoint))
+
+    try:
+        spill.seek(0, os.SEEK_END)
+        for acquisition_id, records in chunks:
+            with stage('write'):
+                offset = spill.tell()
+                pickle.dump((acquisition_id, records), spill, pickle.HIGHEST_PROTOCOL)
+                # make sure progress survives the process dying
+                spill.flush()
+                add_to_index(offset, records)
+
+        if VERBOSE:
+            print("Tidying and writing the results...")
+        index.sort(key=itemgetter(0), reverse=True)
+
+        def sorted_records():
+            loaded_offset, records = None, None
+            for _, offset, i in index:
+                if offset != loaded_offset:
+                    spill.seek(offset)
+                    loaded_offset, (_, records) = offset, pickle.load(spill)
+                yield records[i]
+
+        with stage('write'):
+            columns = sorted(set(types) | set(columns))
+            untyped = set(untyped)
+            if table_format(output) == 'csv':
+                with open(output, 'w', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=columns, restval='', lineterminator='\n')
+                    writer.writeheader()
+                    writer.writerows(sorted_records())
+                schema = {
+                    x: column_kind(types[x], counts[x] == len(index))
+                    for x in columns if x not in untyped
+                    }
+            else:
+                write_table(pd.DataFrame(list(sorted_records()), columns=columns), output)
+                schema = {}
+            write_schema(output, schema, started)
+    finally:
+        spill.close()
+
+    if checkpoint is not None:
+        os.remove(checkpoint)
+    return len(index)
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        fw = flywheel.Client()
-        assert fw, "Your Flywheel CLI credentials aren't set!"
+
+def main():
 
     parser = argparse.ArgumentParser(description=("Use this tool to query Flywheel for a project and write out the acquisitions to a table"))
     parser.add_argument(
         "-proj", "--project",
-        help="The project in flywheel to search for",
+        help="The project in flywheel to search for; repeat to query several projects",
         nargs="+",
+        action="append",
         required=True,
         dest="project"
     )
     parser.add_argument(
         "-output", "--output-file",
-        help="The path and name of the output CSV of the query",
+        help="The path and name of the output table of the query; a CSV unless it ends in .parquet or .feather",
         required=True,
         dest="output"
     )
@@ -190,29 +711,91 @@ def main():
         nargs="+",
         default=None
     )
+    parser.add_argument(
+        "--hydrate",
+        help="Take files and parent labels from the session listings instead of fetching each acquisition",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of acquisitions to fetch from flywheel concurrently",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--since",
+        help=("Only fetch acquisitions modified since a previous query output "
+              "was made, or since a timestamp, and merge them into that output"),
+        default=None
+    )
+    parser.add_argument(
+        "--resume",
+        help="Pick up an interrupted query from its checkpoint file instead of starting over",
+        action="store_true",
+        default=False
+    )
     parser.add_argument(
         "-v", "--verbose",
         help="Print out progress messages and information",
         default=True
     )
 
+    add_cassette_arguments(parser)
+    add_metrics_arguments(parser)
+    add_policy_arguments(parser)
+    add_client_arguments(parser)
     args = parser.parse_args()
 
     global VERBOSE
     VERBOSE = args.verbose
-    project = ' '.join(args.project)
-    with warnings.catch_warnings():
+    projects = [' '.join(x) for x in args.project]
+    fw = client_for(args)
+    with report_metrics(args, 'query-bids'), warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        query_result = query_fw(fw, project)
-        query_result_files = process_query(fw, query_result, args.target_cols)
+        started = time.time()
+        with stage('list'):
+            # projects are listed one after the other, each with its sessions
+            # spread over the workers, so there is only ever one pool at a time
+            query_result = [
+                acq
+                for project in projects
+                for acq in query_fw(fw, project, args.subject, args.session, args.hydrate, args.workers)
+                ]
+        prior_chunks, columns, untyped = [], [], []
+
+        # progress is saved alongside the output until it has been written
+        checkpoint = "{}.checkpoint".format(args.output)
+        done = set()
+        if args.resume:
+            done = completed_acquisitions(checkpoint)
+            if VERBOSE:
+                print("Skipping {} acquisitions that were already processed.".format(len(done)))
+            query_result = [x for x in query_result if acquisition_id(x) not in done]
+        elif os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+
+        if args.since:
+            cutoff, prior = parse_since(args.since)
+            listed = set(acquisition_id(x) for x in query_result)
+            query_result = [x for x in query_result if modified_since(x, cutoff)]
+            if VERBOSE:
+                print("{} acquisitions have changed since {}.".format(len(query_result), cutoff))
+            # carry over what hasn't changed, dropping deleted acquisitions
+            if prior is not None:
+                unchanged = listed - set(acquisition_id(x) for x in query_result) - done
+                prior_chunks = read_prior_chunks(prior, unchanged)
+                columns, untyped = prior_columns(prior)
+
+        chunks = iter_query_records(fw, query_result, args.target_cols, args.workers)
+        # record when the query started, rather than finished, so that a later
+        # --since doesn't miss anything that changed during the run
+        write_query_csv(chain(prior_chunks, chunks), args.output, checkpoint,
+                        columns, untyped, started)
 
         if VERBOSE:
             global NO_DATA
             print("{} acquisitions could not be processed.".format(NO_DATA))
-
-        df = query_result_files.reindex(sorted(query_result_files.columns), axis=1)
-        df = df.sort_values(by=['acquisition.id', 'acquisition.label', 'name'], ascending=False).reset_index(drop=True)
-        df.to_csv(args.output, index=False)
     print("Done!")
 
 
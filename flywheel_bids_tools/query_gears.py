@@ -1,11 +1,11 @@
 import pandas as pd
-import flywheel
-import warnings
 import argparse
 from tabulate import tabulate
 from pandas.io.json.normalize import nested_to_record
 import json
 import sys
+from flywheel_bids_tools.ratelimit import add_policy_arguments
+from flywheel_bids_tools.client import add_client_arguments, client_for
 
 
 def find_gear(gear_name, client):
@@ -45,11 +45,6 @@ def str2bool(v):
 
 def main():
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        fw = flywheel.Client()
-        assert fw, "Your Flywheel CLI credentials aren't set!"
-
     parser = argparse.ArgumentParser(description=("Use this to query Flywheel for the gears available to you, or get the config file for a gear."))
 
     parser.add_argument(
@@ -67,7 +62,10 @@ def main():
         default='False'
     )
 
+    add_policy_arguments(parser)
+    add_client_arguments(parser)
     args = parser.parse_args()
+    fw = client_for(args)
 
     config = str2bool(args.config)
 
@@ -0,0 +1,325 @@
+import time
+import random
+import threading
+
+
+class RateLimiter(object):
+    '''
+    A thread-safe token bucket
+
+    Tokens are added at a steady rate up to a maximum burst, and each
+    request takes one, waiting for the bucket to refill if it is empty.
+
+    Input:
+        rate: the average number of requests allowed per second
+        burst: how many requests can be made at once after a quiet spell
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1.0, self.rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Wait until a request is allowed
+        '''
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# statuses worth trying again; 429 and 503 also mean the server wants us to slow down
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+
+try:
+    from urllib3.exceptions import HTTPError as ConnectionProblem
+except ImportError:
+    ConnectionProblem = OSError
+
+
+class CircuitOpen(Exception):
+    '''
+    Raised instead of making a request while the server is failing
+    '''
+
+
+def is_transient(error):
+    '''
+    Whether a failed request might succeed if tried again: server errors,
+    throttling and dropped connections
+    '''
+
+    status = getattr(error, 'status', None)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    return isinstance(error, (CircuitOpen, OSError, ConnectionProblem))
+
+
+def is_throttled(error):
+    return getattr(error, 'status', None) in THROTTLE_STATUSES
+
+
+def retry_after(error):
+    '''
+    The seconds the server asked us to wait in a Retry-After header, if any
+    '''
+
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After') or headers.get('retry-after'))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    '''
+    How long to wait before a retry: a random time up to an exponentially
+    growing limit, so that workers that failed together don't retry together
+    '''
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveLimiter(object):
+    '''
+    A limit on requests in flight that adjusts to the server
+
+    The limit grows by one for each limit's worth of successful requests and
+    halves when the server throttles a request (additive increase,
+    multiplicative decrease). A burst of throttled requests that were all in
+    flight together only halves it once.
+
+    Input:
+        max_limit: the most requests to have in flight at once
+        min_limit: the fewest the limit can drop to
+    '''
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = min(min_limit, self.max_limit)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        '''
+        Wait until another request can be in flight
+        '''
+
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, throttled=False):
+        '''
+        Finish a request that was started (as given by acquire)
+        '''
+
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                if started >= self.decreased:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.decreased = time.monotonic()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker(object):
+    '''
+    Stop sending requests to a server that keeps failing
+
+    After `threshold` transient failures in a row the breaker opens and
+    requests are refused with CircuitOpen for `cooldown` seconds. Then one
+    request is let through as a trial: if it succeeds the breaker closes,
+    and if not it opens again.
+
+    Input:
+        threshold: how many transient failures in a row open the breaker
+        cooldown: seconds to stay open before a trial request
+    '''
+
+    def __init__(self, threshold=10, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        '''
+        Seconds until the breaker lets a trial request through
+        '''
+
+        with self._lock:
+            if self.opened is None:
+                return 0.0
+            return max(0.0, self.opened + self.cooldown - time.monotonic())
+
+    def before(self):
+        '''
+        Check a request may be made, raising CircuitOpen if not
+        '''
+
+        with self._lock:
+            if self.opened is None:
+                return
+            if self.trial or time.monotonic() < self.opened + self.cooldown:
+                raise CircuitOpen("Too many requests to flywheel have failed; waiting before trying again")
+            self.trial = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+            self.trial = False
+
+
+class RequestPolicy(object):
+    '''
+    How a client's requests are paced, limited and retried
+
+    Each request waits for a token from the rate limiter, if there is one,
+    and for room under the adaptive concurrency limit. Requests that fail
+    transiently (see is_transient) are retried after a jittered backoff, or
+    as long as the server's Retry-After header asks; other failures are
+    raised straight away. Throttling halves the concurrency limit, and a run
+    of failures trips the circuit breaker so the server gets a rest.
+
+    Input:
+        rate: the most requests per second, or None for no limit
+        burst: how many requests can be made at once after a quiet spell
+        concurrency: the most requests in flight at once, or None for no
+            limit
+        retries: how many times to retry a request that fails transiently
+        backoff: seconds the first retry waits up to; doubled each time
+        max_backoff: the longest a retry waits
+        breaker: the CircuitBreaker to use; one with default settings if None
+    '''
+
+    def __init__(self, rate=None, burst=None, concurrency=None, retries=5,
+                 backoff=0.5, max_backoff=30.0, breaker=None):
+        self.limiter = RateLimiter(rate, burst) if rate else None
+        self.concurrency = AdaptiveLimiter(concurrency) if concurrency else None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def attempt(self, func, *args, **kwargs):
+        '''
+        Make a single request under the rate and concurrency limits
+        '''
+
+        self.breaker.before()
+        if self.limiter is not None:
+            self.limiter.acquire()
+        started = self.concurrency.acquire() if self.concurrency is not None else None
+        throttled = False
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            throttled = is_throttled(e)
+            # any other error means the server is up, however unhelpful
+            if is_transient(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        finally:
+            if self.concurrency is not None:
+                self.concurrency.release(started, throttled)
+        self.breaker.success()
+        return result
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Make a request, retrying it if it fails transiently
+
+        Output:
+            the result of func(*args, **kwargs); the last exception is
+            raised if every attempt fails
+        '''
+
+        for attempt in range(self.retries + 1):
+            try:
+                return self.attempt(func, *args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+                if isinstance(e, CircuitOpen):
+                    delay = max(delay, self.breaker.remaining())
+                time.sleep(max(delay, retry_after(e) or 0))
+
+
+def request_policy(client, rate=None, burst=None, concurrency=None, retries=5,
+                   backoff=0.5, max_backoff=30.0, breaker=None):
+    '''
+    Pace, limit and retry every request a flywheel client makes
+
+    Every request the SDK makes, including those made through the containers
+    it hands back, goes through the client's ApiClient.call_api, so wrapping
+    that applies one policy across every thread sharing the client. See
+    RequestPolicy for the options.
+
+    Output:
+        policy: the RequestPolicy now in use
+    '''
+
+    api_client = getattr(client, 'api_client', None)
+    if api_client is None:
+        raise ValueError("This client doesn't make requests through an ApiClient!")
+
+    policy = RequestPolicy(rate, burst, concurrency, retries, backoff, max_backoff, breaker)
+    call_api = api_client.call_api
+
+    def governed_call_api(*args, **kwargs):
+        return policy.call(call_api, *args, **kwargs)
+
+    api_client.call_api = governed_call_api
+    return policy
+
+
+def add_policy_arguments(parser):
+    '''
+    Add the options for pacing and retrying requests to a tool's parser
+    '''
+
+    parser.add_argument(
+        "--max-rate",
+        help="The most requests per second to make to flywheel across all workers",
+        type=float,
+        default=None,
+        dest="max_rate"
+    )
+    parser.add_argument(
+        "--retries",
+        help="How many times to retry a request that fails because of throttling, a server error or a dropped connection",
+        type=int,
+        default=5
+    )
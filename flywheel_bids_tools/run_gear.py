@@ -1,7 +1,5 @@
 import json
 import argparse
-import flywheel
-import warnings
 
 def process_config(config):
     '''
@@ -18,11 +16,6 @@ def process_config(config):
 
 def main():
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        fw = flywheel.Client()
-        assert fw, "Your Flywheel CLI credentials aren't set!"
-
     parser = argparse.ArgumentParser(description=("Use this tool to run a Flywheel gear on the changes you've made."))
 
     parser.add_argument(
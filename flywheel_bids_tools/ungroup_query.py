@@ -1,27 +1,7 @@
-import pandas as pd
 import argparse
-from flywheel_bids_tools.upload_bids import get_unequal_cells
-from flywheel_bids_tools.utils import relist_item
+from flywheel_bids_tools.utils import relist_item, read_flywheel_csv, write_table, grouped_changes, ungroup_table, read_schema
 
-
-def read_flywheel_csv(fpath, required_cols=['acquisition.id']):
-    '''
-    Read in a CSV and also ensure it's one of ours
-
-    Input:
-        fpath: path to the file
-        required_cols: list of columns to ensure csv is a flywheel query
-    Output:
-        df: a pandas dataframe
-    '''
-
-    df = pd.read_csv(fpath)
-
-    if not all(elem in df.columns.tolist() for elem in required_cols):
-        raise Exception(("It doesn't look like this csv is correctly formatted",
-        " for this flywheel editing process!"))
-    df = df.sort_values(by=["acquisition.id", "acquisition.label"])
-    return(df)
+SORT_BY = ["acquisition.id", "acquisition.label"]
 
 
 def main():
@@ -54,49 +34,27 @@ def main():
 
     args = parser.parse_args()
 
+    # the edited grouped table is read in the same way as the one it came from
+    grouped_schema = read_schema(args.grouped) or {}
+
     # grouped edited df
-    df_grouped_modified = read_flywheel_csv(args.modified)
+    df_grouped_modified = read_flywheel_csv(args.modified, sort_by=SORT_BY, ascending=True, schema=grouped_schema)
     groups = relist_item(df_grouped_modified['groups'][0])
 
     # grouped unedited
-    df_grouped = read_flywheel_csv(args.grouped)
+    df_grouped = read_flywheel_csv(args.grouped, sort_by=SORT_BY, ascending=True, schema=grouped_schema)
 
     # original df
-    df_original = read_flywheel_csv(args.original)
-
-    # add groupings
-    # add a group index
-    df_original['group_id'] = float('nan')
-    # group the file and store separate groups
-    grouped_df = df_original.groupby(groups).groups
+    df_original = read_flywheel_csv(args.original, sort_by=SORT_BY, ascending=True)
 
-    # loop over groups and assign the index
-    id = 1
-    for name, df in grouped_df.items():
-
-        index = df.to_list()
-        df_original.loc[index, 'group_id'] = id
-        id += 1
     # index the differences
-    diff = get_unequal_cells(df_grouped, df_grouped_modified, provenance=True)
-
-    changes = []
-
-    for x in diff:
+    changes = grouped_changes(df_grouped, df_grouped_modified, provenance=True)
 
-        key = df_grouped_modified.loc[x[0], 'group_id']
-        val = (df_grouped_modified.columns[x[1]], df_grouped_modified.iloc[x[0], x[1]])
-        changes.append((key, val))
-
-    # loop through the differences and map them to the full dataset
+    # map them to the full dataset
     print("Applying the changes to the full dataset...")
+    df_original = ungroup_table(df_original, groups, changes)
 
-    for change in changes:
-        df_original.loc[df_original['group_id'] == change[0], change[1][0]] = change[1][1]
-
-    df_original.drop(columns='group_id', inplace=True)
-    df_original = df_original.sort_values(by=["acquisition.id", "acquisition.label"])
-    df_original.to_csv(args.output, index=False)
+    write_table(df_original, args.output)
     print("Done")
 
 
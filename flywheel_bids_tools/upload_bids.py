@@ -1,18 +1,41 @@
 import sys
 import os
 import pandas as pd
-import numpy as np
 import re
-import flywheel
-import numbers
 import datetime
 import argparse
-from flywheel_bids_tools.utils import relist_item, get_unequal_cells, is_nan, read_flywheel_csv
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from flywheel_bids_tools.utils import get_unequal_cells, is_nan, read_flywheel_csv, ordered_map, write_table, read_schema
+from flywheel_bids_tools.cache import ContainerCache
+from flywheel_bids_tools.validation import Validator, load_schema
+from flywheel_bids_tools.cassette import add_cassette_arguments
+from flywheel_bids_tools.ratelimit import add_policy_arguments
+from flywheel_bids_tools.instrument import stage, add_metrics_arguments, report_metrics
+from flywheel_bids_tools.client import add_client_arguments, client_for
 from tqdm import tqdm
 
 
-ERROR_MESSAGES = []
 FAILS = []
+# requests per second to estimate how long an upload will take at, unless
+# --max-rate paces it
+REQUEST_RATE = 5.0
+
+
+VALIDATOR = None
+
+
+def get_validator():
+    '''
+    The validator for the default schema, built the first time it's needed
+    '''
+
+    global VALIDATOR
+    if VALIDATOR is None:
+        VALIDATOR = Validator()
+    return VALIDATOR
 
 
 def change_checker(user_input, column):
@@ -21,6 +44,8 @@ def change_checker(user_input, column):
     supplied is in the allowed list of acceptable changes. Note this function
     adjusts cases.
 
+    Use Validator.check to also get the rule that was broken.
+
     Input:
         user_input: what the user tried to change
         column: the column they tried to change
@@ -28,231 +53,487 @@ def change_checker(user_input, column):
         boolean: True or False whether the change is acceptable on Flywheel
     '''
 
-    drop_down_bool = {
-        'ignore': ['true', 'false'],
-        'valid': ['true', 'false'],
-        'info_bids_ignore': ['true', 'false']
-        }
+    valid, rule = get_validator().check(user_input, column)
+    if not valid and rule['type'] == 'unknown':
+        raise Exception(rule['message'])
+    return valid
+
+
+def validation_errors(indices_list, changed_df, validator=None, workers=1):
+    '''
+    Run the validator over every changed cell and report the invalid ones
+
+    Input:
+        indices_list: array of the row indices and column indices
+        changed_df: the df to run the change checker on
+        validator: a Validator to use instead of the default schema
+        workers: number of columns to validate at once
+    Output:
+        errors: dataframe of row, column, value, rule and message for each
+            invalid cell; empty if every change is valid
+    '''
+
+    if validator is None:
+        validator = get_validator()
+    errors = validator.validate(changed_df, indices_list, workers)
+
+    if not errors.empty:
+        print("The following changes don't seem to be valid for this data:")
+        for error in errors.itertuples():
+            print("")
+            print("Row {}, Column {}, \"{}\"".format(
+                error.row+1,
+                changed_df.columns.get_loc(error.column)+1,
+                error.value
+                ))
+            print(error.message)
+    return errors
+
+
+def validate_on_unequal_cells(indices_list, changed_df, validator=None, workers=1):
+    '''
+    Loop over list of row-column pairs and run the change checker on each
+
+    Input:
+        indices_list: array of the row indices and column indices
+        changed_df: the df to run the change checker on
+        validator: a Validator to use instead of the default schema
+        workers: number of columns to validate at once
+    Output:
+        valid: boolean on whether the df passed the change checker
+    '''
+
+    return validation_errors(indices_list, changed_df, validator, workers).empty
+
+
+def changed_columns(change_index, columns):
+    '''
+    Collect the names of the changed columns in each row
+
+    Input:
+        change_index: the row-column pairs of the changed cells, as positions
+            in the modified query (whose index is the default range index)
+        columns: the columns of the modified query
+    Output:
+        changes: dict of row index to the set of its changed column names
+    '''
+
+    changes = {}
+    for row, col in change_index:
+        changes.setdefault(row, set()).add(columns[col])
+    return changes
+
+
+def plan_file_update(row, changed=None):
+    '''
+    Work out what to send to flywheel for one modified row
+
+    Only the fields in changed cells are planned: the classification request
+    is left out if no classification or modality cell changed, and the BIDS
+    request if no BIDS cell did. Without a record of the changes every field
+    in the row is planned, and compared with flywheel when it's applied.
+
+    Input:
+        row: a modified row of the query
+        changed: set of the row's changed column names; None for all of them
+    Output:
+        entry: dict of the file, its new classification and BIDS info (None
+            where there's nothing to send), or None if there's nothing at all
+    '''
+
+    modality_changed = changed is not None and 'modality' in changed
+    if changed is None:
+        changed = set(row.index)
+
+    # create MR classifier dict from the changed classification cells
+    class_cols = [x for x in row.index if x.startswith("classification") and x in changed]
+    classification = None
+    if class_cols or modality_changed:
+        classification = {re.sub("classification_", "", x): row[x] for x in class_cols}
+        classification = {k: v for k, v in classification.items() if not is_nan(v)}
+
+    # create BIDS info dict from the changed BIDS cells
+    bids_cols = [x for x in row.index if x.startswith("info_BIDS_") and x in changed]
+    bids = None
+    if bids_cols:
+        bids = {re.sub("info_BIDS_", "", x): ('' if is_nan(row[x]) else row[x]) for x in bids_cols}
+
+    if classification is None and bids is None:
+        return None
+    return {
+        'acquisition.id': str(row['acquisition.id']),
+        'name': row['name'],
+        'subject.label': row.get('subject.label'),
+        'session.label': row.get('session.label'),
+        'modality': None if is_nan(row.get('modality')) else row.get('modality'),
+        'modality_changed': modality_changed,
+        'classification': classification,
+        'bids': bids
+    }
 
-    drop_down_single_fields = {
-        'modality': ['', 'nan', 'mr', 'ct', 'pet', 'us', 'eeg', 'ieeg', 'x-ray',
-            'ecg', 'meg', 'nirs']
-        }
 
-    drop_down_multi_fields = {
-        'classification_measurement': ['nan', 'ASL', 'B0', 'B1', 'Diffusion',
-            'Fingerprinting', 'MT', 'PD', 'Perfusion', 'Spectroscopy',
-            'Susceptibility', 'T1', 'T2', 'T2*', 'Velocity'],
+def build_plan(modified_df, change_index=None, request_rate=REQUEST_RATE):
+    '''
+    Work out every update an upload will make, without touching flywheel
 
-        'classification_intent': ['nan', 'Calibration', 'Fieldmap', 'Functional',
-            'Localizer', 'Non-Image', 'Screenshot', 'Shim', 'Structural'],
+    Input:
+        modified_df: the modified rows of the query
+        change_index: the row-column pairs of the changed cells, as positions
+            in the modified query (whose index is the default range index);
+            None to plan every field of every row
+        request_rate: requests per second to estimate the runtime at
+    Output:
+        plan: dict with a summary and the planned file updates grouped by
+            acquisition
+    '''
 
-        'classification_features': ['nan', '3D', 'Compressed-Sensing', 'Derived',
-            'Eddy-Current-Corrected', 'Fieldmap-Corrected', 'Gradient-Unwarped',
-            'In-Plane', 'Magnitude', 'Motion-Corrected', 'Multi-Band',
-            'Multi-Echo', 'Multi-Flip', 'Multi-Shell', 'Phase',
-            'Physio-Corrected', 'Quantitative', 'Steady-State']
+    changes = None
+    if change_index is not None:
+        changes = changed_columns(change_index, modified_df.columns)
+        modified_df = modified_df.loc[modified_df.index.isin(list(changes))]
+
+    acquisitions = OrderedDict()
+    for index, row in modified_df.iterrows():
+        entry = plan_file_update(row, None if changes is None else changes.get(index, set()))
+        if entry is not None:
+            acquisitions.setdefault(entry['acquisition.id'], []).append(entry)
+
+    plan = {
+        'acquisitions': [
+            {'acquisition.id': k, 'files': v} for k, v in acquisitions.items()
+            ]
     }
+    plan['summary'] = summarise_plan(plan, request_rate)
+    return plan
 
-    string_fields = ['acquisition.label', 'project.label', 'error_message',
-        'subject.label', 'folder', 'template',
-        'intendedfor', 'mod', 'path', 'rec', 'task', 'run',
-        'info_bids_error_message', 'info_sequencename',
-        'info_bids_filename', 'type', 'info_bids_folder', 'info_bids_modality',
-        'info_bids_path', 'info_bids_template', 'info_seriesdescription',
-        'classification_custom', 'info_bids_task', 'info_bids_acq',
-        'info_bids_intendedfor', 'session.label', 'subject.label'
-        ]
-
-    numeric_fields = ['info_echotime', 'info_repetitiontime', 'info_echotime1', 'info_echotime2']
-
-    # na is acceptible by default
-    if is_nan(user_input):
-        return True
-    # try boolean drop down option
-    if column.lower() in drop_down_bool.keys():
-        if str(user_input).lower() == 'true' or str(user_input).lower() == 'false':
-            return True
-        else:
-            ERROR_MESSAGES.append("This field accepts booleans, these can only be written as \"True\" or \"False\"!")
-            return False
-
-    # try drop down string option
-    elif column.lower() in drop_down_single_fields.keys():
-        for field, options in drop_down_single_fields.items():
-            if str(user_input).lower() in options:
-                return True
-            else:
-                continue
-        ERROR_MESSAGES.append("Items in this field must exactly match one of the available options in the drop-down menu on the website!")
-        return False
-
-    # try drop down multi option
-    elif column.lower() in drop_down_multi_fields.keys():
-
-        if not isinstance(user_input, list):
-            user_input = [user_input]
-        if set(user_input) <= set(drop_down_multi_fields[column.lower()]):
-            return True
-        else:
-            ERROR_MESSAGES.append("This field must match one of the available options in the drop-down menu on the website!")
-            return False
 
-    # try generic string
-    elif column.lower() in string_fields:
-        if type(user_input) is str or is_nan(user_input):
-            return True
-        else:
-            ERROR_MESSAGES.append("This field only accepts strings!")
-            return False
+def summarise_plan(plan, request_rate=REQUEST_RATE):
+    '''
+    Count the requests in a plan and estimate how long they'll take
 
-    # try generic number
-    elif column.lower() in numeric_fields:
-        if isinstance(user_input, numbers.Number):
-            return True
-        else:
-            ERROR_MESSAGES.append("This field only accepts numeric types!")
-            return False
-
-    # try the filename separately
-    elif column.lower() == 'filename':
-        # three different types of acceptable file names
-        anat1 = re.compile(
-            r'^sub-(?P<subject_id>[a-zA-Z0-9]+)(_ses-(?P<session_id>[a-zA-Z0-9]+))?(_acq-(?P<acquisition_label>[a-zA-Z0-9]+))?(_ce-(?P<contrastenhanced_id>[a-zA-Z0-9]+))?(_rec-(?P<reconstruction_id>[a-zA-Z0-9]+))?(_run-(?P<run_id>[a-zA-Z0-9]+))?(_(?P<modality>[a-zA-Z0-9]+))?((?P<suffix>\.nii(\.gz)?))$'
-            )
-
-        anat2 = re.compile(
-            r'^sub-(?P<subject_id>[a-zA-Z0-9]+)(_ses-(?P<session_id>[a-zA-Z0-9]+))?(_acq-(?P<acquisition_label>[a-zA-Z0-9]+))?(_ce-(?P<contrastenhanced_id>[a-zA-Z0-9]+))?(_rec-(?P<reconstruction_id>[a-zA-Z0-9]+))?(_run-(?P<run_id>[a-zA-Z0-9]+))?(_mod-(?P<modality>[a-zA-Z0-9]+))?(_(?P<suffix>[a-zA-Z0-9]+\.nii(\.gz)?))$'
-            )
-
-        func1 = re.compile(
-            r'^sub-(?P<subject_id>[a-zA-Z0-9]+)(_ses-(?P<session_id>[a-zA-Z0-9]+))?(_task-(?P<task_label>[a-zA-Z0-9]+))?(_acq-(?P<acquisition_label>[a-zA-Z0-9]+))?(_ce-(?P<contrastenhanced_id>[a-zA-Z0-9]+))?(_dir-(?P<direction>[a-zA-Z0-9]+))?(_rec-(?P<reconstruction_id>[a-zA-Z0-9]+))?(_run-(?P<run_id>[a-zA-Z0-9]+))?(_echo-(?P<echo_id>[a-zA-Z0-9]+))?(_(?P<contrast_label>[a-zA-Z0-9]+))?((?P<suffix>\.nii(\.gz)?))$'
-        )
+    Each acquisition is fetched once, then each file gets at most one
+    classification and one info request; a request is skipped when applying
+    the plan if flywheel already holds the planned values.
+    '''
 
-        if bool(anat1.match(str(user_input))):
-            return True
-        elif bool(anat2.match(str(user_input))):
-            return True
-        elif bool(func1.match(str(user_input))):
-            return True
-        else:
-            ERROR_MESSAGES.append("This field MUST be a BIDS compliant name!")
-            return False
+    files = [f for acq in plan['acquisitions'] for f in acq['files']]
+    classification = [f['classification'] for f in files if f['classification'] is not None]
+    bids = [f['bids'] for f in files if f['bids'] is not None]
+    requests = len(plan['acquisitions']) + len(classification) + len(bids)
+    return {
+        'acquisitions': len(plan['acquisitions']),
+        'files': len(files),
+        'classification_updates': len(classification),
+        'info_updates': len(bids),
+        'requests': requests,
+        'payload_bytes': sum(len(json.dumps(x, default=to_json)) for x in classification + bids),
+        'request_rate': request_rate,
+        'estimated_seconds': round(requests / float(request_rate), 1)
+    }
+
+
+def to_json(x):
+    '''
+    Convert the numpy values pandas hands back into plain python for JSON
+    '''
 
-    # can't edit acquisition ID tho!
-    elif column == 'acquisition.id':
-        ERROR_MESSAGES.append("You cannot edit the acquisition ID!")
-        return False
-    else:
-        raise Exception("Column {0} not recognised!".format(column))
+    return x.item() if hasattr(x, 'item') else str(x)
 
 
-def validate_on_unequal_cells(indices_list, changed_df):
+def write_plan(plan, fpath):
+    with open(fpath, 'w') as f:
+        json.dump(plan, f, indent=2, default=to_json)
+
+
+def read_plan(fpath):
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def plan_hash(plan):
     '''
-    Loop over list of row-column pairs and run the change checker on each
+    A hash of the updates in a plan, whatever rate its summary assumed
+    '''
+
+    updates = json.dumps(plan['acquisitions'], sort_keys=True, default=to_json)
+    return hashlib.sha1(updates.encode('utf-8')).hexdigest()
+
+
+def journal_path(plan):
+    '''
+    Where the journal of a plan's upload goes unless --journal says otherwise
+    '''
+
+    return "./upload_journal_{}.jsonl".format(plan_hash(plan)[:12])
+
+
+def print_plan_summary(summary):
+    print("{acquisitions} acquisitions, {files} files: {classification_updates} "
+          "classification and {info_updates} info updates".format(**summary))
+    print("{requests} requests, {payload_bytes} bytes of updates, about "
+          "{estimated_seconds} seconds at {request_rate} requests per second".format(**summary))
+
+
+class UploadJournal(object):
+    '''
+    An append-only record of the updates that have been made on flywheel
+
+    Each line of the journal is a JSON object naming the plan, the
+    acquisition, the file, which of its fields were updated ("classification"
+    or "bids") and a hash of the values sent. Updates that turned out to be
+    on flywheel already are recorded too, so a resumed upload doesn't check
+    them again.
+
+    Only the lines of the journal's own plan are read back, so a journal
+    shared by several uploads can't have one skip the updates of another.
 
     Input:
-        indices_list: array of the row indices and column indices
-        changed_df: the df to run the change checker on
+        fpath: path to the journal; it's created if it doesn't exist
+        plan: the plan being uploaded
+    '''
+
+    def __init__(self, fpath, plan):
+        self.fpath = fpath
+        self.plan = plan_hash(plan)
+        self.applied = set()
+        self._lock = threading.Lock()
+        if os.path.isfile(fpath):
+            with open(fpath) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    if record.get('plan') == self.plan:
+                        self.applied.add((record['plan'], record['acquisition.id'], record['name'],
+                                          record['fields'], record['hash']))
+
+    def key(self, entry, fields):
+        if fields == 'classification':
+            payload = {'classification': entry['classification'], 'modality': entry['modality']}
+        else:
+            payload = entry['bids']
+        digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=to_json).encode('utf-8')).hexdigest()
+        return (self.plan, entry['acquisition.id'], entry['name'], fields, digest)
+
+    def __contains__(self, key):
+        return key in self.applied
+
+    def record(self, entry, fields, status='applied'):
+        key = self.key(entry, fields)
+        line = json.dumps({
+            'plan': key[0],
+            'acquisition.id': key[1],
+            'name': key[2],
+            'fields': key[3],
+            'hash': key[4],
+            'status': status,
+            'time': datetime.datetime.now().isoformat()
+            })
+        with self._lock:
+            with open(self.fpath, 'a') as f:
+                f.write(line + '\n')
+            self.applied.add(key)
+
+
+def remaining_plan(plan, journal):
+    '''
+    Drop the updates a journal says have already been made from a plan
+    '''
+
+    acquisitions = []
+    for acquisition in plan['acquisitions']:
+        files = []
+        for entry in acquisition['files']:
+            entry = dict(entry)
+            for fields in ['classification', 'bids']:
+                if entry[fields] is not None and journal.key(entry, fields) in journal:
+                    entry[fields] = None
+            if entry['classification'] is not None or entry['bids'] is not None:
+                files.append(entry)
+        if files:
+            acquisitions.append({'acquisition.id': acquisition['acquisition.id'], 'files': files})
+    return {'acquisitions': acquisitions}
+
+
+def file_updates(fw_object, f, entry, journal=None):
+    '''
+    Turn the planned updates for one file into requests
+
+    Input:
+        fw_object: the flywheel acquisition object
+        f: the acquisition's file the entry is for
+        entry: the planned updates for the file
+        journal: an UploadJournal to record updates that aren't needed in
     Output:
-        valid: boolean on whether the df passed the change checker
+        updates: list of (entry, fields, description, function, arguments)
+            tuples, one for each request to make
     '''
 
-    valid = []
-    for pair in indices_list:
-        valid.append(change_checker(
-            changed_df.iloc[pair[0], pair[1]],
-            changed_df.columns[pair[1]]
+    updates = []
+    new_class = entry['classification']
+    if new_class is not None:
+        current_class = dict(f.get('classification') or {})
+        if any(current_class.get(k) != v for k, v in new_class.items()) or entry['modality_changed']:
+            current_class.update(new_class)
+            updates.append((
+                entry,
+                'classification',
+                "Couldn't make this classification change: Subj{}-Sess{}".format(entry['subject.label'], entry['session.label']),
+                fw_object.replace_file_classification,
+                (f.name, current_class, entry['modality'])
+            ))
+        elif journal is not None:
+            journal.record(entry, 'classification', 'unchanged')
+
+    bids = entry['bids']
+    if bids is not None:
+        # files that were never curated, like DICOMs, have no BIDS info yet
+        current_bids = (f.get('info') or {}).get('BIDS') or {}
+        if any(current_bids.get(k) != v for k, v in bids.items()):
+            # the BIDS info is replaced as a whole, so keep what hasn't changed
+            new_bids = dict(current_bids)
+            new_bids.update(bids)
+            updates.append((
+                entry,
+                'bids',
+                "Couldn't make this BIDS change: Subj {}-Sess {}-File {}\n{}".format(entry['subject.label'], entry['session.label'], entry['name'], new_bids),
+                fw_object.update_file_info,
+                (f.name, {'BIDS': new_bids})
             ))
+        elif journal is not None:
+            journal.record(entry, 'bids', 'unchanged')
 
-    if all(valid):
-        return True
-    else:
-        print("The following changes don't seem to be valid for this data:")
-        for x in range(len(valid)):
-            if valid[x] is False:
-                print("")
-                print("Row {}, Column {}, \"{}\"".format(
-                    indices_list[x][0]+1,
-                    indices_list[x][1]+1,
-                    changed_df.iloc[indices_list[x][0], indices_list[x][1]]
-                    ))
-                print(ERROR_MESSAGES.pop(0))
-        return False
+    return updates
 
 
-def upload_to_flywheel(modified_df, change_index, client):
+def acquisition_updates(fw_object, entries, journal=None):
     '''
-    If the changes are valid, upload them to flywheel
+    Turn the planned updates for one acquisition into requests
+
+    A file that can't be planned for is added to the failures on its own,
+    so the other files of the acquisition are still updated.
+
+    Input:
+        fw_object: the flywheel acquisition object
+        entries: the planned file updates for this acquisition
+        journal: an UploadJournal to record updates that aren't needed in
+    Output:
+        updates: list of (entry, fields, description, function, arguments)
+            tuples, one for each request to make
     '''
+
     global FAILS
-    # loop through each of the modified rows
-    for index, row in tqdm(modified_df.iterrows(), total=modified_df.shape[0]):
-
-        # get the acquisition
-        acquisition = row['acquisition.id']
-        file_type = row['type']
-        file_name = row['name']
-        modality = row['modality']
-        # get the flywheel object of the acquisition
+    files = {f.name: f for f in fw_object.files}
+    updates = []
+    for entry in entries:
+
+        f = files.get(entry['name'])
+        if f is None:
+            print("Error fetching files for acquisition!")
+            print("No file named {} in acquisition {}".format(entry['name'], entry['acquisition.id']))
+            FAILS.append(entry)
+            continue
+
         try:
-            fw_object = client.get(str(acquisition))
-            f = [f for f in fw_object.files if f.name == file_name][0]
+            updates.extend(file_updates(fw_object, f, entry, journal))
         except Exception as e:
-            print("Error fetching files for acquisition!")
+            print("Couldn't work out the changes to this file: Subj {}-Sess {}-File {}".format(
+                entry['subject.label'], entry['session.label'], entry['name']))
             print(e)
-            FAILS.append(row)
-            continue
+            FAILS.append(entry)
 
-        # create MR classifier dict
-        classification_vals = row.filter(regex=r"classification")
-        keys = [re.sub("classification_", "", x) for x in classification_vals.index.to_list()]
-        values = [None if is_nan(x) else x for x in list(classification_vals.values)]
-        classification = dict(zip(keys,values))
-        new_class = {k: v for k, v in classification.items() if v is not None}
-        current_class = f.classification
-        if new_class != current_class:
-            current_class.update(new_class)
+    return updates
 
-            try:
-                update_attempt_classifier = fw_object.replace_file_classification(
-                    f.name,
-                    current_class,
-                    modality
-                )
-
-            except Exception as e:
-                print("Couldn't make this classification change: Subj{}-Sess{}".format(row['subject.label'], row['session.label']))
-                print(e)
-                FAILS.append(row)
-
-        # create BIDS info dict
-        bids_cols = row.filter(regex=r"info_BIDS")
-        bids = bids_cols.to_dict()
-        bids = {re.sub("info_BIDS_", "", k): v for k, v in bids.items()}
-        bids = {k: (v if not is_nan(v) else '') for k, v in bids.items()}
-        del bids['info_BIDS']
-        current_bids = f['info']['BIDS']
-
-        if current_bids != bids:
-            try:
-                update_attempt_bids = fw_object.update_file_info(
-                    f.name,
-                    {'BIDS': bids}
-                )
-            except Exception as e:
-                print("Couldn't make this BIDS change: Subj {}-Sess {}-File {}".format(row['subject.label'], row['session.label'], row['name']))
-                print(bids)
-                print(e)
-                FAILS.append(row)
 
+def apply_plan(plan, client, cache=None, workers=1, journal=None, resume=False):
+    '''
+    Send the updates in a plan to flywheel
+
+    Each acquisition is fetched once, and the file updates for all of them
+    are sent through a pool of worker threads; the client's request policy
+    retries those that fail transiently. Anything that still fails is
+    written to failed_to_upload.csv, and as a plan that can be applied again
+    to failed_to_upload.json.
+
+    Input:
+        plan: a plan from build_plan or read_plan
+        client: the flywheel Client class object
+        cache: a ContainerCache to fetch acquisitions through
+        workers: number of requests to have in flight at once
+        journal: an UploadJournal to record each update in as it's made
+        resume: skip the updates the journal says were already made
+    '''
+    global FAILS
+    if cache is None:
+        cache = ContainerCache(client)
+    if resume and journal is not None:
+        before = summarise_plan(plan)['files']
+        plan = remaining_plan(plan, journal)
+        print("Skipping {} file updates already in the journal.".format(before - summarise_plan(plan)['files']))
+
+    def fetch(acquisition):
+        try:
+            fw_object = cache.get(acquisition['acquisition.id'])
+        except Exception as e:
+            print("Error fetching files for acquisition!")
+            print(e)
+            FAILS.extend(acquisition['files'])
+            return []
+        return acquisition_updates(fw_object, acquisition['files'], journal)
+
+    def send(update):
+        entry, fields, message, func, args = update
+        try:
+            func(*args)
+        except Exception as e:
+            print(message)
+            print(e)
+            FAILS.append(entry)
+            return
+        if journal is not None:
+            journal.record(entry, fields)
+
+    updates = (
+        update
+        for planned in ordered_map(fetch, plan['acquisitions'], workers)
+        for update in planned
+        )
+    for _ in tqdm(ordered_map(send, updates, workers), unit='update'):
+        pass
 
     if len(FAILS) > 0:
-        fails_df = pd.concat(FAILS, sort=False)
+        fails_df = pd.DataFrame(FAILS)
         fails_df.to_csv("./failed_to_upload.csv", index=False)
+        failed = OrderedDict()
+        for entry in FAILS:
+            failed.setdefault(entry['acquisition.id'], []).append(entry)
+        write_plan({'acquisitions': [{'acquisition.id': k, 'files': v} for k, v in failed.items()]},
+                   "./failed_to_upload.json")
     return
 
 
+def upload_to_flywheel(modified_df, change_index, client, cache=None,
+                       workers=1, journal=None, resume=False):
+    '''
+    If the changes are valid, upload them to flywheel
+
+    Input:
+        modified_df: the modified rows of the query
+        change_index: the row-column pairs of the changed cells, which decide
+            the fields sent for each file; None to compare every field
+        client: the flywheel Client class object
+        cache: a ContainerCache to fetch acquisitions through
+        workers: number of requests to have in flight at once
+        journal: an UploadJournal to record each update in as it's made
+        resume: skip the updates the journal says were already made
+    '''
+
+    apply_plan(build_plan(modified_df, change_index), client, cache, workers,
+               journal, resume)
+
+
 def create_nested_fw_dict(tree_list, value):
 
     if tree_list:
@@ -260,48 +541,126 @@ def create_nested_fw_dict(tree_list, value):
     return value
 
 
-def main():
+def upload(plan, args):
+    '''
+    Upload a plan's updates with the options given to upload-bids
+    '''
 
-    fw = flywheel.Client()
+    client = client_for(args)
+    journal = UploadJournal(args.journal or journal_path(plan), plan)
+    print("Uploading...")
+    with stage('upload'):
+        apply_plan(plan, client, workers=args.workers, journal=journal,
+                   resume=args.resume)
+    print("Done!")
+
+
+def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-orig",
-        help="Path to the original flywheel query CSV",
+        help="Path to the original flywheel query table (.csv, .parquet or .feather)",
         dest="original",
-        required=True
+        required=False
     )
     parser.add_argument(
         "-mod",
-        help="Path to the modified flywheel query CSV",
+        help="Path to the modified flywheel query table (.csv, .parquet or .feather)",
         dest="modified",
-        required=True
+        required=False
     )
 
-    args = parser.parse_args()
-
-    # original df
-    df_original = read_flywheel_csv(args.original)
-    # edited df
-    df_modified = read_flywheel_csv(args.modified)
-
-    # check for equality of each cell between the original and modified
-    unequal = get_unequal_cells(df_original, df_modified)
-    # if any unequal, assess the validity of the modification
-    res = validate_on_unequal_cells(unequal, df_modified)
-
-    if len(ERROR_MESSAGES) is 0 and res is True:
-        print("Changes appear to be valid! Uploading...")
-        diff = df_modified.fillna(9999) != df_original.fillna(9999)
-        #drop_downs = ['classification_Measurement', 'classification_Intent', 'classification_Features']
-        #df_modified.loc[:, drop_downs] = df_modified.loc[:, drop_downs].applymap(relist_item)
-        upload_to_flywheel(df_modified.loc[diff.any(axis=1),], unequal, fw)
-        print("Done!")
-        sys.exit(0)
-    else:
-        print("Exiting...")
-        sys.exit(0)
+    parser.add_argument(
+        "--schema",
+        help="Path to a JSON file of extra or replacement validation rules, by column",
+        default=None
+    )
+    parser.add_argument(
+        "--errors",
+        help="Path to write a table of any invalid changes to (.csv, .parquet or .feather)",
+        default=None
+    )
+    parser.add_argument(
+        "--plan",
+        help="Don't upload; write the updates that would be made to this JSON plan file instead",
+        default=None
+    )
+    parser.add_argument(
+        "--apply-plan",
+        help="Upload the updates in a JSON plan file made with --plan",
+        default=None,
+        dest="apply_plan"
+    )
+    parser.add_argument(
+        "--journal",
+        help="Path of the journal that records each update as it's made; "
+             "by default one named after the plan being uploaded",
+        default=None
+    )
+    parser.add_argument(
+        "--resume",
+        help="Skip the updates the journal says were already made by an earlier run",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of requests to send to flywheel, or columns to validate, at once",
+        type=int,
+        default=1
+    )
 
+    add_cassette_arguments(parser)
+    add_metrics_arguments(parser)
+    add_policy_arguments(parser)
+    add_client_arguments(parser)
+    args = parser.parse_args()
+    request_rate = args.max_rate or REQUEST_RATE
+
+    with report_metrics(args, 'upload-bids'):
+        if args.apply_plan:
+            plan = read_plan(args.apply_plan)
+            print_plan_summary(summarise_plan(plan, request_rate))
+            upload(plan, args)
+            sys.exit(0)
+
+        if args.original is None or args.modified is None:
+            parser.error("-orig and -mod are required unless --apply-plan is given")
+
+        with stage('read'):
+            # original df
+            table_schema = read_schema(args.original) or {}
+            df_original = read_flywheel_csv(args.original, schema=table_schema)
+            # edited df; read the same way as the original so the two compare cell for cell
+            df_modified = read_flywheel_csv(args.modified, schema=table_schema)
+
+        with stage('validate'):
+            # check for equality of each cell between the original and modified
+            unequal = get_unequal_cells(df_original, df_modified)
+            # if any unequal, assess the validity of the modification
+            validator = Validator(load_schema(args.schema)) if args.schema else None
+            errors = validation_errors(unequal, df_modified, validator, args.workers)
+
+        if errors.empty:
+            print("Changes appear to be valid!")
+            #drop_downs = ['classification_Measurement', 'classification_Intent', 'classification_Features']
+            #df_modified.loc[:, drop_downs] = df_modified.loc[:, drop_downs].applymap(relist_item)
+            with stage('plan'):
+                plan = build_plan(df_modified, unequal, request_rate)
+            print_plan_summary(plan['summary'])
+            if args.plan:
+                write_plan(plan, args.plan)
+                print("Plan written to {}".format(args.plan))
+                sys.exit(0)
+            upload(plan, args)
+            sys.exit(0)
+        else:
+            if args.errors:
+                write_table(errors, args.errors)
+                print("Invalid changes written to {}".format(args.errors))
+            print("Exiting...")
+            sys.exit(0)
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,13 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
+import csv
+import json
+import numbers
+import importlib.util
 
 
 def unlist_item(ls):
@@ -25,29 +31,400 @@ def relist_item(string):
         return string
 
 
-def read_flywheel_csv(fpath, required_cols=['acquisition.id']):
+TABLE_FORMATS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.feather': 'feather'
+}
+
+
+def table_format(fpath):
+    '''
+    Work out the format of a table from its file extension; anything that
+    isn't parquet or feather is treated as a CSV
+    '''
+
+    return TABLE_FORMATS.get(os.path.splitext(str(fpath))[1].lower(), 'csv')
+
+
+def require_pyarrow(fpath):
+    '''
+    Make sure a table can be read or written in its format, which for
+    parquet and feather needs the optional pyarrow
+    '''
+
+    if table_format(fpath) != 'csv' and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError("{} is a {} table, which needs pyarrow; install it with "
+                          "pip install flywheel-bids-tools[parquet]".format(fpath, table_format(fpath)))
+
+
+SCHEMA_SUFFIX = '.schema.json'
+
+# what each kind of column in a schema sidecar is read in as
+SCHEMA_DTYPES = {
+    'str': str,
+    'float': 'float64',
+    'int': 'int64',
+    'bool': 'bool'
+}
+
+# the text pandas reads as a missing value
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+    '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+    'n/a', 'nan', 'null']
+
+PYARROW_CSV = importlib.util.find_spec('pyarrow') is not None
+
+_SCHEMAS = {}
+
+
+def schema_path(fpath):
+    '''
+    The path of the schema sidecar that goes with a table
+    '''
+
+    return str(fpath) + SCHEMA_SUFFIX
+
+
+def column_kind(types, complete=True):
     '''
-    Read in a CSV and also ensure it's one of ours
+    Work out what a column of a table can safely be read in as
 
     Input:
-        fpath: path to the file
+        types: set of the python types of the values in the column
+        complete: boolean; False if some rows have no value at all
+    Output:
+        kind: "str", "float", "int" or "bool"; None if it's best left to
+            pandas to guess
+    '''
+
+    missing = not complete or type(None) in types
+    types = set(types) - {type(None)}
+    if not types:
+        return None
+    if not all(issubclass(t, numbers.Number) for t in types):
+        return 'str'
+    if any(issubclass(t, bool) for t in types):
+        # a boolean column with gaps reads in as objects
+        return 'bool' if types == {bool} and not missing else None
+    if all(issubclass(t, numbers.Integral) for t in types) and not missing:
+        return 'int'
+    return 'float'
+
+
+def write_schema(fpath, schema, started=None):
+    '''
+    Write out the schema sidecar of a table
+
+    Input:
+        fpath: path to the table the schema describes
+        schema: dict of column name to kind; see column_kind
+        started: when the query the table came from started, as seconds
+            since the epoch
+    '''
+
+    sidecar = {
+        'columns': {k: v for k, v in schema.items() if v is not None},
+        'size': os.path.getsize(fpath)
+        }
+    if started is not None:
+        sidecar['started'] = started
+    with open(schema_path(fpath), 'w') as f:
+        json.dump(sidecar, f, indent=1, sort_keys=True)
+
+
+def read_schema(fpath):
+    '''
+    Read the schema sidecar of a CSV table, if it has an up to date one
+
+    Schemas are cached for as long as their sidecar is unchanged. A sidecar
+    is ignored once its table has been edited and changed size.
+
+    Input:
+        fpath: path to the table
+    Output:
+        schema: dict of column name to kind, or None
+    '''
+
+    sidecar = schema_path(fpath)
+    try:
+        stamp = os.stat(sidecar).st_mtime
+        size = os.path.getsize(fpath)
+    except OSError:
+        return None
+    if _SCHEMAS.get(sidecar, (None,))[0] != stamp:
+        try:
+            with open(sidecar) as f:
+                _SCHEMAS[sidecar] = (stamp, json.load(f))
+        except ValueError:
+            return None
+    saved = _SCHEMAS[sidecar][1]
+    if saved.get('size') != size:
+        return None
+    return dict(saved['columns'])
+
+
+def read_started(fpath):
+    '''
+    When the query a table came from started, as recorded in its sidecar
+
+    Unlike its schema, this still holds after the table has been edited.
+
+    Output:
+        started: seconds since the epoch, or None if it wasn't recorded
+    '''
+
+    try:
+        with open(schema_path(fpath)) as f:
+            return json.load(f).get('started')
+    except (OSError, ValueError):
+        return None
+
+
+def read_csv_header(fpath):
+    with open(fpath, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def read_table_header(fpath):
+    '''
+    The columns of a table, without reading any of its rows
+
+    Output:
+        columns: list of column names, in the order they're stored
+    '''
+
+    fmt = table_format(fpath)
+    require_pyarrow(fpath)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(fpath).names
+    elif fmt == 'feather':
+        import pyarrow as pa
+        with pa.memory_map(str(fpath)) as source:
+            return pa.ipc.open_file(source).schema.names
+    return read_csv_header(fpath)
+
+
+def read_table(fpath, columns=None, schema=None):
+    '''
+    Read in a table in whichever format its extension says it's in
+
+    A CSV with a schema, given or from its sidecar, has its column types set
+    from it rather than guessed, and is read with the pyarrow parser if that's
+    installed and every column is covered. Either way, numbers are read back
+    exactly as they were written.
+
+    Input:
+        fpath: path to a .csv, .parquet or .feather file
+        columns: list of columns to read; all of them if None. Any the
+            table doesn't have are left out
+        schema: dict of column name to kind to read a CSV with; by default
+            the one in its sidecar, if any. An empty dict means guess them all
+    Output:
+        df: a pandas dataframe
+    '''
+
+    fmt = table_format(fpath)
+    header = read_table_header(fpath)
+    if columns is not None:
+        # leave out any the table doesn't have
+        requested = set(columns)
+        columns = [x for x in header if x in requested]
+    if fmt == 'parquet':
+        return missing_as_nan(pd.read_parquet(fpath, columns=columns))
+    elif fmt == 'feather':
+        return missing_as_nan(pd.read_feather(fpath, columns=columns))
+
+    if schema is None:
+        schema = read_schema(fpath)
+    if not schema:
+        return pd.read_csv(fpath, usecols=columns)
+
+    wanted = header if columns is None else columns
+    kinds = {x: schema[x] for x in wanted if schema.get(x) in SCHEMA_DTYPES}
+    try:
+        if PYARROW_CSV and len(kinds) == len(wanted):
+            return read_csv_with_pyarrow(fpath, kinds)
+        return pd.read_csv(fpath, usecols=columns, dtype={k: SCHEMA_DTYPES[v] for k, v in kinds.items()},
+            float_precision='round_trip')
+    except (ValueError, TypeError):
+        # something has been edited into a column of numbers that isn't one,
+        # so read them all as text and convert whatever still can be
+        df = pd.read_csv(fpath, usecols=columns, dtype={k: str for k in kinds})
+        for col, kind in kinds.items():
+            if kind != 'str':
+                df[col] = parse_column(df[col], kind)
+        return df
+
+
+def parse_column(values, kind):
+    '''
+    Convert a column of text to a schema kind, leaving as text any values
+    that can't be
+    '''
+
+    parse = {'float': float, 'int': int, 'bool': lambda x: {'True': True, 'False': False}[x]}[kind]
+
+    def parse_value(x):
+        if not isinstance(x, str):
+            return x
+        try:
+            return parse(x)
+        except (ValueError, KeyError):
+            return x
+
+    if kind != 'bool':
+        try:
+            return values.astype(SCHEMA_DTYPES[kind])
+        except (ValueError, TypeError):
+            pass
+    return values.astype(object).map(parse_value)
+
+
+def read_csv_with_pyarrow(fpath, schema):
+    '''
+    Read the columns of a CSV in a schema with the pyarrow parser, which is
+    told their types up front rather than guessing them
+
+    Input:
+        fpath: path to the CSV
+        schema: dict of column name to kind for every column to read
+    Output:
+        df: a pandas dataframe, with missing text as NaN as pandas reads it
+    '''
+
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    types = {'str': pa.string(), 'float': pa.float64(), 'int': pa.int64(), 'bool': pa.bool_()}
+    options = pa_csv.ConvertOptions(
+        column_types={k: types[v] for k, v in schema.items()},
+        include_columns=list(schema),
+        null_values=NA_VALUES,
+        strings_can_be_null=True
+        )
+    return missing_as_nan(pa_csv.read_csv(fpath, convert_options=options).to_pandas())
+
+
+def missing_as_nan(df):
+    '''
+    Make the missing values pyarrow reads in as None NaN, as pandas reads
+    them from a CSV
+    '''
+
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notnull(), np.nan)
+    return df
+
+
+def write_table(df, fpath, **kwargs):
+    '''
+    Write out a table in whichever format the extension of fpath asks for
+
+    Parquet and feather keep numeric, boolean and date columns as they are.
+    Text columns holding anything other than strings (lists of
+    classifications, IntendedFor dicts, mixed values) are written as the same
+    text a CSV would hold, so every format reads back the same way.
+
+    Input:
+        df: a pandas dataframe
+        fpath: path to a .csv, .parquet or .feather file
+        kwargs: passed on to DataFrame.to_csv when writing a CSV
+    '''
+
+    fmt = table_format(fpath)
+    if fmt == 'csv':
+        df.to_csv(fpath, index=False, **kwargs)
+        return
+
+    require_pyarrow(fpath)
+    df = df.reset_index(drop=True)
+    for col in df.columns[df.dtypes == object]:
+        types = set(df[col].dropna().map(type))
+        # booleans with gaps are kept, as parquet and feather can hold those
+        if not (types <= {str} or types <= {bool}):
+            df[col] = df[col].map(lambda x: x if x is None or is_nan(x) else str(x))
+    if fmt == 'parquet':
+        df.to_parquet(fpath, index=False)
+    else:
+        df.to_feather(fpath)
+
+
+def read_flywheel_csv(fpath, required_cols=['acquisition.id'], columns=None,
+        sort_by=['acquisition.id', 'acquisition.label', 'name'], ascending=False, schema=None):
+    '''
+    Read in a query table and also ensure it's one of ours
+
+    Input:
+        fpath: path to the file; a CSV, or a parquet or feather file
         required_cols: list of columns to ensure csv is a flywheel query
+        columns: list of columns to read; all of them if None
+        sort_by: list of columns to sort the rows by; None to leave them be
+        ascending: boolean; sort in ascending order
+        schema: dict of column name to kind to read a CSV with; see read_table
     Output:
         df: a pandas dataframe
     '''
 
-    df = pd.read_csv(fpath)
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + required_cols + list(sort_by or [])))
+    df = read_table(fpath, columns, schema)
     for col in ['session.label', 'subject.label']:
-        df[col] = df[col].astype(str)
+        if col in df.columns:
+            df[col] = df[col].astype(str)
 
     if not all(elem in df.columns.tolist() for elem in required_cols):
         raise Exception(("It doesn't look like this csv is correctly formatted",
         " for this flywheel editing process!"))
     df = df.reindex(sorted(df.columns), axis=1)
-    df = df.sort_values(by=['acquisition.id', 'acquisition.label', 'name'], ascending=False).reset_index(drop=True)
+    if sort_by:
+        df = df.sort_values(by=sort_by, ascending=ascending).reset_index(drop=True)
     return(df)
 
 
+def unequal_cells_mask(df1, df2):
+    '''
+    Find which cells differ between two dataframes of the same shape
+
+    Two missing values count as equal, but a missing value and anything else
+    (including 0 or an empty string) do not.
+
+    Input:
+        df1: original pandas dataframe
+        df2: modified pandas dataframe
+    Output:
+        mask: boolean array that is True where the cells differ
+    '''
+
+    a = df1.values
+    b = df2.values
+    return (a != b) & ~(pd.isnull(a) & pd.isnull(b))
+
+
+def provenance_table(df1, df2, mask):
+    '''
+    Build a log of the cells that differ between two dataframes
+
+    Input:
+        df1: original pandas dataframe
+        df2: modified pandas dataframe
+        mask: boolean array of the cells that differ
+    Output:
+        provenance_df: one row per changed cell with its original value,
+            modified value, row index and column name
+    '''
+
+    rows, cols = np.nonzero(mask)
+    return pd.DataFrame({
+        'original': df1.values[rows, cols],
+        'modified': df2.values[rows, cols],
+        'row': df1.index.values[rows],
+        'column': df1.columns.values[cols]
+        }, columns=["original", "modified", "row", "column"])
+
+
 def get_unequal_cells(df1, df2, provenance=True):
     '''
     Compare two dataframes and return indeces where the values are not equal
@@ -66,25 +443,12 @@ def get_unequal_cells(df1, df2, provenance=True):
     if df1.shape != df2.shape:
         raise Exception("These dataframes don't have the same number of rows and columns")
     else:
-        comparison_array = df1.fillna(0).values == df2.fillna(0).values
-        indices = np.where(comparison_array == False)
-        indices = np.dstack(indices)[0].tolist()
+        mask = unequal_cells_mask(df1, df2)
+        indices = np.argwhere(mask).tolist()
 
         if provenance:
 
-            cols = ["original", "modified", "row", "column"]
-            lst = []
-
-            for pair in indices:
-
-                original = df1.iloc[pair[0], pair[1]]
-                modified = df2.iloc[pair[0], pair[1]]
-                column = df1.columns[pair[1]]
-                row = df1.index[pair[0]]
-
-                lst.append([original, modified, row, column])
-
-            provenance_df = pd.DataFrame(lst, columns=cols)
+            provenance_df = provenance_table(df1, df2, mask)
             currentDT = datetime.now()
             fname = "provenance_{}.csv".format(currentDT.strftime("%Y-%m-%d_%H:%M:%S"))
             fname_exists = os.path.isfile(fname)
@@ -100,9 +464,130 @@ def get_unequal_cells(df1, df2, provenance=True):
 
         return(indices)
 
+
+def group_ids(df, by):
+    '''
+    Number the groups of rows that share values in some columns
+
+    Input:
+        df: pandas dataframe
+        by: list of columns to group by
+    Output:
+        ids: float series of group numbers counting from 1 in the sorted
+            order of the groups; NaN for rows missing any of the columns
+    '''
+
+    # group-query stores the columns sorted, so number the groups the same
+    # way whichever order the columns are given in
+    ids = df.groupby(sorted(by)).ngroup() + 1
+    return ids.where(ids > 0).astype(float)
+
+
+def group_table(df, by):
+    '''
+    Collapse a query table to one row per group of common values
+
+    Input:
+        df: pandas dataframe
+        by: list of columns to group by
+    Output:
+        grouped: the first row of each group, with its "group_id" and the
+            "groups" it was grouped by
+    '''
+
+    df = df.copy()
+    df['group_id'] = group_ids(df, by)
+    grouped = df.drop_duplicates(by).copy()
+    grouped['groups'] = unlist_item(list(by))
+    return grouped
+
+
+def grouped_changes(df_grouped, df_grouped_modified, provenance=True):
+    '''
+    List the edits made to a grouped query table
+
+    Input:
+        df_grouped: the grouped table as written by group-query
+        df_grouped_modified: the same table after editing
+        provenance: boolean; write out a log of proposed changes
+    Output:
+        changes: dataframe of the "group_id", "column" and new "value" of
+            each edited cell
+    '''
+
+    diff = np.array(get_unequal_cells(df_grouped, df_grouped_modified, provenance), dtype=int).reshape(-1, 2)
+    rows, cols = diff[:, 0], diff[:, 1]
+    changes = pd.DataFrame({
+        'group_id': df_grouped['group_id'].values[rows],
+        'column': df_grouped_modified.columns.values[cols],
+        'value': df_grouped_modified.values[rows, cols]
+        }, columns=['group_id', 'column', 'value'])
+    # the bookkeeping columns aren't edits, and a group without an ID was
+    # never matched to any rows
+    return changes[~changes['column'].isin(['group_id', 'groups']) & changes['group_id'].notnull()]
+
+
+def ungroup_table(df, by, changes):
+    '''
+    Apply edits made to groups to every row of the full query table
+
+    Each changed column is joined to the table on the group ID, so the cost
+    grows with the number of rows and changed columns rather than with the
+    number of edits.
+
+    Input:
+        df: the full query table
+        by: list of columns the table was grouped by
+        changes: dataframe of "group_id", "column" and "value"; see
+            grouped_changes
+    Output:
+        df: a copy of the table with the edits applied
+    '''
+
+    df = df.copy()
+    ids = group_ids(df, by)
+    for column, edits in changes.groupby('column', sort=False):
+        new_values = edits.drop_duplicates('group_id', keep='last').set_index('group_id')['value']
+        edited = ids.isin(new_values.index) & ids.notnull()
+        if column not in df.columns:
+            df[column] = np.nan
+        df[column] = df[column].mask(edited, ids.map(new_values))
+    return df
+
+
 def is_nan(x):
     return (x is np.nan or x != x)
 
 
 def is_list_column(col):
     return("[" in col.to_string() and "{" not in col.to_string())
+
+
+def ordered_map(func, iterable, workers=1):
+    '''
+    Apply a function to each item of an iterable using a bounded pool of
+    worker threads, yielding the results in the same order as the input
+
+    Input:
+        func: the function to apply
+        iterable: the items to apply it to
+        workers: number of threads; 1 runs everything in the calling thread
+    Output:
+        generator of func(item) for each item
+    '''
+
+    if workers is None or workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    # only keep a few tasks per worker in flight so results don't pile up
+    window = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
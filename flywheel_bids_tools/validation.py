@@ -0,0 +1,236 @@
+import re
+import json
+import numbers
+import pandas as pd
+from collections import defaultdict
+from flywheel_bids_tools.utils import ordered_map
+
+
+# the three kinds of BIDS compliant file names
+BIDS_FILENAME_PATTERNS = [
+    r'^sub-(?P<subject_id>[a-zA-Z0-9]+)(_ses-(?P<session_id>[a-zA-Z0-9]+))?(_acq-(?P<acquisition_label>[a-zA-Z0-9]+))?(_ce-(?P<contrastenhanced_id>[a-zA-Z0-9]+))?(_rec-(?P<reconstruction_id>[a-zA-Z0-9]+))?(_run-(?P<run_id>[a-zA-Z0-9]+))?(_(?P<modality>[a-zA-Z0-9]+))?((?P<suffix>\.nii(\.gz)?))$',
+    r'^sub-(?P<subject_id>[a-zA-Z0-9]+)(_ses-(?P<session_id>[a-zA-Z0-9]+))?(_acq-(?P<acquisition_label>[a-zA-Z0-9]+))?(_ce-(?P<contrastenhanced_id>[a-zA-Z0-9]+))?(_rec-(?P<reconstruction_id>[a-zA-Z0-9]+))?(_run-(?P<run_id>[a-zA-Z0-9]+))?(_mod-(?P<modality>[a-zA-Z0-9]+))?(_(?P<suffix>[a-zA-Z0-9]+\.nii(\.gz)?))$',
+    r'^sub-(?P<subject_id>[a-zA-Z0-9]+)(_ses-(?P<session_id>[a-zA-Z0-9]+))?(_task-(?P<task_label>[a-zA-Z0-9]+))?(_acq-(?P<acquisition_label>[a-zA-Z0-9]+))?(_ce-(?P<contrastenhanced_id>[a-zA-Z0-9]+))?(_dir-(?P<direction>[a-zA-Z0-9]+))?(_rec-(?P<reconstruction_id>[a-zA-Z0-9]+))?(_run-(?P<run_id>[a-zA-Z0-9]+))?(_echo-(?P<echo_id>[a-zA-Z0-9]+))?(_(?P<contrast_label>[a-zA-Z0-9]+))?((?P<suffix>\.nii(\.gz)?))$'
+]
+
+STRING_FIELDS = ['acquisition.label', 'project.label', 'error_message',
+    'subject.label', 'folder', 'template',
+    'intendedfor', 'mod', 'path', 'rec', 'task', 'run',
+    'info_bids_error_message', 'info_sequencename',
+    'info_bids_filename', 'type', 'info_bids_folder', 'info_bids_modality',
+    'info_bids_path', 'info_bids_template', 'info_seriesdescription',
+    'classification_custom', 'info_bids_task', 'info_bids_acq',
+    'info_bids_intendedfor', 'session.label', 'subject.label'
+    ]
+
+NUMERIC_FIELDS = ['info_echotime', 'info_repetitiontime', 'info_echotime1', 'info_echotime2']
+
+# Which values each editable column accepts. Columns are looked up in lower
+# case; each rule has a "type" and, depending on the type, the "options" or
+# "patterns" it allows and the "message" shown when a value breaks it.
+BIDS_SCHEMA = {
+    'ignore': {'type': 'boolean'},
+    'valid': {'type': 'boolean'},
+    'info_bids_ignore': {'type': 'boolean'},
+
+    'modality': {
+        'type': 'choice',
+        'options': ['', 'nan', 'mr', 'ct', 'pet', 'us', 'eeg', 'ieeg', 'x-ray',
+            'ecg', 'meg', 'nirs']
+        },
+
+    'classification_measurement': {
+        'type': 'multichoice',
+        'options': ['nan', 'ASL', 'B0', 'B1', 'Diffusion',
+            'Fingerprinting', 'MT', 'PD', 'Perfusion', 'Spectroscopy',
+            'Susceptibility', 'T1', 'T2', 'T2*', 'Velocity']
+        },
+    'classification_intent': {
+        'type': 'multichoice',
+        'options': ['nan', 'Calibration', 'Fieldmap', 'Functional',
+            'Localizer', 'Non-Image', 'Screenshot', 'Shim', 'Structural']
+        },
+    'classification_features': {
+        'type': 'multichoice',
+        'options': ['nan', '3D', 'Compressed-Sensing', 'Derived',
+            'Eddy-Current-Corrected', 'Fieldmap-Corrected', 'Gradient-Unwarped',
+            'In-Plane', 'Magnitude', 'Motion-Corrected', 'Multi-Band',
+            'Multi-Echo', 'Multi-Flip', 'Multi-Shell', 'Phase',
+            'Physio-Corrected', 'Quantitative', 'Steady-State']
+        },
+
+    'filename': {'type': 'pattern', 'patterns': BIDS_FILENAME_PATTERNS},
+
+    'acquisition.id': {'type': 'readonly', 'message': "You cannot edit the acquisition ID!"}
+}
+BIDS_SCHEMA.update({x: {'type': 'string'} for x in STRING_FIELDS})
+BIDS_SCHEMA.update({x: {'type': 'number'} for x in NUMERIC_FIELDS})
+
+DEFAULT_MESSAGES = {
+    'boolean': "This field accepts booleans, these can only be written as \"True\" or \"False\"!",
+    'choice': "Items in this field must exactly match one of the available options in the drop-down menu on the website!",
+    'multichoice': "This field must match one of the available options in the drop-down menu on the website!",
+    'string': "This field only accepts strings!",
+    'number': "This field only accepts numeric types!",
+    'pattern': "This field MUST be a BIDS compliant name!",
+    'readonly': "This field can't be edited!",
+    'unknown': "Column {column} not recognised!"
+}
+
+ERROR_COLUMNS = ['row', 'column', 'value', 'rule', 'message']
+
+
+def load_schema(fpath, base=BIDS_SCHEMA):
+    '''
+    Read extra or replacement rules from a JSON file on top of a schema
+
+    Input:
+        fpath: path to a JSON object of column name to rule
+        base: the schema to extend
+    Output:
+        schema: the combined schema
+    '''
+
+    with open(fpath) as f:
+        extra = json.load(f)
+    schema = dict(base)
+    schema.update({k.lower(): v for k, v in extra.items()})
+    return schema
+
+
+class Validator(object):
+    '''
+    Check edited values against a schema of what each column accepts
+
+    The schema is compiled once, and then whole columns of changed values
+    are checked at a time.
+
+    Input:
+        schema: dict of lower case column name to rule; see BIDS_SCHEMA
+    '''
+
+    def __init__(self, schema=None):
+        self.schema = {}
+        for column, rule in (BIDS_SCHEMA if schema is None else schema).items():
+            rule = dict(rule)
+            if rule['type'] == 'choice':
+                rule['options'] = set(str(x).lower() for x in rule['options'])
+            elif rule['type'] == 'multichoice':
+                rule['options'] = set(rule['options'])
+            elif rule['type'] == 'pattern':
+                rule['patterns'] = [re.compile(x) for x in rule['patterns']]
+            rule.setdefault('message', DEFAULT_MESSAGES[rule['type']])
+            self.schema[column.lower()] = rule
+
+    def rule_for(self, column):
+        '''
+        The rule for a column; columns without one get an "unknown" rule
+        '''
+
+        # only the exact acquisition.id column is read only
+        rule = self.schema.get(column.lower())
+        if rule is None or (rule['type'] == 'readonly' and column.lower() != column):
+            return {'type': 'unknown', 'message': DEFAULT_MESSAGES['unknown'].format(column=column)}
+        return rule
+
+    def check_values(self, column, values):
+        '''
+        Check a column of values
+
+        Input:
+            column: the name of the column
+            values: pandas series of the values to check
+        Output:
+            valid: boolean series, True where the value is acceptable
+            rule: the rule the values were checked against
+        '''
+
+        rule = self.rule_for(column)
+        kind = rule['type']
+        # missing values are always acceptable
+        missing = values.isnull()
+
+        if kind == 'boolean':
+            valid = values.astype(str).str.lower().isin(['true', 'false'])
+        elif kind == 'choice':
+            valid = values.astype(str).str.lower().isin(list(rule['options']))
+        elif kind == 'multichoice':
+            options = rule['options']
+            is_list = values.map(lambda x: isinstance(x, list)).astype(bool)
+            valid = pd.Series(False, index=values.index)
+            valid[~is_list] = values[~is_list].isin(list(options))
+            valid[is_list] = values[is_list].map(lambda x: set(x) <= options)
+        elif kind == 'string':
+            valid = values.map(lambda x: isinstance(x, str))
+        elif kind == 'number':
+            if pd.api.types.is_numeric_dtype(values):
+                valid = pd.Series(True, index=values.index)
+            else:
+                valid = values.map(lambda x: isinstance(x, numbers.Number))
+        elif kind == 'pattern':
+            text = values.astype(str)
+            valid = pd.Series(False, index=values.index)
+            for pattern in rule['patterns']:
+                valid |= text.str.match(pattern).fillna(False).astype(bool)
+        else:
+            valid = pd.Series(False, index=values.index)
+
+        return valid.astype(bool) | missing, rule
+
+    def check(self, value, column):
+        '''
+        Check a single value
+
+        Output:
+            valid: boolean; True if the value is acceptable
+            rule: the rule it was checked against
+        '''
+
+        valid, rule = self.check_values(column, pd.Series([value], dtype=object))
+        return bool(valid.iloc[0]), rule
+
+    def validate(self, df, change_index, workers=1):
+        '''
+        Check every changed cell of an edited query
+
+        Columns are independent of each other, so they can be checked by
+        several worker threads at once.
+
+        Input:
+            df: the edited query
+            change_index: the row-column pairs (as positions) of changed cells
+            workers: number of columns to check at once
+        Output:
+            errors: dataframe with a row for each invalid cell giving its
+                row position, column name, value, rule and message
+        '''
+
+        by_column = defaultdict(list)
+        for row, col in change_index:
+            by_column[col].append(row)
+
+        def check_column(item):
+            col, rows = item
+            column = df.columns[col]
+            values = df.iloc[rows, col]
+            valid, rule = self.check_values(column, values)
+            bad = ~valid.values
+            return pd.DataFrame({
+                'row': [r for r, b in zip(rows, bad) if b],
+                'column': column,
+                'value': values.values[bad],
+                'rule': rule['type'],
+                'message': rule['message']
+                }, columns=ERROR_COLUMNS)
+
+        errors = [
+            x for x in ordered_map(check_column, sorted(by_column.items()), workers)
+            if not x.empty
+            ]
+        if not errors:
+            return pd.DataFrame(columns=ERROR_COLUMNS)
+        errors = pd.concat(errors, ignore_index=True)
+        # report them in the order of the cells in the table
+        positions = errors['column'].map(df.columns.get_loc)
+        order = sorted(range(len(errors)), key=lambda i: (errors['row'].iat[i], positions.iat[i]))
+        return errors.iloc[order].reset_index(drop=True)
@@ -13,6 +13,10 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/PennBBL/bids-on-flywheel",
     packages=setuptools.find_packages(),
+    extras_require={
+        # reading and writing .parquet and .feather tables
+        'parquet': ['pyarrow']
+    },
     classifiers=[
         "Programming Language :: Python :: 2.7",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,73 @@
+'''
+Micro-benchmark of the query-bids column filter
+
+Compares searching every key of every flattened file record with the
+column pattern (the old behaviour) against query_bids.ColumnFilter, on a
+synthetic project of flattened file records.
+
+Usage:
+    python benchmark_column_filter.py [--files 100000] [--keys 200]
+'''
+import sys
+import re
+import time
+import random
+import argparse
+sys.path.append("..")
+from flywheel_bids_tools.query_bids import ColumnFilter, column_pattern
+
+
+def synthetic_records(n_files, n_keys, seed=0):
+    '''
+    Make flattened file records drawing their keys from a fixed pool of
+    column names, like the info headers of a real project
+    '''
+
+    rng = random.Random(seed)
+    pool = ['name', 'type', 'modality', 'acquisition.id', 'acquisition.label',
+            'session.label', 'subject.label', 'classification_Intent',
+            'info_BIDS_Filename', 'info_BIDS_Folder', 'info_EchoTime',
+            'info_SeriesDescription']
+    pool += ['info_Header{}'.format(i) for i in range(n_keys * 2)]
+    return [
+        {k: i for k in pool[:12] + rng.sample(pool[12:], n_keys - 12)}
+        for i in range(n_files)
+        ]
+
+
+def search_every_key(records, target_cols=None):
+    cols = column_pattern(target_cols)
+    return [{k: v for k, v in r.items() if re.search(cols, k)} for r in records]
+
+
+def column_filter(records, target_cols=None):
+    select = ColumnFilter(target_cols)
+    return [select(r) for r in records]
+
+
+def time_it(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the query-bids column filter")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--keys", type=int, default=200)
+    args = parser.parse_args()
+
+    records = synthetic_records(args.files, args.keys)
+    print("{} files, {} keys each".format(args.files, args.keys))
+
+    for label, target_cols in [('default', None), ('target_cols', ['info_Header1', 'EchoTime'])]:
+        old_time, old = time_it(search_every_key, records, target_cols)
+        new_time, new = time_it(column_filter, records, target_cols)
+        assert old == new
+        print("{:<12} re.search: {:7.2f}s  ColumnFilter: {:7.2f}s  speedup: {:.1f}x".format(
+            label, old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''
+Benchmark of group-query and ungroup-query
+
+Compares the old per-group loops against utils.group_table,
+utils.grouped_changes and utils.ungroup_table on a large synthetic query
+table, with a column edited in some of its groups.
+
+Usage:
+    python benchmark_grouping.py [--rows 500000] [--groups 20000] [--edited 10000]
+'''
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+sys.path.append("..")
+from flywheel_bids_tools.utils import group_table, grouped_changes, ungroup_table, unequal_cells_mask
+
+GROUPS = ['info_EchoTime', 'info_SeriesDescription']
+
+
+def synthetic_table(n_rows, n_groups, seed=0):
+    '''
+    Make a query-like table whose rows fall into about n_groups groups of
+    series description and echo time, a few of them missing the description
+    '''
+
+    rng = np.random.RandomState(seed)
+    group = rng.randint(0, n_groups, n_rows)
+    description = np.array(['series{}'.format(i // 2) for i in range(n_groups)], dtype=object)[group]
+    description[rng.rand(n_rows) < 0.001] = np.nan
+    return pd.DataFrame({
+        'acquisition.id': ['acq{}'.format(i) for i in range(n_rows)],
+        'acquisition.label': 'label',
+        'info_SeriesDescription': description,
+        'info_EchoTime': (group % 2) * 0.03,
+        'info_BIDS_Folder': rng.choice(['anat', 'func', np.nan], n_rows),
+        'info_BIDS_Task': np.full(n_rows, np.nan, dtype=object)
+        })
+
+
+def edit_groups(grouped, n_edited, seed=0):
+    rng = np.random.RandomState(seed)
+    modified = grouped.copy()
+    rows = rng.choice(len(grouped), min(n_edited, len(grouped)), replace=False)
+    modified.iloc[rows, modified.columns.get_loc('info_BIDS_Task')] = 'edited'
+    return modified
+
+
+def old_group(query_result, group):
+    query_result = query_result.copy()
+    query_result['group_id'] = float('nan')
+    grouped_df = query_result.groupby(group).groups
+    id = 1
+    for name, df in grouped_df.items():
+        index = df.to_list()
+        query_result.loc[index, 'group_id'] = id
+        id += 1
+    query_result = query_result.drop_duplicates(group)
+    query_result['groups'] = ', '.join(sorted(group))
+    return query_result
+
+
+def old_ungroup(df_grouped, df_grouped_modified, df_original, groups):
+    df_original = df_original.copy()
+    df_original['group_id'] = float('nan')
+    grouped_df = df_original.groupby(groups).groups
+    id = 1
+    for name, df in grouped_df.items():
+        index = df.to_list()
+        df_original.loc[index, 'group_id'] = id
+        id += 1
+    diff = np.argwhere(unequal_cells_mask(df_grouped, df_grouped_modified)).tolist()
+    changes = []
+    for x in diff:
+        key = df_grouped_modified.iloc[x[0]]['group_id']
+        val = (df_grouped_modified.columns[x[1]], df_grouped_modified.iloc[x[0], x[1]])
+        changes.append((key, val))
+    for change in changes:
+        df_original.loc[df_original['group_id'] == change[0], change[1][0]] = change[1][1]
+    return df_original.drop(columns='group_id')
+
+
+def new_ungroup(df_grouped, df_grouped_modified, df_original, groups):
+    changes = grouped_changes(df_grouped, df_grouped_modified, provenance=False)
+    return ungroup_table(df_original, groups, changes)
+
+
+def time_it(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark group-query and ungroup-query")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--groups", type=int, default=20000)
+    parser.add_argument("--edited", type=int, default=10000)
+    args = parser.parse_args()
+
+    df = synthetic_table(args.rows, args.groups)
+
+    old_time, old_grouped = time_it(old_group, df, GROUPS)
+    new_time, new_grouped = time_it(group_table, df, GROUPS)
+    assert old_grouped['group_id'].equals(new_grouped['group_id'])
+    print("{} rows, {} groups".format(args.rows, len(new_grouped)))
+    print("group:   loop: {:7.2f}s  vectorized: {:7.2f}s  speedup: {:.1f}x".format(
+        old_time, new_time, old_time / new_time))
+
+    modified = edit_groups(new_grouped, args.edited)
+    old_time, old = time_it(old_ungroup, new_grouped, modified, df, GROUPS)
+    new_time, new = time_it(new_ungroup, new_grouped, modified, df, GROUPS)
+    assert old.astype(str).equals(new.astype(str))
+    print("ungroup: loop: {:7.2f}s  vectorized: {:7.2f}s  speedup: {:.1f}x  ({} groups edited, {} rows changed)".format(
+        old_time, new_time, old_time / new_time, args.edited, int((new['info_BIDS_Task'] == 'edited').sum())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Benchmark of reading a query table back in
+
+Writes a large synthetic query with query_bids.write_query_csv, which also
+writes its schema sidecar, then compares reading it the old way (pandas
+guessing every column's type) against utils.read_flywheel_csv with the
+schema, both for every column and for only the columns autofill-bids needs.
+
+Usage:
+    python benchmark_read_query.py [--rows 400000] [--keep]
+'''
+import sys
+import os
+import time
+import random
+import argparse
+import tempfile
+import pandas as pd
+sys.path.append("..")
+from flywheel_bids_tools.query_bids import write_query_csv
+from flywheel_bids_tools.utils import read_flywheel_csv, PYARROW_CSV
+
+# the columns autofill-bids reads
+COLUMNS = ['acquisition.id', 'name', 'session.label', 'subject.label',
+    'info_BIDS_IntendedFor', 'info_BIDS_Folder', 'info_BIDS_Filename',
+    'info_SeriesDescription', 'info_EchoTime1', 'info_EchoTime2']
+
+
+def synthetic_chunks(n_rows, files_per_acquisition=4, n_headers=30, seed=0):
+    '''
+    Make acquisitions of query records, with a mix of text, numeric, boolean,
+    list and sparse columns like a real project's
+    '''
+
+    rng = random.Random(seed)
+    for a in range(n_rows // files_per_acquisition):
+        acq = '5c{:022x}'.format(a)
+        records = []
+        for f in range(files_per_acquisition):
+            record = {
+                'acquisition.id': acq,
+                'acquisition.label': 'series_{}'.format(a % 40),
+                'name': '{}_{}.nii.gz'.format(acq, f),
+                'session.label': '{:04d}'.format(a // 10),
+                'subject.label': '{:05d}'.format(a // 20),
+                'type': 'nifti',
+                'modality': 'MR',
+                'classification_Intent': ['Structural'] if f % 2 else ['Functional'],
+                'info_BIDS_Folder': rng.choice(['anat', 'func', 'fmap']),
+                'info_BIDS_Filename': 'sub-{}_ses-{}_run-{}_bold.nii.gz'.format(a // 20, a // 10, f),
+                'info_BIDS_ignore': False,
+                'info_SeriesDescription': 'series_{}'.format(a % 40),
+                'info_EchoTime': rng.choice([0.0025, 0.03, 0.005]),
+                'info_RepetitionTime': 2,
+                'size': rng.randint(10 ** 5, 10 ** 8),
+            }
+            if f == 0:
+                record['info_BIDS_IntendedFor'] = "[{'Folder': 'func'}]"
+                record['info_EchoTime1'] = 0.00412
+                record['info_EchoTime2'] = 0.00658
+            for h in range(n_headers):
+                record['info_Header{}'.format(h)] = rng.random() if h % 3 else 'value{}'.format(h)
+            records.append(record)
+        yield acq, records
+
+
+def old_read(fpath):
+    df = pd.read_csv(fpath)
+    df['session.label'] = df['session.label'].astype(str)
+    df['subject.label'] = df['subject.label'].astype(str)
+    return df.sort_values(by=['acquisition.id', 'acquisition.label', 'name'], ascending=False)
+
+
+def time_it(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark reading a query table")
+    parser.add_argument("--rows", type=int, default=400000)
+    parser.add_argument("--keep", action='store_true', help="Keep the synthetic query file")
+    args = parser.parse_args()
+
+    fpath = os.path.join(tempfile.mkdtemp(), 'query.csv')
+    write_query_csv(synthetic_chunks(args.rows), fpath)
+    print("{} rows, {:.0f}MB (pyarrow parser {}available)".format(
+        args.rows, os.path.getsize(fpath) / 1e6, '' if PYARROW_CSV else 'not '))
+
+    old_time, old = time_it(old_read, fpath)
+    new_time, new = time_it(read_flywheel_csv, fpath)
+    subset_time, subset = time_it(read_flywheel_csv, fpath, columns=COLUMNS)
+    assert new.shape == old.shape and subset.shape[0] == old.shape[0]
+    print("guessing types: {:7.2f}s".format(old_time))
+    print("with schema:    {:7.2f}s  speedup: {:.1f}x".format(new_time, old_time / new_time))
+    print("{} columns:     {:7.2f}s  speedup: {:.1f}x".format(subset.shape[1], subset_time, old_time / subset_time))
+    print("labels with leading zeros kept: {}".format(new['session.label'].iloc[-1]))
+
+    if args.keep:
+        print("Kept {}".format(fpath))
+    else:
+        for x in os.listdir(os.path.dirname(fpath)):
+            os.remove(os.path.join(os.path.dirname(fpath), x))
+        os.rmdir(os.path.dirname(fpath))
+
+
+if __name__ == '__main__':
+    main()
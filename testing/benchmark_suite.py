@@ -0,0 +1,146 @@
+'''
+End-to-end benchmark of the command-line tools against a fake flywheel
+
+Runs query-bids, group-query, ungroup-query, upload-bids and autofill-bids
+one after the other on synthetic projects of each size, as a curation round
+would: query the project, group it, edit one group, ungroup the edit and
+upload it, then fill in the fieldmaps' IntendedFor and echo times. For each
+tool it reports the flywheel calls made, the wall time and the peak memory
+traced. With --throttle, some of the calls are refused with a 429, and the
+rows query-bids writes show whether any were lost.
+
+The gear tools need a gear exchange, which the fake doesn't serve, so they
+aren't included.
+
+Usage:
+    python benchmark_suite.py [--sizes 1000 10000 100000] [--workers 8] [--latency 0.0] [--throttle 0.0] [--no-memory]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import pandas as pd
+sys.path.append("..")
+from fake_flywheel import FakeClient, SyntheticProject
+from flywheel_bids_tools import query_bids, group_query, ungroup_query, upload_bids, autopopulate_bids_fields
+from flywheel_bids_tools.client import set_client, reset_client
+
+# the group of the grouped query the benchmark edits
+EDITED_GROUP = {'info_SeriesDescription': 'MPRAGE', 'type': 'nifti'}
+
+
+def run_main(main, argv):
+    '''
+    Run a tool's main as if from the command line, keeping its output quiet
+    '''
+
+    sys.argv = argv
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            try:
+                main()
+            except SystemExit:
+                pass
+
+
+def edit_grouped(fpath, output):
+    '''
+    Make an edit to one group of a grouped query
+    '''
+
+    df = pd.read_csv(fpath, dtype=str)
+    edited = (df['info_SeriesDescription'] == EDITED_GROUP['info_SeriesDescription']) & \
+        (df['type'] == EDITED_GROUP['type'])
+    df.loc[edited, 'info_BIDS_Acq'] = 'mprage'
+    df.to_csv(output, index=False)
+
+
+def measure(client, stage, memory, *args):
+    '''
+    Run a stage and report the calls it made, its wall time and peak memory
+    '''
+
+    calls = client.call_count()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    stage(*args)
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if memory else float('nan')
+    if memory:
+        tracemalloc.stop()
+    return client.call_count() - calls, wall, peak / 1e6
+
+
+def run_suite(n_acquisitions, workers, latency, memory, throttle=0.0):
+    '''
+    Run every tool against a synthetic project of this many acquisitions
+
+    Output:
+        results: list of (tool, calls, wall seconds, peak MB)
+        rows: the number of rows query-bids wrote
+    '''
+
+    client = FakeClient([SyntheticProject('synthetic', acquisitions=n_acquisitions)],
+                        latency=latency, throttle=throttle)
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    set_client(client)
+    w = str(workers)
+    stages = [
+        ('query-bids', run_main, query_bids.main,
+            ['query-bids', '-proj', 'synthetic', '-output', 'query.csv', '--workers', w]),
+        ('group-query', run_main, group_query.main,
+            ['group-query', '-input', 'query.csv', '-output', 'grouped.csv', '-groups', 'info_SeriesDescription', 'type']),
+        ('(edit)', edit_grouped, 'grouped.csv', 'grouped_edited.csv'),
+        ('ungroup-query', run_main, ungroup_query.main,
+            ['ungroup-query', '-grouped', 'grouped.csv', '-mod', 'grouped_edited.csv', '-orig', 'query.csv', '-output', 'edited.csv']),
+        ('upload-bids', run_main, upload_bids.main,
+            ['upload-bids', '-orig', 'query.csv', '-mod', 'edited.csv', '--workers', w]),
+        ('autofill-bids', run_main, autopopulate_bids_fields.main,
+            ['autofill-bids', '-input', 'edited.csv', '--workers', w])
+    ]
+    results = []
+    try:
+        for stage in stages:
+            name, func, args = stage[0], stage[1], stage[2:]
+            calls, wall, peak = measure(client, func, memory, *args)
+            if name != '(edit)':
+                results.append((name, calls, wall, peak))
+        rows = len(pd.read_csv('query.csv', usecols=['acquisition.id']))
+    finally:
+        reset_client()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return results, rows
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark every tool against a fake flywheel")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Numbers of acquisitions in the synthetic projects")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds each flywheel call takes")
+    parser.add_argument("--throttle", type=float, default=0.0,
+                        help="Fraction of flywheel calls to refuse with a 429")
+    parser.add_argument("--no-memory", action='store_false', dest='memory',
+                        help="Don't trace memory, which slows everything down")
+    args = parser.parse_args()
+
+    print("{:>8} {:<14} {:>8} {:>9} {:>9}".format('acqs', 'tool', 'calls', 'wall (s)', 'peak (MB)'))
+    for n in args.sizes:
+        results, rows = run_suite(n, args.workers, args.latency, args.memory, args.throttle)
+        for name, calls, wall, peak in results:
+            print("{:>8} {:<14} {:>8} {:>9.2f} {:>9.1f}".format(n, name, calls, wall, peak))
+        print("{:>8} query-bids wrote {} rows".format(n, rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Benchmark of the cell diff behind upload-bids and ungroup-query
+
+Compares the old per-cell provenance loop against utils.provenance_table
+on a large synthetic query table with a bulk edit applied to it.
+
+Usage:
+    python benchmark_unequal_cells.py [--rows 100000] [--changes 50000]
+'''
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+sys.path.append("..")
+from flywheel_bids_tools.utils import unequal_cells_mask, provenance_table
+
+
+def synthetic_tables(n_rows, n_changes, seed=0):
+    '''
+    Make a query-like table and a copy with n_changes cells edited, some
+    of them from 0 to blank
+    '''
+
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'acquisition.id': ['acq{}'.format(i) for i in range(n_rows)],
+        'info_BIDS_Folder': rng.choice(['anat', 'func', 'fmap', np.nan], n_rows),
+        'info_BIDS_Task': rng.choice(['rest', 'nback', np.nan], n_rows),
+        'info_EchoTime': rng.choice([0.0025, 0.03, 0.0, np.nan], n_rows),
+        'classification_Intent': rng.choice(['Structural', 'Functional', np.nan], n_rows)
+        })
+    modified = df.copy()
+    cols = rng.randint(1, df.shape[1], n_changes)
+    rows = rng.choice(n_rows, n_changes, replace=False)
+    for col in np.unique(cols):
+        target = rows[cols == col]
+        if df.columns[col] == 'info_EchoTime':
+            modified.iloc[target, col] = np.where(df.iloc[target, col] == 0.0, np.nan, 0.05)
+        else:
+            modified.iloc[target, col] = 'edited'
+    return df, modified
+
+
+def old_provenance(df1, df2):
+    comparison_array = df1.fillna(0).values == df2.fillna(0).values
+    indices = np.dstack(np.where(comparison_array == False))[0].tolist()
+    lst = []
+    for pair in indices:
+        original = df1.iloc[pair[0], pair[1]]
+        modified = df2.iloc[pair[0], pair[1]]
+        column = df1.columns[pair[1]]
+        row = df1.index[pair[0]]
+        lst.append([original, modified, row, column])
+    return pd.DataFrame(lst, columns=["original", "modified", "row", "column"])
+
+
+def new_provenance(df1, df2):
+    return provenance_table(df1, df2, unequal_cells_mask(df1, df2))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the cell diff")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--changes", type=int, default=50000)
+    args = parser.parse_args()
+
+    df1, df2 = synthetic_tables(args.rows, args.changes)
+
+    start = time.perf_counter()
+    old = old_provenance(df1, df2)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = new_provenance(df1, df2)
+    new_time = time.perf_counter() - start
+
+    print("{} rows, {} cells edited".format(args.rows, args.changes))
+    print("loop: {:7.2f}s ({} cells)  vectorized: {:7.2f}s ({} cells)  speedup: {:.1f}x".format(
+        old_time, len(old), new_time, len(new), old_time / new_time))
+    print("edits from 0 to blank hidden by fillna(0): {}".format(len(new) - len(old)))
+
+
+if __name__ == '__main__':
+    main()
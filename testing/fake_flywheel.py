@@ -0,0 +1,587 @@
+'''
+An in-process stand-in for the flywheel SDK client
+
+FakeClient implements the parts of flywheel.Client that flywheel_bids_tools
+uses, serving one or more synthetic projects from memory. Every request is
+sent through client.api_client.call_api, as it is with the real SDK, so
+anything wrapped around call_api (request_policy, for one) sees the same traffic.
+Calls are counted per endpoint, and a latency can be injected into each one
+to stand in for the network.
+
+Containers are generated from their IDs when they're asked for, and only
+the changes made to files are stored, so a project of 100k acquisitions
+costs next to nothing to hold.
+
+Usage:
+    from fake_flywheel import FakeClient, SyntheticProject
+    fw = FakeClient([SyntheticProject('synthetic', acquisitions=1000)], latency=0.01)
+    query_bids.query_fw(fw, 'synthetic')
+    print(fw.api_client.calls)
+'''
+import copy
+import time
+import random
+import datetime
+import threading
+from collections import Counter
+
+MODIFIED = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+# every synthetic session runs through this protocol in order: the BIDS
+# folder, suffix, series description, intent, measurement and task
+PROTOCOL = [
+    ('anat', 'T1w', 'MPRAGE', 'Structural', 'T1', None),
+    ('func', 'bold', 'BOLD_rest', 'Functional', 'T2*', 'rest'),
+    ('func', 'bold', 'BOLD_nback', 'Functional', 'T2*', 'nback'),
+    ('fmap', 'phasediff', 'B0map', 'Fieldmap', 'B0', None),
+    ('dwi', 'dwi', 'DTI_64dir', 'Structural', 'Diffusion', None),
+    ('anat', 'T2w', 'T2_SPACE', 'Structural', 'T2', None),
+    ('func', 'sbref', 'BOLD_rest_SBRef', 'Functional', 'T2*', 'rest'),
+    ('anat', 'FLAIR', 'FLAIR', 'Structural', 'T2', None)
+]
+
+
+class SyntheticProject(object):
+    '''
+    The shape of a synthetic project
+
+    Input:
+        label: the project label
+        acquisitions: the number of acquisitions in the project
+        acquisitions_per_session: how many acquisitions each session has
+        sessions_per_subject: how many sessions each subject has
+        files_per_acquisition: a DICOM archive and this many minus one NIfTIs
+        info_keys: the number of extra DICOM header fields in each file's info
+        listing_info: boolean; whether acquisitions listed under a session
+            come with their files' info, or only say it exists
+    '''
+
+    def __init__(self, label, acquisitions=1000, acquisitions_per_session=8,
+                 sessions_per_subject=2, files_per_acquisition=2, info_keys=20,
+                 listing_info=True):
+        self.label = label
+        self.acquisitions = acquisitions
+        self.acquisitions_per_session = acquisitions_per_session
+        self.sessions_per_subject = sessions_per_subject
+        self.files_per_acquisition = files_per_acquisition
+        self.info_keys = info_keys
+        self.listing_info = listing_info
+
+    @property
+    def sessions(self):
+        return -(-self.acquisitions // self.acquisitions_per_session)
+
+    @property
+    def subjects(self):
+        return -(-self.sessions // self.sessions_per_subject)
+
+
+class FakeModel(object):
+    '''
+    A container or file, whose fields can be read as attributes or items
+    like an SDK model. Like the SDK's, it isn't a dict itself; its info and
+    classification are.
+    '''
+
+    # fields that are models of their own in the SDK
+    NESTED = ('parents', 'subject')
+
+    def __init__(self, client, data):
+        self._client = client
+        self._data = {k: FakeModel(client, v) if k in self.NESTED and isinstance(v, dict) else v
+                      for k, v in data.items()}
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return self._data.get(key)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def to_dict(self):
+        return {k: v.to_dict() if isinstance(v, FakeModel) else copy.deepcopy(v) for k, v in self._data.items()}
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self._data.get('id', self._data.get('name')))
+
+
+class Finder(object):
+    '''
+    A listing of child containers that can be called or searched, like
+    project.sessions in the SDK
+    '''
+
+    def __init__(self, client, resource_path, path_params=None):
+        self._client = client
+        self._resource_path = resource_path
+        self._path_params = path_params or {}
+
+    def __call__(self):
+        return self.find()
+
+    def find(self, *filters):
+        query_params = [('filter', ','.join(filters))] if filters else []
+        return self._client._call(self._resource_path, 'GET', self._path_params, query_params)
+
+    def find_first(self, *filters):
+        found = self.find(*filters)
+        return found[0] if found else None
+
+    def find_one(self, *filters):
+        found = self.find(*filters)
+        if len(found) != 1:
+            raise ValueError("Found {} results, expected exactly one".format(len(found)))
+        return found[0]
+
+    def iter(self):
+        return iter(self.find())
+
+
+class FakeFile(FakeModel):
+
+    def update_info(self, info):
+        return self._client.modify_acquisition_file_info(self._parent, self['name'], {'set': info})
+
+
+class FakeAcquisition(FakeModel):
+
+    def __init__(self, client, data):
+        super(FakeAcquisition, self).__init__(client, data)
+        files = []
+        for f in self._data.get('files', []):
+            f = FakeFile(client, f)
+            f._parent = self['id']
+            files.append(f)
+        self._data['files'] = files
+
+    def update_file_info(self, file_name, info):
+        return self._client.modify_acquisition_file_info(self['id'], file_name, {'set': info})
+
+    def replace_file_classification(self, file_name, classification, modality=None):
+        body = {'replace': classification, 'modality': modality}
+        return self._client.modify_acquisition_file_classification(self['id'], file_name, body)
+
+
+class FakeSession(FakeModel):
+
+    @property
+    def acquisitions(self):
+        return Finder(self._client, '/sessions/{SessionId}/acquisitions', {'SessionId': self['id']})
+
+
+class FakeSubject(FakeModel):
+
+    @property
+    def sessions(self):
+        return Finder(self._client, '/subjects/{SubjectId}/sessions', {'SubjectId': self['id']})
+
+
+class FakeProject(FakeModel):
+
+    @property
+    def subjects(self):
+        return Finder(self._client, '/projects/{ProjectId}/subjects', {'ProjectId': self['id']})
+
+    @property
+    def sessions(self):
+        return Finder(self._client, '/projects/{ProjectId}/sessions', {'ProjectId': self['id']})
+
+
+MODELS = {
+    'project': FakeProject,
+    'subject': FakeSubject,
+    'session': FakeSession,
+    'acquisition': FakeAcquisition
+}
+
+
+def parse_filters(query_params):
+    '''
+    Turn a filter query parameter like 'label="x",code=y' into pairs
+    '''
+
+    filters = []
+    for name, value in query_params or []:
+        if name != 'filter':
+            continue
+        for term in value.split(','):
+            key, _, target = term.partition('=')
+            filters.append((key.strip(), target.strip().strip('"')))
+    return filters
+
+
+def matches(record, filters):
+    for key, target in filters:
+        value = record
+        for part in key.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if str(value) != target:
+            return False
+    return True
+
+
+class FakeSite(object):
+    '''
+    The server side: generates containers on request and keeps the changes
+    made to files, and when each acquisition was last changed
+    '''
+
+    def __init__(self, projects):
+        self.projects = list(projects)
+        self.files = {}
+        self.modified = {}
+        self._lock = threading.Lock()
+        self.routes = {
+            ('GET', '/projects'): self.list_projects,
+            ('GET', '/projects/{ProjectId}/subjects'): self.list_subjects,
+            ('GET', '/projects/{ProjectId}/sessions'): self.list_project_sessions,
+            ('GET', '/subjects/{SubjectId}/sessions'): self.list_subject_sessions,
+            ('GET', '/sessions/{SessionId}/acquisitions'): self.list_acquisitions,
+            ('GET', '/containers/{ContainerId}'): self.get_container,
+            ('POST', '/acquisitions/{AcquisitionId}/files/{FileName}/info'): self.modify_file_info,
+            ('POST', '/acquisitions/{AcquisitionId}/files/{FileName}/classification'): self.modify_file_classification,
+            ('POST', '/views/data'): self.view_data
+        }
+
+    def handle(self, resource_path, method, path_params, query_params, body):
+        try:
+            handler = self.routes[(method, resource_path)]
+        except KeyError:
+            raise NotImplementedError("{} {} isn't served by the fake".format(method, resource_path))
+        return handler(path_params, query_params, body)
+
+    # containers
+
+    def parse_id(self, container_id):
+        parts = container_id.split('-')
+        try:
+            indices = [int(x[1:]) for x in parts]
+            project = self.projects[indices[0]]
+        except (ValueError, IndexError):
+            raise KeyError("Not found: {}".format(container_id))
+        return project, indices
+
+    def project(self, p):
+        project = self.projects[p]
+        return {'container_type': 'project', 'id': 'p{}'.format(p), 'label': project.label,
+                'modified': MODIFIED}
+
+    def subject(self, p, u):
+        return {'container_type': 'subject', 'id': 'p{}-u{}'.format(p, u), 'label': '{:04d}'.format(u + 1),
+                'code': '{:04d}'.format(u + 1), 'project': 'p{}'.format(p),
+                'parents': {'project': 'p{}'.format(p)}, 'modified': MODIFIED}
+
+    def session(self, p, u, s):
+        project = self.projects[p]
+        subject = self.subject(p, u)
+        return {'container_type': 'session', 'id': 'p{}-u{}-s{}'.format(p, u, s),
+                'label': '{:04d}{:02d}'.format(u + 1, s + 1), 'project': 'p{}'.format(p),
+                'subject': {'id': subject['id'], 'label': subject['label'], 'code': subject['code']},
+                'parents': {'project': 'p{}'.format(p), 'subject': subject['id']},
+                'timestamp': MODIFIED, 'modified': MODIFIED}
+
+    def session_acquisitions(self, p, u, s):
+        project = self.projects[p]
+        first = (u * project.sessions_per_subject + s) * project.acquisitions_per_session
+        return max(0, min(project.acquisitions_per_session, project.acquisitions - first))
+
+    def acquisition(self, p, u, s, a, with_info=True):
+        project = self.projects[p]
+        folder, suffix, description, intent, measurement, task = PROTOCOL[a % len(PROTOCOL)]
+        acq_id = 'p{}-u{}-s{}-a{}'.format(p, u, s, a)
+        sub = '{:04d}'.format(u + 1)
+        ses = '{:04d}{:02d}'.format(u + 1, s + 1)
+        headers = {
+            'SeriesDescription': description,
+            'EchoTime': 0.03 if folder == 'func' else 0.0025,
+            'RepetitionTime': 2.0 if folder == 'func' else 2.3,
+            'ShimSetting': [a % 3, 1, 2],
+        }
+        if folder == 'fmap':
+            headers.update({'EchoTime1': 0.00412, 'EchoTime2': 0.00658})
+        for i in range(project.info_keys):
+            headers['Header{}'.format(i)] = (a * 31 + i) % 97 / 10.0 if i % 2 else 'value{}'.format(i % 5)
+
+        files = []
+        for f in range(project.files_per_acquisition):
+            if f == 0:
+                name, kind, info = '{}.dicom.zip'.format(description), 'dicom', dict(headers)
+            else:
+                name, kind = '{}_{}.nii.gz'.format(description, f), 'nifti'
+                filename = 'sub-{}_ses-{}{}_run-{}_{}.nii.gz'.format(
+                    sub, ses, '' if task is None else '_task-{}'.format(task), f, suffix)
+                bids = {'Filename': filename, 'Folder': folder, 'Modality': suffix,
+                        'Path': 'sub-{}/ses-{}/{}'.format(sub, ses, folder), 'Run': f,
+                        'Task': task or '', 'Acq': '', 'ignore': False, 'valid': True,
+                        'error_message': '', 'template': '{}_file'.format(folder)}
+                if folder == 'fmap':
+                    bids['IntendedFor'] = [{'Folder': 'func'}]
+                info = dict(headers, BIDS=bids)
+            record = {'name': name, 'type': kind, 'modality': 'MR', 'size': 1000 + (a * 7919 + f) % 100000,
+                      'classification': {'Intent': [intent], 'Measurement': [measurement]},
+                      'info': info, 'info_exists': True, 'modified': MODIFIED}
+            changed = self.files.get((acq_id, name))
+            if changed is not None:
+                record.update(copy.deepcopy(changed))
+            if not with_info:
+                record['info'] = {}
+            files.append(record)
+
+        return {'container_type': 'acquisition', 'id': acq_id, 'label': description,
+                'session': 'p{}-u{}-s{}'.format(p, u, s),
+                'parents': {'project': 'p{}'.format(p), 'subject': 'p{}-u{}'.format(p, u),
+                            'session': 'p{}-u{}-s{}'.format(p, u, s)},
+                'timestamp': MODIFIED, 'modified': self.modified.get(acq_id, MODIFIED), 'files': files}
+
+    def all_sessions(self, p):
+        project = self.projects[p]
+        for u in range(project.subjects):
+            for s in range(project.sessions_per_subject):
+                if self.session_acquisitions(p, u, s):
+                    yield u, s
+
+    def get_container(self, path_params, query_params, body):
+        project, indices = self.parse_id(path_params['ContainerId'])
+        p = indices[0]
+        if len(indices) == 1:
+            return self.project(p)
+        if indices[1] >= project.subjects:
+            raise KeyError("Not found: {}".format(path_params['ContainerId']))
+        if len(indices) == 2:
+            return self.subject(*indices)
+        if not self.session_acquisitions(*indices[:3]):
+            raise KeyError("Not found: {}".format(path_params['ContainerId']))
+        if len(indices) == 3:
+            return self.session(*indices)
+        if indices[3] >= self.session_acquisitions(*indices[:3]):
+            raise KeyError("Not found: {}".format(path_params['ContainerId']))
+        return self.acquisition(*indices)
+
+    # listings
+
+    def list_projects(self, path_params, query_params, body):
+        filters = parse_filters(query_params)
+        found = (self.project(p) for p in range(len(self.projects)))
+        return [x for x in found if matches(x, filters)]
+
+    def list_subjects(self, path_params, query_params, body):
+        project, (p,) = self.parse_id(path_params['ProjectId'])
+        filters = parse_filters(query_params)
+        found = (self.subject(p, u) for u in range(project.subjects))
+        return [x for x in found if matches(x, filters)]
+
+    def list_project_sessions(self, path_params, query_params, body):
+        project, (p,) = self.parse_id(path_params['ProjectId'])
+        filters = parse_filters(query_params)
+        found = (self.session(p, u, s) for u, s in self.all_sessions(p))
+        return [x for x in found if matches(x, filters)]
+
+    def list_subject_sessions(self, path_params, query_params, body):
+        project, (p, u) = self.parse_id(path_params['SubjectId'])
+        filters = parse_filters(query_params)
+        found = (self.session(p, u, s) for s in range(project.sessions_per_subject)
+                 if self.session_acquisitions(p, u, s))
+        return [x for x in found if matches(x, filters)]
+
+    def list_acquisitions(self, path_params, query_params, body):
+        project, (p, u, s) = self.parse_id(path_params['SessionId'])
+        filters = parse_filters(query_params)
+        found = (self.acquisition(p, u, s, a, project.listing_info)
+                 for a in range(self.session_acquisitions(p, u, s)))
+        return [x for x in found if matches(x, filters)]
+
+    # changes
+
+    def find_file(self, acquisition_id, file_name):
+        acquisition = self.get_container({'ContainerId': acquisition_id}, None, None)
+        for f in acquisition['files']:
+            if f['name'] == file_name:
+                return f
+        raise KeyError("Not found: {}/{}".format(acquisition_id, file_name))
+
+    def modify_file_info(self, path_params, query_params, body):
+        key = (path_params['AcquisitionId'], path_params['FileName'])
+        with self._lock:
+            info = self.find_file(*key)['info']
+            if 'replace' in body:
+                info = dict(body['replace'])
+            info.update(body.get('set', {}))
+            for k in body.get('delete', []):
+                info.pop(k, None)
+            self.files.setdefault(key, {})['info'] = copy.deepcopy(info)
+            self.touch(*key)
+        return None
+
+    def modify_file_classification(self, path_params, query_params, body):
+        key = (path_params['AcquisitionId'], path_params['FileName'])
+        with self._lock:
+            f = self.find_file(*key)
+            changed = self.files.setdefault(key, {})
+            if 'replace' in body:
+                changed['classification'] = copy.deepcopy(body['replace'])
+            if body.get('modality') is not None:
+                changed['modality'] = body['modality']
+            self.touch(*key)
+        return None
+
+    def touch(self, acquisition_id, file_name):
+        # as on flywheel, changing a file changes its acquisition too
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.files[(acquisition_id, file_name)]['modified'] = now
+        self.modified[acquisition_id] = now
+
+    # data views
+
+    def view_data(self, path_params, query_params, body):
+        container_id = dict(query_params)['containerId']
+        project, indices = self.parse_id(container_id)
+        p = indices[0]
+        level = body['columns'][0] if body.get('columns') else 'acquisition'
+        rows = []
+        for u, s in self.all_sessions(p):
+            if len(indices) > 1 and indices[1:] != [u, s][:len(indices) - 1]:
+                continue
+            subject, session = self.subject(p, u), self.session(p, u, s)
+            row = {'project.id': 'p{}'.format(p), 'project.label': project.label,
+                   'subject.id': subject['id'], 'subject.label': subject['label']}
+            if level == 'subject':
+                if s == 0:
+                    rows.append(row)
+                continue
+            row.update({'session.id': session['id'], 'session.label': session['label']})
+            if level == 'session':
+                rows.append(row)
+                continue
+            for a in range(self.session_acquisitions(p, u, s)):
+                acquisition = self.acquisition(p, u, s, a, with_info=False)
+                rows.append(dict(row, **{'acquisition.id': acquisition['id'],
+                                         'acquisition.label': acquisition['label']}))
+        return rows
+
+
+class FakeApiClient(object):
+    '''
+    Stands in for the SDK's ApiClient: every request passes through
+    call_api, which counts it, waits out the injected latency and has the
+    site answer it
+
+    Input:
+        site: the FakeSite to send requests to
+        latency: seconds to wait on each call, or a function of the
+            resource path and method giving the seconds to wait
+        throttle: the fraction of calls to refuse with a 429, as a busy
+            server would
+        seed: seed for choosing which calls to refuse
+    '''
+
+    def __init__(self, site, latency=0.0, throttle=0.0, seed=0):
+        self.site = site
+        self.latency = latency
+        self.throttle = throttle
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call_api(self, resource_path, method, path_params=None, query_params=None,
+                 header_params=None, body=None, post_params=None, files=None,
+                 response_type=None, auth_settings=None, **kwargs):
+        with self._lock:
+            self.calls['{} {}'.format(method, resource_path)] += 1
+            throttled = self._random.random() < self.throttle
+        delay = self.latency(resource_path, method) if callable(self.latency) else self.latency
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            raise ApiException(429, 'Too Many Requests')
+        try:
+            return self.site.handle(resource_path, method, path_params or {}, query_params, body)
+        except KeyError as e:
+            raise ApiException(404, e.args[0])
+
+
+class FakeClient(object):
+    '''
+    Stands in for flywheel.Client
+
+    Input:
+        projects: list of SyntheticProjects to serve; one project labelled
+            "synthetic" of 1000 acquisitions by default
+        latency: seconds to wait on each call, or a function of the resource
+            path and method giving the seconds to wait
+        throttle: the fraction of calls to refuse with a 429
+    '''
+
+    def __init__(self, projects=None, latency=0.0, throttle=0.0):
+        self.site = FakeSite(projects or [SyntheticProject('synthetic')])
+        self.api_client = FakeApiClient(self.site, latency, throttle)
+
+    def _call(self, resource_path, method='GET', path_params=None, query_params=None, body=None):
+        data = self.api_client.call_api(resource_path, method, path_params=path_params,
+                                        query_params=query_params, body=body)
+        return self._wrap(data)
+
+    def _wrap(self, data):
+        if isinstance(data, list):
+            return [self._wrap(x) for x in data]
+        if isinstance(data, dict) and 'container_type' in data:
+            return MODELS[data['container_type']](self, data)
+        return data
+
+    @property
+    def projects(self):
+        return Finder(self, '/projects')
+
+    def get(self, container_id):
+        return self._call('/containers/{ContainerId}', 'GET', {'ContainerId': container_id})
+
+    get_acquisition = get_session = get_subject = get_project = get
+
+    def modify_acquisition_file_info(self, acquisition_id, file_name, body):
+        return self._call('/acquisitions/{AcquisitionId}/files/{FileName}/info', 'POST',
+                          {'AcquisitionId': acquisition_id, 'FileName': file_name}, body=body)
+
+    def modify_acquisition_file_classification(self, acquisition_id, file_name, body):
+        return self._call('/acquisitions/{AcquisitionId}/files/{FileName}/classification', 'POST',
+                          {'AcquisitionId': acquisition_id, 'FileName': file_name}, body=body)
+
+    def View(self, columns=None, **kwargs):
+        if isinstance(columns, str):
+            columns = [columns]
+        return dict(kwargs, columns=columns or [])
+
+    def read_view_data(self, view, container_id):
+        return self._call('/views/data', 'POST', query_params=[('containerId', container_id)], body=view)
+
+    def read_view_dataframe(self, view, container_id):
+        import pandas as pd
+        return pd.DataFrame(self.read_view_data(view, container_id))
+
+    def call_count(self):
+        return sum(self.api_client.calls.values())
+
+
+class ApiException(Exception):
+    '''
+    Raised for a request the site can't answer, like the SDK's ApiException
+    '''
+
+    def __init__(self, status, reason):
+        super(ApiException, self).__init__("({}) {}".format(status, reason))
+        self.status = status
+        self.reason = reason
@@ -0,0 +1,1007 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import importlib.util
+import threading
+import pytest
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+sys.path.append("..")
+from fake_flywheel import FakeClient, SyntheticProject
+from fake_flywheel import ApiException as FakeApiException
+from flywheel_bids_tools import query_bids, group_query, ungroup_query, upload_bids, autopopulate_bids_fields
+from flywheel_bids_tools.cache import ContainerCache
+from flywheel_bids_tools.validation import Validator
+from flywheel_bids_tools.ratelimit import RequestPolicy, CircuitBreaker, CircuitOpen, backoff_delay, request_policy
+from flywheel_bids_tools.cassette import Cassette, CassetteMiss, use_cassette
+from flywheel_bids_tools import client as shared_client
+from flywheel_bids_tools.instrument import Metrics, instrument, report_metrics
+from flywheel_bids_tools.client import set_client, reset_client, client_for, get_client, pool_connections
+from flywheel_bids_tools.utils import read_flywheel_csv, read_schema, read_table, read_table_header, write_table
+from flywheel_bids_tools.utils import unequal_cells_mask, get_unequal_cells
+
+'''
+==========={flywheel-bids-tools offline testing suite}===========
+The same tools, run against the in-process fake flywheel in
+fake_flywheel.py, so no server or credentials are needed
+=================================================================
+'''
+
+
+@pytest.fixture()
+def fw():
+    return FakeClient([SyntheticProject('synthetic', acquisitions=24)])
+
+
+@pytest.fixture()
+def shared(fw, tmp_path, monkeypatch):
+    '''
+    Run in a scratch directory, with the fake as the tools' client
+    '''
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(upload_bids, 'FAILS', [])
+    monkeypatch.setattr(autopopulate_bids_fields, 'FAILS', [])
+    set_client(fw)
+    yield fw
+    reset_client()
+
+
+def run_main(main, *argv):
+    sys.argv = list(argv)
+    main()
+
+
+def read_rows(fpath):
+    with open(fpath, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+'''
+=========================================================
+1. ContainerCache
+=========================================================
+'''
+
+def test_cache_fetches_each_container_once(fw):
+
+    cache = ContainerCache(fw)
+    first = cache.get('p0-u0-s0')
+    assert cache.get('p0-u0-s0') is first
+    assert fw.api_client.calls['GET /containers/{ContainerId}'] == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.label('p0-u0') == '0001'
+
+
+def test_cache_evicts_least_recently_used(fw):
+
+    cache = ContainerCache(fw, maxsize=2)
+    cache.get('p0-u0-s0')
+    cache.get('p0-u0-s1')
+    cache.get('p0-u0-s0')
+    cache.get('p0-u1-s0')
+    assert len(cache) == 2
+    assert 'p0-u0-s0' in cache and 'p0-u0-s1' not in cache
+
+
+def test_cache_shares_concurrent_fetches():
+
+    fw = FakeClient([SyntheticProject('synthetic', acquisitions=24)], latency=0.05)
+    cache = ContainerCache(fw)
+    threads = [threading.Thread(target=cache.get, args=('p0-u0-s0',)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert fw.api_client.calls['GET /containers/{ContainerId}'] == 1
+
+
+def test_cache_does_not_keep_failures(fw):
+
+    cache = ContainerCache(fw)
+    for _ in range(2):
+        with pytest.raises(FakeApiException):
+            cache.get('p0-u99')
+    assert cache.misses == 2
+    assert len(cache) == 0
+
+
+'''
+=========================================================
+2. Validator
+=========================================================
+'''
+
+@pytest.mark.parametrize("column, value, valid", [
+    ('info_BIDS_ignore', 'True', True),
+    ('info_BIDS_ignore', 'yes', False),
+    ('modality', 'MR', True),
+    ('modality', 'MRI', False),
+    ('classification_Intent', ['Structural', 'Functional'], True),
+    ('classification_Intent', ['Structural', 'Anatomical'], False),
+    ('Filename', 'sub-01_ses-01_run-1_T1w.nii.gz', True),
+    ('Filename', 'T1w.nii.gz', False),
+    ('info_EchoTime', 0.03, True),
+    ('info_EchoTime', '0.03', False),
+    ('info_BIDS_Acq', None, True),
+    ('acquisition.id', 'abc', False),
+    ('not_a_column', 'x', False)
+])
+def test_validator_check(column, value, valid):
+
+    assert Validator().check(value, column)[0] is valid
+
+
+def test_validator_reports_cells_in_order():
+
+    df = pd.DataFrame({
+        'info_BIDS_ignore': ['True', 'maybe', 'False'],
+        'modality': ['MR', 'MR', 'XX']
+        })
+    errors = Validator().validate(df, [(2, 1), (1, 0), (0, 0), (2, 0)], workers=2)
+    assert list(zip(errors['row'], errors['column'])) == [(1, 'info_BIDS_ignore'), (2, 'modality')]
+    assert list(errors['rule']) == ['boolean', 'choice']
+
+
+'''
+=========================================================
+3. UploadJournal and --resume
+=========================================================
+'''
+
+def acquisition_plan(fw, acq_value):
+
+    acq = fw.get('p0-u0-s0-a0')
+    entry = {
+        'acquisition.id': acq.id, 'name': acq.files[1].name,
+        'subject.label': '0001', 'session.label': '000101',
+        'classification': None, 'modality': None, 'modality_changed': False,
+        'bids': {'Acq': acq_value}
+        }
+    return {'acquisitions': [{'acquisition.id': acq.id, 'files': [entry]}]}
+
+
+def posts(fw):
+    return sum(v for k, v in fw.api_client.calls.items() if k.startswith('POST'))
+
+
+def test_journal_records_updates(shared):
+
+    fw = shared
+    plan = acquisition_plan(fw, 'mprage')
+    upload_bids.apply_plan(plan, fw, journal=upload_bids.UploadJournal('journal.jsonl', plan))
+    assert fw.get('p0-u0-s0-a0').files[1]['info']['BIDS']['Acq'] == 'mprage'
+    records = [json.loads(line) for line in open('journal.jsonl')]
+    assert [(x['fields'], x['status']) for x in records] == [('bids', 'applied')]
+    assert records[0]['plan'] == upload_bids.plan_hash(plan)
+
+
+def test_resume_skips_journalled_updates(shared):
+
+    fw = shared
+    plan = acquisition_plan(fw, 'mprage')
+    upload_bids.apply_plan(plan, fw, journal=upload_bids.UploadJournal('journal.jsonl', plan))
+    # a crash can leave half a line behind
+    with open('journal.jsonl', 'a') as f:
+        f.write('{"plan": ')
+
+    sent = posts(fw)
+    upload_bids.apply_plan(plan, fw, journal=upload_bids.UploadJournal('journal.jsonl', plan), resume=True)
+    assert posts(fw) == sent
+
+
+def test_resume_is_scoped_to_the_plan(shared):
+
+    fw = shared
+    plan = acquisition_plan(fw, 'mprage')
+    upload_bids.apply_plan(plan, fw, journal=upload_bids.UploadJournal('journal.jsonl', plan))
+    # put flywheel back as it was, then upload a different plan that sends
+    # the same values, sharing the journal
+    fw.modify_acquisition_file_info('p0-u0-s0-a0', plan['acquisitions'][0]['files'][0]['name'],
+                                    {'set': {'BIDS': dict(fw.get('p0-u0-s0-a0').files[1]['info']['BIDS'], Acq='')}})
+    other = acquisition_plan(fw, 'mprage')
+    other['acquisitions'][0]['files'][0]['session.label'] = 'another'
+    journal = upload_bids.UploadJournal('journal.jsonl', other)
+    assert upload_bids.remaining_plan(other, journal) == {'acquisitions': other['acquisitions']}
+
+    sent = posts(fw)
+    upload_bids.apply_plan(other, fw, journal=journal, resume=True)
+    assert posts(fw) == sent + 1
+
+
+def test_journal_path_follows_the_plan(fw):
+
+    assert upload_bids.journal_path(acquisition_plan(fw, 'a')) != upload_bids.journal_path(acquisition_plan(fw, 'b'))
+    assert upload_bids.journal_path(acquisition_plan(fw, 'a')) == upload_bids.journal_path(acquisition_plan(fw, 'a'))
+
+
+'''
+=========================================================
+4. group-query and ungroup-query
+=========================================================
+'''
+
+@pytest.fixture()
+def queried(shared):
+
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'query.csv', '--workers', '4')
+    return 'query.csv'
+
+
+def test_group_ungroup_round_trip(queried):
+
+    run_main(group_query.main, 'group-query', '-input', queried, '-output', 'grouped.csv',
+             '-groups', 'info_SeriesDescription', 'type')
+    grouped = pd.read_csv('grouped.csv', dtype=str)
+    assert len(grouped) == len(grouped[['info_SeriesDescription', 'type']].drop_duplicates())
+
+    edited = (grouped['info_SeriesDescription'] == 'MPRAGE') & (grouped['type'] == 'nifti')
+    grouped.loc[edited, 'info_BIDS_Acq'] = 'mprage'
+    grouped.to_csv('grouped_edited.csv', index=False)
+    run_main(ungroup_query.main, 'ungroup-query', '-grouped', 'grouped.csv', '-mod', 'grouped_edited.csv',
+             '-orig', queried, '-output', 'edited.csv')
+
+    # read the edit the way upload-bids does, with the original's schema
+    schema = read_schema(queried)
+    original = read_flywheel_csv(queried, schema=schema)
+    result = read_flywheel_csv('edited.csv', schema=schema)
+    assert list(result.columns) == list(original.columns)
+    assert len(result) == len(original)
+    in_group = (result['info_SeriesDescription'] == 'MPRAGE') & (result['type'] == 'nifti')
+    assert in_group.any()
+    assert (result.loc[in_group, 'info_BIDS_Acq'] == 'mprage').all()
+    pd.testing.assert_frame_equal(result.loc[~in_group], original.loc[~in_group])
+
+
+def test_ungroup_without_edits_changes_nothing(queried):
+
+    run_main(group_query.main, 'group-query', '-input', queried, '-output', 'grouped.csv',
+             '-groups', 'info_SeriesDescription', 'type')
+    run_main(ungroup_query.main, 'ungroup-query', '-grouped', 'grouped.csv', '-mod', 'grouped.csv',
+             '-orig', queried, '-output', 'edited.csv')
+    schema = read_schema(queried)
+    pd.testing.assert_frame_equal(read_flywheel_csv('edited.csv', schema=schema),
+                                  read_flywheel_csv(queried, schema=schema))
+
+
+'''
+=========================================================
+5. RequestPolicy
+=========================================================
+'''
+
+class Flaky(object):
+    '''
+    A request that fails with each of the given statuses before succeeding
+    '''
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.statuses:
+            raise FakeApiException(self.statuses.pop(0), 'failed')
+        return 'ok'
+
+
+def test_backoff_delay_is_capped():
+
+    for attempt in range(12):
+        assert 0 <= backoff_delay(attempt, 0.5, 2.0) <= min(2.0, 0.5 * 2 ** attempt)
+
+
+def test_policy_retries_transient_failures():
+
+    request = Flaky(503, 429)
+    assert RequestPolicy(retries=2, backoff=0).call(request) == 'ok'
+    assert request.calls == 3
+
+
+def test_policy_gives_up_after_its_retries():
+
+    request = Flaky(500, 500, 500)
+    with pytest.raises(FakeApiException):
+        RequestPolicy(retries=1, backoff=0).call(request)
+    assert request.calls == 2
+
+
+def test_policy_does_not_retry_client_errors():
+
+    request = Flaky(404)
+    with pytest.raises(FakeApiException):
+        RequestPolicy(retries=5, backoff=0).call(request)
+    assert request.calls == 1
+
+
+def test_breaker_opens_and_recovers():
+
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    policy = RequestPolicy(retries=0, backoff=0, breaker=breaker)
+    for _ in range(2):
+        with pytest.raises(FakeApiException):
+            policy.call(Flaky(503))
+
+    request = Flaky()
+    with pytest.raises(CircuitOpen):
+        policy.call(request)
+    assert request.calls == 0
+
+    # once the cooldown is over, a trial request is let through
+    breaker.opened -= 61
+    assert policy.call(request) == 'ok'
+    assert breaker.opened is None
+
+
+def test_breaker_closes_on_a_client_error():
+
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    policy = RequestPolicy(retries=0, backoff=0, breaker=breaker)
+    with pytest.raises(FakeApiException):
+        policy.call(Flaky(503))
+    with pytest.raises(FakeApiException):
+        policy.call(Flaky(404))
+    assert breaker.opened is None
+
+
+def test_policy_rides_out_throttling():
+
+    fw = FakeClient([SyntheticProject('synthetic', acquisitions=24)], throttle=0.3)
+    request_policy(fw, concurrency=4, retries=20, backoff=0)
+    acquisitions = query_bids.query_fw(fw, 'synthetic', workers=4)
+    assert len(acquisitions) == 24
+    # a project, its sessions and three listings, plus the refused calls
+    assert fw.call_count() > 5
+
+
+'''
+=========================================================
+6. Cassettes
+=========================================================
+'''
+
+class ApiException(Exception):
+    '''
+    Like the SDK's, made from a response; the cassette raises whichever
+    ApiException the rest client's module has
+    '''
+
+    def __init__(self, status=None, reason=None, http_resp=None):
+        super(ApiException, self).__init__(status, reason)
+        if http_resp is not None:
+            status, reason = http_resp.status, http_resp.reason
+            self.headers, self.body = http_resp.getheaders(), http_resp.data
+        self.status = status
+        self.reason = reason
+
+
+class Response(object):
+
+    def __init__(self, status, data):
+        self.status = status
+        self.reason = 'OK' if status == 200 else 'Not Found'
+        self.data = data
+
+    def getheaders(self):
+        return {'Content-Type': 'application/json'}
+
+
+class RestClient(object):
+    '''
+    Answers requests from a FakeSite, over "HTTP"
+    '''
+
+    def __init__(self, fw):
+        self.fw = fw
+        self.requests = 0
+
+    def request(self, method, url, query_params=None, headers=None, body=None,
+                post_params=None, _preload_content=True, _request_timeout=None):
+        self.requests += 1
+        container_id = url.rsplit('/', 1)[-1]
+        try:
+            data = self.fw.site.get_container({'ContainerId': container_id}, None, None)
+        except KeyError:
+            e = ApiException(404, 'Not Found')
+            e.headers, e.body = {}, b''
+            raise e
+        return Response(200, json.dumps(data, default=str).encode('utf8'))
+
+
+def http_client(rest_client):
+    api_client = SimpleNamespace(rest_client=rest_client,
+                                 configuration=SimpleNamespace(host='https://flywheel.test/api'))
+    return SimpleNamespace(api_client=api_client)
+
+
+def test_cassette_replays_what_it_recorded(fw, tmp_path):
+
+    path = str(tmp_path / 'session.jsonl.gz')
+    live = RestClient(fw)
+    recorder = use_cassette(http_client(live), path, 'record')
+    recorded = live.request('GET', 'https://flywheel.test/api/containers/p0-u0-s0',
+                       headers={'Authorization': 'scitran-user secret'}).data
+    with pytest.raises(ApiException):
+        live.request('GET', 'https://flywheel.test/api/containers/p0-u99')
+    recorder.close()
+    assert live.requests == 2
+    with gzip.open(path, 'rt') as f:
+        assert 'secret' not in f.read()
+
+    offline = RestClient(fw)
+    replayer = use_cassette(http_client(offline), path, 'replay', latency_scale=0)
+    assert replayer.host == 'https://flywheel.test/api'
+    # matched on the path whatever the host
+    response = offline.request('GET', 'https://elsewhere.test/api/containers/p0-u0-s0')
+    assert response.data == recorded
+    with pytest.raises(ApiException) as e:
+        offline.request('GET', 'https://flywheel.test/api/containers/p0-u99')
+    assert e.value.status == 404
+    with pytest.raises(CassetteMiss):
+        offline.request('GET', 'https://flywheel.test/api/containers/p0-u1')
+    assert offline.requests == 0
+
+
+def test_cassette_serves_repeats_in_order(tmp_path):
+
+    path = str(tmp_path / 'repeats.jsonl.gz')
+    cassette = Cassette(path, 'record', host='https://flywheel.test/api')
+    for n in range(2):
+        cassette.record('GET /x? ', 200, 'OK', {}, str(n), 0.0)
+    cassette.close()
+
+    cassette = Cassette(path, 'replay', latency_scale=0)
+    assert [cassette.replay('GET /x? ')['data'] for _ in range(3)] == ['0', '1', '1']
+
+
+'''
+=========================================================
+7. query-bids --resume and --since
+=========================================================
+'''
+
+class Interrupted(Exception):
+    pass
+
+
+def test_resume_picks_up_where_a_query_stopped(queried, monkeypatch):
+
+    full = open(queried).read()
+    iter_query_records = query_bids.iter_query_records
+    asked = []
+
+    def dies_after(n):
+        def wrapped(client, acquisitions, *args, **kwargs):
+            asked.append(len(acquisitions))
+            for i, chunk in enumerate(iter_query_records(client, acquisitions, *args, **kwargs)):
+                if i == n:
+                    raise Interrupted()
+                yield chunk
+        return wrapped
+
+    monkeypatch.setattr(query_bids, 'iter_query_records', dies_after(10))
+    with pytest.raises(Interrupted):
+        run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'resumed.csv')
+    assert os.path.isfile('resumed.csv.checkpoint')
+
+    monkeypatch.setattr(query_bids, 'iter_query_records', dies_after(None))
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'resumed.csv', '--resume')
+    assert asked == [24, 14]
+    assert not os.path.isfile('resumed.csv.checkpoint')
+    assert open('resumed.csv').read() == full
+
+
+def test_since_only_fetches_what_changed(queried, fw, monkeypatch):
+
+    plan = acquisition_plan(fw, 'mprage')
+    upload_bids.apply_plan(plan, fw)
+
+    iter_query_records = query_bids.iter_query_records
+    asked = []
+
+    def counted(client, acquisitions, *args, **kwargs):
+        asked.append([query_bids.acquisition_id(x) for x in acquisitions])
+        return iter_query_records(client, acquisitions, *args, **kwargs)
+
+    monkeypatch.setattr(query_bids, 'iter_query_records', counted)
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'merged.csv', '--since', queried)
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'fresh.csv')
+    assert asked[0] == ['p0-u0-s0-a0']
+    assert open('merged.csv').read() == open('fresh.csv').read()
+    # zero padded labels are carried over as they were
+    assert set(x['subject.label'] for x in read_rows('merged.csv')) == {'0001', '0002'}
+
+
+def test_since_needs_a_recorded_start(queried):
+
+    os.remove('{}.schema.json'.format(queried))
+    with pytest.raises(ValueError):
+        run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'merged.csv', '--since', queried)
+
+
+'''
+=========================================================
+8. Sending a plan's updates
+=========================================================
+'''
+
+def file_entry(acq, f, bids=None, classification=None):
+    return {
+        'acquisition.id': acq.id, 'name': f.name,
+        'subject.label': '0001', 'session.label': '000101',
+        'classification': classification, 'modality': None, 'modality_changed': False,
+        'bids': bids
+        }
+
+
+def test_files_without_bids_info_are_updated(shared):
+
+    fw = shared
+    acq = fw.get('p0-u0-s0-a0')
+    dicom, nifti = acq.files
+    assert 'BIDS' not in dicom['info']
+    entries = [file_entry(acq, dicom, bids={'ignore': True}),
+               file_entry(acq, nifti, bids={'Acq': 'mprage'}, classification={'Features': ['3D']})]
+    upload_bids.apply_plan({'acquisitions': [{'acquisition.id': acq.id, 'files': entries}]}, fw)
+
+    assert upload_bids.FAILS == []
+    dicom, nifti = fw.get('p0-u0-s0-a0').files
+    assert dicom['info']['BIDS'] == {'ignore': True}
+    assert nifti['info']['BIDS']['Acq'] == 'mprage'
+    assert nifti['classification']['Features'] == ['3D']
+
+
+def test_one_bad_file_does_not_sink_the_acquisition(shared, monkeypatch):
+
+    fw = shared
+    acq = fw.get('p0-u0-s0-a0')
+    dicom, nifti = acq.files
+    file_updates = upload_bids.file_updates
+
+    def fails_for_dicoms(fw_object, f, entry, journal=None):
+        if f.name == dicom.name:
+            raise ValueError("unreadable")
+        return file_updates(fw_object, f, entry, journal)
+
+    monkeypatch.setattr(upload_bids, 'file_updates', fails_for_dicoms)
+    entries = [file_entry(acq, dicom, bids={'ignore': True}), file_entry(acq, nifti, bids={'Acq': 'mprage'})]
+    upload_bids.apply_plan({'acquisitions': [{'acquisition.id': acq.id, 'files': entries}]}, fw)
+
+    assert [x['name'] for x in upload_bids.FAILS] == [dicom.name]
+    assert [x['name'] for x in read_rows('failed_to_upload.csv')] == [dicom.name]
+    assert fw.get('p0-u0-s0-a0').files[1]['info']['BIDS']['Acq'] == 'mprage'
+
+
+'''
+=========================================================
+9. autofill-bids IntendedFor
+=========================================================
+'''
+
+def intention_table(shims=(None, None, None, None)):
+    # a fieldmap and three NIfTIs in one session, and one in another
+    return pd.DataFrame({
+        'acquisition.id': ['fmap', 'rest', 'dwi', 'nback', 'other'],
+        'name': ['fmap.nii.gz', 'rest.nii.gz', 'dwi.nii.gz', 'nback.nii.gz', 'rest.nii.gz'],
+        'type': ['nifti'] * 5,
+        'subject.label': ['01'] * 5,
+        'session.label': ['a', 'a', 'a', 'a', 'b'],
+        'info_BIDS_Folder': ['fmap', 'func', 'dwi', 'func', 'func'],
+        'info_BIDS_Filename': ['fmap.nii.gz', 'rest.nii.gz', 'dwi.nii.gz', 'nback.nii.gz', 'rest.nii.gz'],
+        'info_BIDS_IntendedFor': ["[{'Folder': 'dwi'}, {'Folder': 'func'}, {'Folder': 'dwi'}]", None, None, None, None],
+        'info_ShimSetting': list(shims) + [shims[0]]
+        })
+
+
+def test_intended_folders_keep_their_order():
+
+    for _ in range(3):
+        assert autopopulate_bids_fields.intended_folders(
+            "[{'Folder': 'func'}, {'Folder': 'dwi'}, {'Folder': 'func'}, {'Folder': 'anat'}]") == ['func', 'dwi', 'anat']
+
+
+def test_resolve_intentions():
+
+    intentions, fails = autopopulate_bids_fields.resolve_intentions(intention_table())
+    assert fails.empty
+    assert list(intentions['acquisition.id']) == ['fmap']
+    assert intentions['files'].iloc[0] == ['ses-a/dwi/dwi.nii.gz', 'ses-a/func/rest.nii.gz', 'ses-a/func/nback.nii.gz']
+
+
+def test_resolve_intentions_matching_shims():
+
+    df = intention_table(shims=('1_2', '1_2', '3_4', '3_4'))
+    intentions, fails = autopopulate_bids_fields.resolve_intentions(df, match_shim=True)
+    assert intentions['files'].iloc[0] == ['ses-a/func/rest.nii.gz']
+
+    df = intention_table(shims=('1_2', '3_4', '3_4', '3_4'))
+    intentions, fails = autopopulate_bids_fields.resolve_intentions(df, match_shim=True)
+    assert intentions.empty
+    assert list(fails['error']) == ["No matching files for this shim setting"]
+
+
+def test_resolve_intentions_without_matches():
+
+    df = intention_table().iloc[[0, 4]]
+    intentions, fails = autopopulate_bids_fields.resolve_intentions(df)
+    assert intentions.empty
+    assert list(fails['error']) == ["No matching files"]
+
+
+def test_autofill_matching_shims(queried, fw):
+
+    run_main(autopopulate_bids_fields.main, 'autofill-bids', '-input', queried, '--match-shim')
+    # the fieldmap of the first session only shares its shim setting with
+    # the single-band reference
+    fieldmap = fw.get('p0-u0-s0-a3').files[1]
+    assert fieldmap['info']['IntendedFor'] == ['ses-000101/func/sub-0001_ses-000101_task-rest_run-1_sbref.nii.gz']
+
+
+def test_autofill_match_shim_needs_the_column(queried):
+
+    pd.read_csv(queried, dtype=str).drop(columns=['info_ShimSetting']).to_csv('no_shims.csv', index=False)
+    with pytest.raises(ValueError, match='info_ShimSetting'):
+        run_main(autopopulate_bids_fields.main, 'autofill-bids', '-input', 'no_shims.csv', '--match-shim')
+
+
+def test_echo_times_are_sent_once_per_acquisition(queried, fw):
+
+    df = read_flywheel_csv(queried)
+    fmaps = df.dropna(subset=['info_EchoTime1']).copy()
+    fmaps['info_EchoTime1'] = 0.005
+    fmaps['info_EchoTime2'] = 0.0075
+    before = fw.api_client.calls['GET /containers/{ContainerId}']
+    autopopulate_bids_fields.update_echo_times(fmaps, fw, workers=4)
+
+    acquisitions = fmaps['acquisition.id'].unique()
+    assert len(acquisitions) > 1
+    assert fw.api_client.calls['GET /containers/{ContainerId}'] - before == len(acquisitions)
+    for acq_id, name in zip(fmaps['acquisition.id'], fmaps['name']):
+        f = [x for x in fw.get(acq_id).files if x.name == name][0]
+        assert (f['info']['EchoTime1'], f['info']['EchoTime2']) == (0.005, 0.0075)
+    assert len(read_rows('successful_echotime_updates.csv')) == len(fmaps)
+    assert autopopulate_bids_fields.FAILS == []
+
+
+def test_echo_times_for_missing_files_fail_alone(queried, fw):
+
+    df = read_flywheel_csv(queried)
+    fmaps = df.dropna(subset=['info_EchoTime1']).head(2).copy()
+    fmaps.iloc[0, fmaps.columns.get_loc('name')] = 'missing.nii.gz'
+    autopopulate_bids_fields.update_echo_times(fmaps, fw)
+
+    assert [x['name'] for x in autopopulate_bids_fields.FAILS] == ['missing.nii.gz']
+    assert [x['name'] for x in read_rows('failed_to_update_echotimes.csv')] == ['missing.nii.gz']
+    assert len(read_rows('successful_echotime_updates.csv')) == 1
+
+
+'''
+=========================================================
+10. query-bids
+=========================================================
+'''
+
+def test_progress_bar_finishes(fw, capsys):
+
+    acquisitions = query_bids.query_fw(fw, 'synthetic')
+    chunks = list(query_bids.iter_query_records(fw, acquisitions, workers=4))
+    assert len(chunks) == 24
+    assert '24/24' in capsys.readouterr().err
+
+
+def test_hydrate_lists_without_fetching_acquisitions(queried, fw):
+
+    before = fw.api_client.calls.copy()
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'hydrated.csv', '--hydrate')
+    calls = fw.api_client.calls - before
+    assert calls['GET /containers/{ContainerId}'] == 0
+    assert calls['GET /sessions/{SessionId}/acquisitions'] == 3
+    pd.testing.assert_frame_equal(read_flywheel_csv('hydrated.csv'), read_flywheel_csv(queried))
+
+
+def test_hydrated_records_carry_their_labels(fw):
+
+    records = query_bids.query_fw(fw, 'synthetic', hydrate=True)
+    assert len(records) == 24
+    record = [x for x in records if x['acquisition.id'] == 'p0-u0-s0-a0'][0]
+    assert (record['subject.label'], record['session.label']) == ('0001', '000101')
+    assert [f.name for f in record['files']] == [f.name for f in fw.get('p0-u0-s0-a0').files]
+
+
+'''
+=========================================================
+11. Table formats
+=========================================================
+'''
+
+@pytest.mark.parametrize("fmt", ['parquet', 'feather'])
+def test_query_formats_read_back_like_csv(queried, fmt):
+
+    output = 'query.' + fmt
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', output, '--workers', '4')
+    csv_table = read_flywheel_csv(queried)
+    table = read_flywheel_csv(output)
+    assert list(table.columns) == list(csv_table.columns)
+    # a CSV can't tell an empty string from a missing value; the others can
+    pd.testing.assert_frame_equal(table.replace('', None), csv_table, check_dtype=False)
+    assert read_table_header(output) == read_table_header(queried)
+
+
+def test_schema_sidecar_types_the_csv(queried):
+
+    schema = read_schema(queried)
+    assert schema['acquisition.id'] == 'str'
+    assert set(schema) <= set(read_table_header(queried))
+    table = read_table(queried)
+    assert pd.api.types.is_string_dtype(table['acquisition.id'])
+
+
+def test_missing_columns_are_left_out(queried):
+
+    table = read_table(queried, columns=['acquisition.id', 'not_a_column'])
+    assert list(table.columns) == ['acquisition.id']
+
+
+def test_formats_without_pyarrow_name_the_extra(tmp_path, monkeypatch):
+
+    real_find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec',
+                        lambda name, *args: None if name == 'pyarrow' else real_find_spec(name, *args))
+    with pytest.raises(ImportError, match=r'flywheel-bids-tools\[parquet\]'):
+        write_table(pd.DataFrame({'a': [1]}), str(tmp_path / 'table.parquet'))
+    with pytest.raises(ImportError, match=r'flywheel-bids-tools\[parquet\]'):
+        read_table_header(str(tmp_path / 'table.feather'))
+    write_table(pd.DataFrame({'a': [1]}), str(tmp_path / 'table.csv'))
+
+
+'''
+=========================================================
+12. upload-bids plans
+=========================================================
+'''
+
+def edit_query(queried, column, value, rows):
+    '''
+    Set a column of some rows of a query, as someone editing it would, and
+    return the acquisitions and names of their files
+    '''
+
+    df = pd.read_csv(queried, dtype=str, keep_default_na=False)
+    df.loc[rows, column] = value
+    df.to_csv('edited.csv', index=False)
+    return list(zip(df.loc[rows, 'acquisition.id'], df.loc[rows, 'name']))
+
+
+def test_plan_counts_requests_without_sending_them(queried, fw):
+
+    df = pd.read_csv(queried, dtype=str)
+    niftis = df.index[df['name'].str.endswith('.nii.gz')]
+    edit_query(queried, 'info_BIDS_Acq', 'mprage', niftis[:3])
+    before = fw.call_count()
+    with pytest.raises(SystemExit):
+        run_main(upload_bids.main, 'upload-bids', '-orig', queried, '-mod', 'edited.csv',
+                 '--plan', 'plan.json', '--max-rate', '2')
+    assert fw.call_count() == before
+
+    plan = upload_bids.read_plan('plan.json')
+    summary = plan['summary']
+    assert (summary['acquisitions'], summary['files']) == (3, 3)
+    assert (summary['classification_updates'], summary['info_updates']) == (0, 3)
+    assert summary['requests'] == 6
+    assert summary['request_rate'] == 2
+    assert summary['estimated_seconds'] == 3.0
+
+
+def test_plan_is_applied_as_planned(queried, fw):
+
+    files = edit_query(queried, 'info_BIDS_Acq', 'mprage', [0, 1])
+    with pytest.raises(SystemExit):
+        run_main(upload_bids.main, 'upload-bids', '-orig', queried, '-mod', 'edited.csv', '--plan', 'plan.json')
+    with pytest.raises(SystemExit):
+        run_main(upload_bids.main, 'upload-bids', '--apply-plan', 'plan.json')
+
+    for acq_id, name in files:
+        f = [x for x in fw.get(acq_id).files if x.name == name][0]
+        assert f['info']['BIDS']['Acq'] == 'mprage'
+    assert upload_bids.FAILS == []
+
+
+def test_rate_estimate_defaults_without_max_rate():
+
+    plan = {'acquisitions': [{'acquisition.id': 'a', 'files': [
+        {'classification': {'Intent': ['Structural']}, 'bids': {'Acq': 'mprage'}}]}]}
+    summary = upload_bids.summarise_plan(plan)
+    assert summary['requests'] == 3
+    assert summary['request_rate'] == upload_bids.REQUEST_RATE
+    assert summary['payload_bytes'] == len('{"Intent": ["Structural"]}') + len('{"Acq": "mprage"}')
+
+
+def test_only_changed_cells_are_planned(queried):
+
+    edit_query(queried, 'info_BIDS_Acq', 'mprage', [0])
+    with pytest.raises(SystemExit):
+        run_main(upload_bids.main, 'upload-bids', '-orig', queried, '-mod', 'edited.csv', '--plan', 'plan.json')
+
+    [acq] = upload_bids.read_plan('plan.json')['acquisitions']
+    [entry] = acq['files']
+    assert entry['bids'] == {'Acq': 'mprage'}
+    assert entry['classification'] is None and not entry['modality_changed']
+
+
+def test_changed_modality_plans_the_classification():
+
+    row = pd.Series({'acquisition.id': 'a', 'name': 'f.nii.gz', 'modality': 'MR',
+                     'classification_Intent': ['Structural'], 'info_BIDS_Acq': 'mprage'})
+    entry = upload_bids.plan_file_update(row, {'modality'})
+    assert entry['classification'] == {} and entry['modality_changed']
+    assert entry['bids'] is None
+    assert upload_bids.plan_file_update(row, set()) is None
+
+
+def test_values_flywheel_already_holds_are_not_sent(shared):
+
+    fw = shared
+    acq = fw.get('p0-u0-s0-a0')
+    nifti = acq.files[1]
+    entry = file_entry(acq, nifti, bids={'Acq': nifti['info']['BIDS'].get('Acq', '')},
+                       classification=dict(nifti['classification']))
+    plan = {'acquisitions': [{'acquisition.id': acq.id, 'files': [entry]}]}
+    journal = upload_bids.UploadJournal('journal.jsonl', plan)
+    before = posts(fw)
+    upload_bids.apply_plan(plan, fw, journal=journal)
+
+    assert posts(fw) == before
+    records = [json.loads(line) for line in open('journal.jsonl')]
+    assert sorted(x['fields'] for x in records) == ['bids', 'classification']
+    assert {x['status'] for x in records} == {'unchanged'}
+
+
+'''
+=========================================================
+13. Shared client
+=========================================================
+'''
+
+def test_client_is_made_and_set_up_once(monkeypatch):
+
+    made, set_up = [], []
+    monkeypatch.setattr(shared_client, 'create_client', lambda **settings: made.append(settings) or FakeClient([]))
+    monkeypatch.setattr(shared_client, 'instrument', set_up.append)
+    monkeypatch.setattr(shared_client, 'request_policy', lambda client, *args, **kwargs: set_up.append(client))
+    reset_client()
+    try:
+        args = SimpleNamespace(workers=16, pool_size=None, keep_alive=True, max_rate=None, retries=5)
+        client = client_for(args)
+        assert client_for(args) is client and get_client() is client
+        assert len(made) == 1 and made[0]['pool_size'] == 16
+        assert set_up == [client, client]
+    finally:
+        reset_client()
+
+
+def test_client_threads_share_one_login(monkeypatch):
+
+    made = []
+
+    def create_client(**settings):
+        made.append(settings)
+        # logging in takes a while, so the other threads come asking meanwhile
+        time.sleep(0.05)
+        return FakeClient([])
+
+    monkeypatch.setattr(shared_client, 'create_client', create_client)
+    reset_client()
+    try:
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(get_client())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(made) == 1
+        assert len(set(map(id, clients))) == 1
+    finally:
+        reset_client()
+
+
+def test_pool_is_sized_for_the_workers():
+
+    pool_manager = SimpleNamespace(connection_pool_kw={'maxsize': 1}, clear=lambda: None)
+    headers = {}
+    api_client = SimpleNamespace(rest_client=SimpleNamespace(pool_manager=pool_manager),
+                                 set_default_header=headers.__setitem__)
+    pool_connections(SimpleNamespace(api_client=api_client), pool_size=16, keep_alive=False)
+    assert pool_manager.connection_pool_kw['maxsize'] == 16
+    assert headers == {'Connection': 'close'}
+
+
+'''
+=========================================================
+14. Unequal cells
+=========================================================
+'''
+
+def test_clearing_a_zero_counts_as_a_change():
+
+    original = pd.DataFrame({'a': [0.0, 1.0, np.nan], 'b': ['x', '', None]})
+    modified = pd.DataFrame({'a': [np.nan, 1.0, np.nan], 'b': ['x', None, None]})
+    mask = unequal_cells_mask(original, modified)
+    assert mask.tolist() == [[True, False], [False, True], [False, False]]
+
+
+def test_unequal_cells_are_logged(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    original = pd.DataFrame({'a': [0, 1], 'b': ['x', 'y']})
+    modified = pd.DataFrame({'a': [0, 2], 'b': ['z', 'y']})
+    assert get_unequal_cells(original, modified) == [[0, 1], [1, 0]]
+
+    [log] = [x for x in os.listdir('.') if x.startswith('provenance_')]
+    rows = read_rows(log)
+    assert [(x['original'], x['modified'], x['row'], x['column']) for x in rows] == \
+        [('x', 'z', '0', 'b'), ('1', '2', '1', 'a')]
+
+
+def test_unequal_cells_need_the_same_shape():
+
+    with pytest.raises(Exception, match='same number of rows'):
+        get_unequal_cells(pd.DataFrame({'a': [1]}), pd.DataFrame({'a': [1, 2]}), provenance=False)
+
+
+'''
+=========================================================
+15. Metrics
+=========================================================
+'''
+
+def test_query_metrics_count_every_call(shared):
+
+    fw = shared
+    run_main(query_bids.main, 'query-bids', '-proj', 'synthetic', '-output', 'query.csv', '--workers', '4',
+             '--metrics', 'metrics.json', '--prometheus', 'metrics.prom')
+
+    with open('metrics.json') as f:
+        summary = json.load(f)
+    assert summary['tool'] == 'query-bids'
+    assert summary['calls'] == fw.call_count()
+    assert {k: v['count'] for k, v in summary['endpoints'].items()} == dict(fw.api_client.calls)
+    assert summary['errors'] == 0
+    assert 'write' in summary['stages']
+
+    with open('metrics.prom') as f:
+        prom = f.read()
+    assert '# TYPE flywheel_api_request_duration_seconds histogram' in prom
+    sessions = summary['endpoints']['GET /sessions/{SessionId}/acquisitions']['count']
+    assert 'flywheel_api_requests_total{{tool="query-bids",endpoint="GET /sessions/{{SessionId}}/acquisitions"}} {}'.format(
+        sessions) in prom.splitlines()
+
+
+def test_metrics_are_written_when_a_run_fails(tmp_path):
+
+    args = SimpleNamespace(metrics=str(tmp_path / 'metrics.json'), prometheus=None)
+    metrics = Metrics()
+    with pytest.raises(RuntimeError):
+        with report_metrics(args, 'upload-bids', metrics):
+            metrics.observe_call('GET /x', 0.2, FakeApiException(503, "Service Unavailable"))
+            raise RuntimeError("interrupted")
+
+    with open(args.metrics) as f:
+        summary = json.load(f)
+    assert summary['errors'] == 1
+    assert summary['endpoints']['GET /x']['errors_by_status'] == {'503': 1}
+    assert summary['endpoints']['GET /x']['latency_buckets']['0.25'] == 1
+    assert summary['endpoints']['GET /x']['latency_buckets']['0.1'] == 0
+
+
+def test_instrumenting_twice_counts_once(fw):
+
+    metrics = Metrics()
+    instrument(fw, metrics)
+    instrument(fw, metrics)
+    fw.get('p0-u0-s0')
+    assert metrics.summary()['calls'] == 1
@@ -288,9 +288,9 @@ def validate(read_in3):
     # check for equality of each cell between the original and modified
     unequal = upload_bids.get_unequal_cells(df_original, df_modified, provenance=True)
     # if any unequal, assess the validity of the modification
-    res = upload_bids.validate_on_unequal_cells(unequal, df_modified)
+    errors = upload_bids.validation_errors(unequal, df_modified)
 
-    return upload_bids.ERROR_MESSAGES, res, df_modified, unequal
+    return errors, errors.empty, df_modified, unequal
 
 def test_validate(validate):
 
@@ -347,9 +347,9 @@ def validate2(read_in4):
     # check for equality of each cell between the original and modified
     unequal = upload_bids.get_unequal_cells(df_original, df_modified, provenance=True)
     # if any unequal, assess the validity of the modification
-    res = upload_bids.validate_on_unequal_cells(unequal, df_modified)
+    errors = upload_bids.validation_errors(unequal, df_modified)
 
-    return upload_bids.ERROR_MESSAGES, res, df_modified, unequal
+    return errors, errors.empty, df_modified, unequal
 
 def test_validate2(validate2):
 